@@ -101,6 +101,7 @@ class AnyKeycode:
         })
         self.names = dict()
         self.prepare_names()
+        self.evaluator = simpleeval.SimpleEval(operators=self.ops, functions=functions, names=self.names)
 
     def prepare_names(self):
         for kc in KEYCODES_SPECIAL + KEYCODES_BASIC + KEYCODES_SHIFTED + KEYCODES_ISO + KEYCODES_BACKLIGHT + \
@@ -114,4 +115,4 @@ class AnyKeycode:
         self.names.update(macros)
 
     def decode(self, s):
-        return simpleeval.simple_eval(s, names=self.names, functions=functions, operators=self.ops)
+        return self.evaluator.eval(s)
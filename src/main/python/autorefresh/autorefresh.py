@@ -2,6 +2,8 @@ import sys
 
 from PyQt5.QtCore import QObject, pyqtSignal
 
+from vial_device import VialDevice
+
 
 class AutorefreshLocker:
 
@@ -63,7 +65,8 @@ class Autorefresh(QObject):
     def load_via_stack(self, data):
         self.thread.load_via_stack(data)
 
-    def select_device(self, idx):
+    def select_device(self, idx, callback):
+        """ callback is called with a Future once the selected device is ready, it may still be loading on return """
         if self.current_device is not None:
             self.current_device.close()
         self.current_device = None
@@ -72,12 +75,15 @@ class Autorefresh(QObject):
 
         if self.current_device is not None:
             if self.current_device.sideload:
-                self.current_device.open(self.thread.sideload_json)
+                self.current_device.open(self.thread.sideload_json, callback)
             elif self.current_device.via_stack:
-                self.current_device.open(self.thread.via_stack_json["definitions"][self.current_device.via_id])
+                self.current_device.open(self.thread.via_stack_json["definitions"][self.current_device.via_id],
+                                         callback)
             else:
-                self.current_device.open(None)
+                self.current_device.open(None, callback)
         self.thread.set_device(self.current_device)
+        if self.current_device is None:
+            VialDevice.opened(callback)
 
     def on_devices_updated(self, devices, changed):
         self.devices = devices
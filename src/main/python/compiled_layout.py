@@ -0,0 +1,222 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import hashlib
+import json
+import logging
+import os
+import pathlib
+
+from PyQt5.QtCore import QStandardPaths
+
+from kle_serial import Serial as KleSerial, Key
+
+
+class CompiledLayout:
+    """
+        KLE keymap reduced to what the GUI needs: flat per-key arrays of geometry, rotation and labels,
+        together with the matrix position, encoder and layout option of every key
+
+        Building it runs the KLE parser once; afterwards it round-trips through plain JSON.
+    """
+
+    VERSION = 1
+
+    GEOMETRY = ["x", "y", "width", "height", "x2", "y2", "width2", "height2",
+                "rotation_x", "rotation_y", "rotation_angle"]
+    MATRIX = ["row", "col", "encoder_idx", "encoder_dir", "layout_index", "layout_option"]
+
+    # what a key is used for
+    KIND_KEY = 0
+    KIND_ENCODER = 1
+    KIND_OTHER = 2
+
+    def __init__(self):
+        self.geometry = {field: [] for field in self.GEOMETRY}
+        self.matrix = {field: [] for field in self.MATRIX}
+        self.decal = []
+        self.labels = []
+        self.kind = []
+
+    def __len__(self):
+        return len(self.kind)
+
+    @classmethod
+    def compile(cls, rows):
+        """ Parses KLE rows, e.g. payload["layouts"]["keymap"] """
+
+        layout = cls()
+        for key in KleSerial().deserialize(rows).keys:
+            row = col = encoder_idx = encoder_dir = None
+            kind = cls.KIND_OTHER
+            if key.labels[4] == "e":
+                encoder_idx, encoder_dir = [int(x) for x in key.labels[0].split(",")]
+                kind = cls.KIND_ENCODER
+            elif key.decal or (key.labels[0] and "," in key.labels[0]):
+                row, col = 0, 0
+                if key.labels[0] and "," in key.labels[0]:
+                    row, col = [int(x) for x in key.labels[0].split(",")]
+                kind = cls.KIND_KEY
+
+            # bottom right corner determines layout index and option in this layout
+            layout_index = layout_option = -1
+            if key.labels[8]:
+                layout_index, layout_option = [int(x) for x in key.labels[8].split(",")]
+
+            for field in cls.GEOMETRY:
+                layout.geometry[field].append(getattr(key, field))
+            for field, value in zip(cls.MATRIX, [row, col, encoder_idx, encoder_dir, layout_index, layout_option]):
+                layout.matrix[field].append(value)
+            layout.decal.append(bool(key.decal))
+            layout.labels.append(key.labels)
+            layout.kind.append(kind)
+        return layout
+
+    def make_key(self, idx):
+        key = Key()
+        for field in self.GEOMETRY:
+            setattr(key, field, self.geometry[field][idx])
+        for field in self.MATRIX:
+            setattr(key, field, self.matrix[field][idx])
+        key.decal = self.decal[idx]
+        key.labels = list(self.labels[idx])
+        return key
+
+    def keys(self, kind=None):
+        """ Returns fresh kle_serial.Key objects, optionally only those of the given kind """
+        return [self.make_key(idx) for idx in range(len(self)) if kind is None or self.kind[idx] == kind]
+
+    def serialize(self):
+        return json.dumps({
+            "version": self.VERSION,
+            "geometry": self.geometry,
+            "matrix": self.matrix,
+            "decal": self.decal,
+            "labels": self.labels,
+            "kind": self.kind,
+        }).encode("utf-8")
+
+    @classmethod
+    def deserialize(cls, data):
+        """ Raises ValueError if data wasn't produced by this version of serialize() """
+
+        obj = json.loads(data.decode("utf-8"))
+        if not isinstance(obj, dict) or obj.get("version") != cls.VERSION:
+            raise ValueError("unsupported compiled layout")
+        layout = cls()
+        try:
+            layout.geometry = {field: obj["geometry"][field] for field in cls.GEOMETRY}
+            layout.matrix = {field: obj["matrix"][field] for field in cls.MATRIX}
+            layout.decal = obj["decal"]
+            layout.labels = obj["labels"]
+            layout.kind = obj["kind"]
+        except (KeyError, TypeError):
+            raise ValueError("malformed compiled layout")
+        if any(len(x) != len(layout.kind) for x in list(layout.geometry.values()) + list(layout.matrix.values())
+               + [layout.decal, layout.labels]):
+            raise ValueError("malformed compiled layout")
+        return layout
+
+
+class LayoutCache:
+    """
+        Compiled layouts addressed by a hash of their KLE source, kept in memory and on disk
+
+        Pass directory=False to keep the cache in memory only
+    """
+
+    MAX_ENTRIES = 64
+
+    # process-wide instance, see shared()
+    instance = None
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.path.join(QStandardPaths.writableLocation(QStandardPaths.AppLocalDataLocation),
+                                     "layouts")
+        self.directory = directory
+        self.memory = dict()
+
+    @classmethod
+    def shared(cls):
+        """ Cache in the default location, shared between keyboards and the built-in keycode palettes """
+        if cls.instance is None:
+            cls.instance = cls()
+        return cls.instance
+
+    @staticmethod
+    def key(rows):
+        """ rows is either the KLE keymap JSON string or the already decoded list """
+        if not isinstance(rows, str):
+            rows = json.dumps(rows, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(rows.encode("utf-8")).hexdigest()[:32]
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def load(self, rows):
+        """ Returns CompiledLayout for the KLE rows, running the parser only if it isn't cached yet """
+
+        key = self.key(rows)
+        if key in self.memory:
+            return self.memory[key]
+
+        layout = self.read(key)
+        if layout is None:
+            layout = CompiledLayout.compile(json.loads(rows) if isinstance(rows, str) else rows)
+            self.write(key, layout)
+        self.memory[key] = layout
+        return layout
+
+    def read(self, key):
+        if not self.directory:
+            return None
+        path = self.path(key)
+        try:
+            with open(path, "rb") as inf:
+                data = inf.read()
+        except OSError:
+            return None
+
+        try:
+            layout = CompiledLayout.deserialize(data)
+        except ValueError:
+            logging.warning("LayoutCache: dropping unusable entry %s", key)
+            self.invalidate(key)
+            return None
+
+        # bump modification time, eviction goes by least recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return layout
+
+    def write(self, key, layout):
+        if not self.directory:
+            return
+        try:
+            pathlib.Path(self.directory).mkdir(parents=True, exist_ok=True)
+            tmp = self.path(key) + ".tmp"
+            with open(tmp, "wb") as outf:
+                outf.write(layout.serialize())
+            os.replace(tmp, self.path(key))
+            self.evict()
+        except OSError as e:
+            logging.warning("LayoutCache: failed to store %s: %s", key, e)
+
+    def invalidate(self, key):
+        self.memory.pop(key, None)
+        if not self.directory:
+            return
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                   if name.endswith(".json")]
+        if len(entries) <= self.MAX_ENTRIES:
+            return
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:len(entries) - self.MAX_ENTRIES]:
+            os.remove(path)
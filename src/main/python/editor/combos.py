@@ -77,6 +77,9 @@ class Combos(BasicEditor):
     def __init__(self):
         super().__init__()
         self.keyboard = None
+        self.active = False
+        # entries are only retrieved from the keyboard once this editor is shown
+        self.entries_loaded = False
 
         self.combo_entries = []
         self.combo_entries_available = []
@@ -94,6 +97,12 @@ class Combos(BasicEditor):
         self.combo_entries = self.combo_entries_available[:self.keyboard.combo_count]
         for x, e in enumerate(self.combo_entries):
             self.tabs.addTab(e.widget(), str(x + 1))
+        self.entries_loaded = False
+        if self.active:
+            self.reload_ui()
+
+    def reload_ui(self):
+        self.entries_loaded = True
         for x, e in enumerate(self.combo_entries):
             e.load(self.keyboard.combo_get(x))
 
@@ -108,6 +117,14 @@ class Combos(BasicEditor):
                (self.device.keyboard and self.device.keyboard.vial_protocol >= VIAL_PROTOCOL_DYNAMIC
                 and self.device.keyboard.combo_count > 0)
 
+    def activate(self):
+        self.active = True
+        if self.keyboard is not None and not self.entries_loaded:
+            self.reload_ui()
+
+    def deactivate(self):
+        self.active = False
+
     def on_key_changed(self):
         for x, e in enumerate(self.combo_entries):
             self.keyboard.combo_set(x, self.combo_entries[x].save())
@@ -2,6 +2,7 @@
 
 import datetime
 import hashlib
+import json
 import struct
 import time
 import threading
@@ -270,15 +271,37 @@ class FirmwareFlasher(BasicEditor):
                 found = self.find_device_with_uid(VialKeyboard, self.uid_restore)
 
             self.log("Found Vial keyboard at {}".format(found.desc["path"].decode("utf-8")))
-            found.open()
             self.device = found
-            self.log("Restoring saved layout...")
-            QCoreApplication.processEvents()
-            found.keyboard.restore_layout(self.layout_restore)
-            found.keyboard.lock()
-            found.close()
-            self.log("Done!")
+            # loading the keyboard and writing the layout both run in the background
+            found.open(callback=self.on_restore_keyboard_loaded)
+            return
+
+        self.unlock_ui()
 
+    def on_restore_keyboard_loaded(self, future):
+        try:
+            future.result()
+        except (RuntimeError, ValueError) as e:
+            self.log("Error: failed to load the keyboard: {}".format(e))
+            self.device.close()
+            self.unlock_ui()
+            return
+
+        keyboard = self.device.keyboard
+        self.log("Restoring saved layout...")
+        if keyboard.restore_needs_unlock(json.loads(self.layout_restore.decode("utf-8"))):
+            Unlocker.unlock(keyboard)
+        keyboard.submit_restore_layout(self.layout_restore, self.on_layout_restored)
+
+    def on_layout_restored(self, future):
+        try:
+            future.result()
+            self.device.keyboard.lock()
+        except (RuntimeError, ValueError) as e:
+            self.log("Error: failed to restore the layout: {}".format(e))
+        else:
+            self.log("Done!")
+        self.device.close()
         self.unlock_ui()
 
     def _on_error(self, msg):
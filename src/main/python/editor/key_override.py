@@ -263,6 +263,9 @@ class KeyOverride(BasicEditor):
     def __init__(self):
         super().__init__()
         self.keyboard = None
+        self.active = False
+        # entries are only retrieved from the keyboard once this editor is shown
+        self.entries_loaded = False
 
         self.key_override_entries = []
         self.key_override_entries_available = []
@@ -280,6 +283,12 @@ class KeyOverride(BasicEditor):
         self.key_override_entries = self.key_override_entries_available[:self.keyboard.key_override_count]
         for x, e in enumerate(self.key_override_entries):
             self.tabs.addTab(e.widget(), str(x + 1))
+        self.entries_loaded = False
+        if self.active:
+            self.reload_ui()
+
+    def reload_ui(self):
+        self.entries_loaded = True
         for x, e in enumerate(self.key_override_entries):
             e.load(self.keyboard.key_override_get(x))
 
@@ -294,6 +303,14 @@ class KeyOverride(BasicEditor):
                (self.device.keyboard and self.device.keyboard.vial_protocol >= VIAL_PROTOCOL_DYNAMIC
                 and self.device.keyboard.key_override_count > 0)
 
+    def activate(self):
+        self.active = True
+        if self.keyboard is not None and not self.entries_loaded:
+            self.reload_ui()
+
+    def deactivate(self):
+        self.active = False
+
     def on_change(self):
         for x, e in enumerate(self.key_override_entries):
             self.keyboard.key_override_set(x, self.key_override_entries[x].save())
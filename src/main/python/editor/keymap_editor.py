@@ -2,7 +2,7 @@
 import json
 
 from PyQt5.QtWidgets import QHBoxLayout, QLabel, QVBoxLayout, QMessageBox, QWidget
-from PyQt5.QtCore import Qt, pyqtSignal
+from PyQt5.QtCore import Qt, pyqtSignal, QTimer
 
 from any_keycode_dialog import AnyKeycodeDialog
 from editor.basic_editor import BasicEditor
@@ -10,6 +10,7 @@ from widgets.keyboard_widget import KeyboardWidget, EncoderWidget
 from keycodes.keycodes import Keycode
 from widgets.square_button import SquareButton
 from tabbed_keycodes import TabbedKeycodes, keycode_filter_masked
+from unlocker import Unlocker
 from util import tr, KeycodeDisplay
 from vial_device import VialKeyboard
 
@@ -57,6 +58,14 @@ class KeymapEditor(BasicEditor):
         self.keyboard = None
         self.current_layer = 0
 
+        # what every key displays on the layers seen so far, layer -> {widget: (code, KeycodeDisplay.describe)}
+        self.layer_display = dict()
+        # fills layer_display for the remaining layers while the GUI is idle
+        self.precompute_timer = QTimer()
+        self.precompute_timer.setSingleShot(True)
+        self.precompute_timer.setInterval(0)
+        self.precompute_timer.timeout.connect(self.precompute_layer_display)
+
         layout_editor.changed.connect(self.on_layout_changed)
 
         self.container.anykey.connect(self.on_any_keycode)
@@ -118,6 +127,8 @@ class KeymapEditor(BasicEditor):
             self.rebuild_layers()
 
             self.container.set_keys(self.keyboard.keys, self.keyboard.encoders)
+            # keycode labels depend on the keyboard, e.g. its custom keycodes
+            self.layer_display.clear()
 
             self.current_layer = 0
             self.on_layout_changed()
@@ -125,6 +136,9 @@ class KeymapEditor(BasicEditor):
             self.tabbed_keycodes.recreate_keycode_buttons()
             TabbedKeycodes.tray.recreate_keycode_buttons()
             self.refresh_layer_display()
+
+            # the keyboard may have only retrieved the first layer so far
+            self.keyboard.prefetch_layers(self.on_layer_loaded)
         self.container.setEnabled(self.valid())
 
     def valid(self):
@@ -133,16 +147,25 @@ class KeymapEditor(BasicEditor):
     def save_layout(self):
         return self.keyboard.save_layout()
 
-    def restore_layout(self, data):
-        if json.loads(data.decode("utf-8")).get("uid") != self.keyboard.keyboard_id:
+    def restore_layout(self, data, callback):
+        """
+            Starts restoring a saved layout in the background, callback gets the Future once it's written
+
+            Returns False if the user backed out before anything was written
+        """
+        saved = json.loads(data.decode("utf-8"))
+        if saved.get("uid") != self.keyboard.keyboard_id:
             ret = QMessageBox.question(self.widget(), "",
                                        tr("KeymapEditor", "Saved keymap belongs to a different keyboard,"
                                                           " are you sure you want to continue?"),
                                        QMessageBox.Yes | QMessageBox.No)
             if ret != QMessageBox.Yes:
-                return
-        self.keyboard.restore_layout(data)
-        self.refresh_layer_display()
+                return False
+        # the unlock dialog has to run here, the I/O worker can't ask the user anything
+        if self.keyboard.restore_needs_unlock(saved) and not Unlocker.unlock(self.keyboard):
+            return False
+        self.keyboard.submit_restore_layout(data, callback)
+        return True
 
     def on_any_keycode(self):
         if self.container.active_key is None:
@@ -161,12 +184,40 @@ class KeymapEditor(BasicEditor):
         if res > 0:
             self.on_keycode_changed(self.dlg.value)
 
-    def code_for_widget(self, widget):
+    def code_for_widget(self, widget, layer=None):
+        if layer is None:
+            layer = self.current_layer
         if widget.desc.row is not None:
-            return self.keyboard.layout[(self.current_layer, widget.desc.row, widget.desc.col)]
+            return self.keyboard.layout[(layer, widget.desc.row, widget.desc.col)]
         else:
-            return self.keyboard.encoder_layout[(self.current_layer, widget.desc.encoder_idx,
-                                                 widget.desc.encoder_dir)]
+            return self.keyboard.encoder_layout[(layer, widget.desc.encoder_idx, widget.desc.encoder_dir)]
+
+    def display_for_widget(self, widget, layer):
+        """ What widget shows on layer; only described again once the keycode there changes """
+        code = self.code_for_widget(widget, layer)
+        displays = self.layer_display.setdefault(layer, dict())
+        cached = displays.get(widget)
+        if cached is None or cached[0] != code:
+            cached = (code, KeycodeDisplay.describe(code))
+            displays[widget] = cached
+        return cached[1]
+
+    def precompute_layer_display(self):
+        """ Describes the keys of one layer which hasn't been displayed yet, then schedules the next one """
+        if not self.valid() or self.keyboard is None:
+            return
+        for layer in range(self.keyboard.layers):
+            if layer not in self.keyboard.loaded_layers:
+                continue
+            # encoders of a layer are only retrieved once it's displayed
+            widgets = [widget for widget in self.container.widgets
+                       if widget.desc.row is not None or layer in self.keyboard.loaded_encoders]
+            displays = self.layer_display.get(layer, dict())
+            if any(widget not in displays for widget in widgets):
+                for widget in widgets:
+                    self.display_for_widget(widget, layer)
+                self.precompute_timer.start()
+                return
 
     def refresh_layer_display(self):
         """ Refresh text on key widgets to display data corresponding to current layer """
@@ -177,17 +228,36 @@ class KeymapEditor(BasicEditor):
             btn.setEnabled(idx != self.current_layer)
             btn.setChecked(idx == self.current_layer)
 
+        # only keys whose legend actually changes get repainted
         for widget in self.container.widgets:
-            code = self.code_for_widget(widget)
-            KeycodeDisplay.display_keycode(widget, code)
-        self.container.update()
-        self.container.updateGeometry()
+            KeycodeDisplay.show(widget, self.display_for_widget(widget, self.current_layer))
+
+        self.precompute_timer.start()
+
+    def refresh_key_display(self, key):
+        """ Refresh only the widgets showing the same matrix position or encoder as key """
+
+        position = (key.desc.row, key.desc.col, key.desc.encoder_idx, key.desc.encoder_dir)
+        for widget in self.container.widgets:
+            if (widget.desc.row, widget.desc.col, widget.desc.encoder_idx, widget.desc.encoder_dir) == position:
+                KeycodeDisplay.show(widget, self.display_for_widget(widget, self.current_layer))
 
     def switch_layer(self, idx):
         self.container.deselect()
         self.current_layer = idx
+        # fetched right away if background loading hasn't got to this layer yet
+        self.keyboard.load_layer(idx)
+        self.keyboard.load_encoders(idx)
         self.refresh_layer_display()
 
+    def on_layer_loaded(self, layer):
+        if self.keyboard is None or layer >= self.keyboard.layers:
+            return
+        if layer == self.current_layer:
+            self.refresh_layer_display()
+        else:
+            self.precompute_timer.start()
+
     def set_key(self, keycode):
         """ Change currently selected key to provided keycode """
 
@@ -215,7 +285,7 @@ class KeymapEditor(BasicEditor):
             keycode = kc.qmk_id.replace("(kc)", "({})".format(keycode))
 
         self.keyboard.set_encoder(l, i, d, keycode)
-        self.refresh_layer_display()
+        self.refresh_key_display(self.container.active_key)
 
     def set_key_matrix(self, keycode):
         l, r, c = self.current_layer, self.container.active_key.desc.row, self.container.active_key.desc.col
@@ -231,11 +301,11 @@ class KeymapEditor(BasicEditor):
                 keycode = kc.qmk_id.replace("(kc)", "({})".format(keycode))
 
             self.keyboard.set_key(l, r, c, keycode)
-            self.refresh_layer_display()
+            self.refresh_key_display(self.container.active_key)
 
     def on_key_clicked(self):
         """ Called when a key on the keyboard widget is clicked """
-        self.refresh_layer_display()
+        # selecting a key doesn't change any legends, the keyboard widget repaints the selection by itself
         if self.container.active_mask:
             self.tabbed_keycodes.set_keycode_filter(keycode_filter_masked)
         else:
@@ -252,4 +322,5 @@ class KeymapEditor(BasicEditor):
         self.keyboard.set_layout_options(self.layout_editor.pack())
 
     def on_keymap_override(self):
+        self.layer_display.clear()
         self.refresh_layer_display()
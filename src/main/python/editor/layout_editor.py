@@ -110,10 +110,8 @@ class LayoutEditor(BasicEditor):
         self.addStretch()
 
     def update_preview(self):
-        self.keyboard_preview.set_keys(self.keyboard.keys, self.keyboard.encoders)
+        # keys stay the same while options change, the preview keeps placements of options it has shown before
         self.keyboard_preview.update_layout()
-        self.keyboard_preview.update()
-        self.keyboard_preview.updateGeometry()
 
     def rebuild(self, device):
         super().rebuild(device)
@@ -139,7 +137,7 @@ class LayoutEditor(BasicEditor):
         self.unpack(self.device.keyboard.layout_options)
 
         self.blockSignals(False)
-        self.update_preview()
+        self.keyboard_preview.set_keys(self.keyboard.keys, self.keyboard.encoders)
 
     def valid(self):
         return isinstance(self.device, VialKeyboard) and self.device.keyboard.layout_labels
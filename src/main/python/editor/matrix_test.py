@@ -6,6 +6,7 @@ import math
 
 from editor.basic_editor import BasicEditor
 from protocol.constants import VIAL_PROTOCOL_MATRIX_TESTER
+from protocol.io_worker import PRIORITY_POLL
 from widgets.keyboard_widget import KeyboardWidget
 from util import tr
 from vial_device import VialKeyboard
@@ -71,17 +72,30 @@ class MatrixTest(BasicEditor):
             w.setPressed(False)
             w.setOn(False)
 
-        self.keyboardWidget.update_layout()
-        self.keyboardWidget.update()
-        self.keyboardWidget.updateGeometry()
-
     def matrix_poller(self):
         if not self.valid():
             self.timer.stop()
             return
 
+        # don't queue up more polls than the device can answer
+        if self.polling:
+            return
+        self.polling = True
+        self.keyboard.submit(PRIORITY_POLL, self.poll_keyboard, callback=self.on_poll_finished)
+
+    def poll_keyboard(self):
+        """ Runs on the I/O worker; returns (unlocked, matrix state) """
+        if not self.keyboard.get_unlock_status(3):
+            return False, None
+        return True, self.keyboard.matrix_poll()
+
+    def on_poll_finished(self, future):
+        self.polling = False
+        if not self.valid():
+            return
+
         try:
-            unlocked = self.keyboard.get_unlock_status(3)
+            unlocked, data = future.result()
         except (RuntimeError, ValueError):
             self.timer.stop()
             return
@@ -101,13 +115,6 @@ class MatrixTest(BasicEditor):
         # Generate 2d array of matrix
         matrix = [[None] * cols for x in range(rows)]
 
-        # Get matrix data from keyboard
-        try:
-            data = self.keyboard.matrix_poll()
-        except (RuntimeError, ValueError):
-            self.timer.stop()
-            return
-
         # Calculate the amount of bytes belong to 1 row, each bit is 1 key, so per 8 keys in a row,
         # a byte is needed for the row.
         row_size = math.ceil(cols / 8)
@@ -141,10 +148,6 @@ class MatrixTest(BasicEditor):
                     if matrix[row][col]:
                         w.setOn(True)
 
-        self.keyboardWidget.update_layout()
-        self.keyboardWidget.update()
-        self.keyboardWidget.updateGeometry()
-
     def unlock(self):
         Unlocker.unlock(self.keyboard)
 
@@ -103,6 +103,9 @@ class TapDance(BasicEditor):
     def __init__(self):
         super().__init__()
         self.keyboard = None
+        self.active = False
+        # entries are only retrieved from the keyboard once this editor is shown
+        self.entries_loaded = False
 
         self.tap_dance_entries = []
         self.tap_dance_entries_available = []
@@ -130,9 +133,12 @@ class TapDance(BasicEditor):
         self.tap_dance_entries = self.tap_dance_entries_available[:self.keyboard.tap_dance_count]
         for x, e in enumerate(self.tap_dance_entries):
             self.tabs.addTab(e.widget(), str(x))
-        self.reload_ui()
+        self.entries_loaded = False
+        if self.active:
+            self.reload_ui()
 
     def reload_ui(self):
+        self.entries_loaded = True
         for x, e in enumerate(self.tap_dance_entries):
             e.load(self.keyboard.tap_dance_get(x))
         self.update_modified_state()
@@ -157,6 +163,14 @@ class TapDance(BasicEditor):
                (self.device.keyboard and self.device.keyboard.vial_protocol >= VIAL_PROTOCOL_DYNAMIC
                 and self.device.keyboard.tap_dance_count > 0)
 
+    def activate(self):
+        self.active = True
+        if self.keyboard is not None and not self.entries_loaded:
+            self.reload_ui()
+
+    def deactivate(self):
+        self.active = False
+
     def on_key_changed(self):
         self.on_save()
 
@@ -3,6 +3,7 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import sys
+from collections import OrderedDict
 
 from keycodes.keycodes_v5 import keycodes_v5
 from keycodes.keycodes_v6 import keycodes_v6
@@ -15,6 +16,18 @@ class Keycode:
     qmk_id_to_keycode = dict()
     protocol = 0
 
+    # values of keycode expressions such as LT(1, KC_A), most recently used last
+    expression_cache = OrderedDict()
+    EXPRESSION_CACHE_SIZE = 4096
+    # AnyKeycode evaluator, its names depend on the current keycode tables
+    expression_engine = None
+    # dense lookup tables built by recreate_keycodes(): qmk_id for every 16-bit keycode (None when it only has
+    # a hex representation) and the other way around
+    serialize_table = None
+    deserialize_table = dict()
+    # bumped by recreate_keycodes(), so that anything derived from labels and tooltips can tell it is stale
+    generation = 0
+
     def __init__(self, qmk_id, label, tooltip=None, masked=False, printable=None, recorder_alias=None, alias=None):
         self.qmk_id = qmk_id
         self.qmk_id_to_keycode[qmk_id] = self
@@ -105,6 +118,14 @@ class Keycode:
     @classmethod
     def serialize(cls, code):
         """ Converts integer keycode to string """
+        if cls.serialize_table is not None and 0 <= code < len(cls.serialize_table):
+            qmk_id = cls.serialize_table[code]
+            return qmk_id if qmk_id is not None else hex(code)
+        return cls.serialize_uncached(code)
+
+    @classmethod
+    def serialize_uncached(cls, code):
+        """ Converts integer keycode to string without going through serialize_table """
         if cls.protocol == 6:
             masked = keycodes_v6.masked
         else:
@@ -129,15 +150,55 @@ class Keycode:
 
         if isinstance(val, int):
             return val
+        code = cls.deserialize_table.get(val)
+        if code is not None:
+            return code
         if val in cls.qmk_id_to_keycode:
             return cls.resolve(cls.qmk_id_to_keycode[val].qmk_id)
-        anykc = AnyKeycode()
+        # output of serialize() for codes without a name
+        if val.startswith("0x"):
+            try:
+                return int(val, 16)
+            except ValueError:
+                pass
+        if val in cls.expression_cache:
+            cls.expression_cache.move_to_end(val)
+            return cls.expression_cache[val]
+
+        if cls.expression_engine is None:
+            cls.expression_engine = AnyKeycode()
         try:
-            return anykc.decode(val)
+            code = cls.expression_engine.decode(val)
         except Exception:
             if reraise:
                 raise
-        return 0
+            return 0
+
+        cls.expression_cache[val] = code
+        if len(cls.expression_cache) > cls.EXPRESSION_CACHE_SIZE:
+            cls.expression_cache.popitem(last=False)
+        return code
+
+    @classmethod
+    def invalidate_expressions(cls):
+        """ Forgets evaluated expressions, needed whenever protocol or keycode tables change """
+        cls.expression_cache.clear()
+        cls.expression_engine = None
+
+    @classmethod
+    def build_tables(cls):
+        """ Precomputes serialize() and deserialize() for all 16-bit keycodes """
+
+        serialize_table = [None] * 0x10000
+        deserialize_table = dict()
+        for code in range(0x10000):
+            qmk_id = cls.serialize_uncached(code)
+            if not qmk_id.startswith("0x"):
+                qmk_id = sys.intern(qmk_id)
+                serialize_table[code] = qmk_id
+                deserialize_table[qmk_id] = code
+        cls.serialize_table = serialize_table
+        cls.deserialize_table = deserialize_table
 
     @classmethod
     def normalize(cls, code):
@@ -949,6 +1010,11 @@ K = None
 def recreate_keycodes():
     """ Regenerates global KEYCODES array """
 
+    Keycode.invalidate_expressions()
+    Keycode.serialize_table = None
+    Keycode.deserialize_table = dict()
+    Keycode.generation += 1
+
     KEYCODES.clear()
     KEYCODES.extend(KEYCODES_SPECIAL + KEYCODES_BASIC + KEYCODES_SHIFTED + KEYCODES_ISO + KEYCODES_LAYERS +
                     KEYCODES_BOOT + KEYCODES_MODIFIERS + KEYCODES_QUANTUM + KEYCODES_BACKLIGHT + KEYCODES_MEDIA +
@@ -958,6 +1024,7 @@ def recreate_keycodes():
     for keycode in KEYCODES:
         KEYCODES_MAP[keycode.qmk_id.replace("(kc)", "")] = keycode
         RAWCODES_MAP[Keycode.deserialize(keycode.qmk_id)] = keycode
+    Keycode.build_tables()
 
 
 def create_user_keycodes():
@@ -1034,7 +1101,8 @@ def recreate_keyboard_keycodes(keyboard):
         generate_keycodes_for_mask("TO",
                                    "Turns on layer and turns off all other layers, except the default layer"))
 
-    for x in range(layers):
+    # layer-tap only has 4 bits for the layer
+    for x in range(min(layers, 16)):
         KEYCODES_LAYERS.append(Keycode("LT{}(kc)".format(x), "LT {}\n(kc)".format(x),
                                        "kc on tap, switch to layer {} while held".format(x), masked=True))
 
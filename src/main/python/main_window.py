@@ -242,8 +242,16 @@ class MainWindow(QMainWindow):
         if dialog.exec_() == QDialog.Accepted:
             with open(dialog.selectedFiles()[0], "rb") as inf:
                 data = inf.read()
-            self.keymap_editor.restore_layout(data)
-            self.rebuild()
+            # the editors stay disabled while the layout is being written to the keyboard
+            self.lock_ui()
+            if not self.keymap_editor.restore_layout(data, self.on_layout_restored):
+                self.unlock_ui()
+
+    def on_layout_restored(self, future):
+        self.unlock_ui()
+        self.rebuild()
+        # raises whatever went wrong while writing the layout
+        future.result()
 
     def on_layout_save(self):
         dialog = QFileDialog()
@@ -279,8 +287,18 @@ class MainWindow(QMainWindow):
             self.on_device_selected()
 
     def on_device_selected(self):
+        # the editors stay disabled while the keyboard is being loaded in the background
+        self.lock_ui()
         try:
-            self.autorefresh.select_device(self.combobox_devices.currentIndex())
+            self.autorefresh.select_device(self.combobox_devices.currentIndex(), self.on_device_opened)
+        except Exception:
+            self.unlock_ui()
+            raise
+
+    def on_device_opened(self, future):
+        self.unlock_ui()
+        try:
+            future.result()
         except ProtocolError:
             QMessageBox.warning(self, "", "Unsupported protocol version!\n"
                                           "Please download latest Vial from https://get.vial.today/")
@@ -305,14 +323,27 @@ class MainWindow(QMainWindow):
 
         # if unlock process was interrupted, we must finish it first
         if isinstance(self.autorefresh.current_device, VialKeyboard) and self.autorefresh.current_device.keyboard.get_unlock_in_progress():
-            Unlocker.unlock(self.autorefresh.current_device.keyboard)
-            self.autorefresh.current_device.keyboard.reload()
+            keyboard = self.autorefresh.current_device.keyboard
+            Unlocker.unlock(keyboard)
+            # editors get rebuilt once the keyboard is loaded again
+            self.lock_ui()
+            keyboard.submit_reload(self.on_keyboard_reloaded, progressive=keyboard.io_worker is not None)
+            return
 
         for e in [self.layout_editor, self.keymap_editor, self.firmware_flasher, self.macro_recorder,
                   self.tap_dance, self.combos, self.key_override, self.qmk_settings, self.matrix_tester,
                   self.rgb_configurator]:
             e.rebuild(self.autorefresh.current_device)
 
+        # tap dance, combos and key overrides of editors that weren't opened yet follow once the window is up
+        if isinstance(self.autorefresh.current_device, VialKeyboard):
+            QTimer.singleShot(0, self.autorefresh.current_device.keyboard.prefetch_dynamic)
+
+    def on_keyboard_reloaded(self, future):
+        self.unlock_ui()
+        future.result()
+        self.rebuild()
+
     def refresh_tabs(self):
         self.tabs.clear()
         for container, lbl in self.editors:
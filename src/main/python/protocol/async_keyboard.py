@@ -0,0 +1,168 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from protocol.keyboard_comm import Keyboard
+from util import MSG_LEN, RetryPolicy, response_matches
+
+
+class AsyncHidTransport:
+    """
+        Non-blocking access to a Linux hidraw device node
+
+        Reports are read from the event loop through loop.add_reader, so waiting for responses doesn't take up
+        a thread of its own. Only one request per device is in flight at a time. Unless a loop is given, the
+        transport attaches itself to the loop which runs its first exchange.
+    """
+
+    def __init__(self, fd, loop=None, policy=None):
+        self.fd = fd
+        self.loop = None
+        self.lock = None
+        self.policy = policy or RetryPolicy()
+        # (request, future) currently waiting for its response
+        self.waiter = None
+        os.set_blocking(fd, False)
+        if loop is not None:
+            self.attach(loop)
+
+    def attach(self, loop):
+        """ Starts reading reports from loop, which all later exchanges have to run on """
+        if self.loop is loop:
+            return
+        if self.loop is not None:
+            raise RuntimeError("the transport is already attached to another event loop")
+        self.loop = loop
+        loop.add_reader(self.fd, self.on_readable)
+
+    @classmethod
+    def open(cls, path, loop=None):
+        return cls(os.open(path, os.O_RDWR), loop)
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.remove_reader(self.fd)
+        os.close(self.fd)
+
+    def on_readable(self):
+        while True:
+            try:
+                data = os.read(self.fd, MSG_LEN)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                if self.waiter is not None and not self.waiter[1].done():
+                    self.waiter[1].set_exception(e)
+                return
+            if not data:
+                return
+            # anything we're not waiting for is a stale response to a request that already timed out
+            if self.waiter is not None and not self.waiter[1].done() and response_matches(self.waiter[0], data):
+                self.waiter[1].set_result(data)
+
+    async def exchange(self, msg, retries=1):
+        """ Sends a request and waits for its response, same semantics as util.hid_send """
+        if len(msg) > MSG_LEN:
+            raise RuntimeError("message must be less than 32 bytes")
+        msg += b"\x00" * (MSG_LEN - len(msg))
+
+        # within a coroutine this is the loop running it
+        self.attach(asyncio.get_event_loop())
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            for attempt in range(retries):
+                if attempt > 0:
+                    await asyncio.sleep(self.policy.backoff(attempt))
+                self.policy.check_deadline()
+                future = self.loop.create_future()
+                self.waiter = (msg, future)
+                start = self.loop.time()
+                try:
+                    # add 00 at start for hidraw report id
+                    if os.write(self.fd, b"\x00" + msg) != MSG_LEN + 1:
+                        continue
+                    timeout_ms = self.policy.timeout_ms(attempt, final=attempt == retries - 1)
+                    data = await asyncio.wait_for(future, timeout_ms / 1000)
+                except (OSError, asyncio.TimeoutError):
+                    continue
+                finally:
+                    self.waiter = None
+                self.policy.observe(self.loop.time() - start)
+                self.policy.record(msg, attempt)
+                return data
+            self.policy.record(msg, retries)
+        raise RuntimeError("failed to communicate with the device")
+
+
+class AsyncKeyboard:
+    """
+        asyncio facade over Keyboard, e.g. for provisioning scripts driving many keyboards at once
+
+        The protocol logic is the regular synchronous Keyboard with all of its mixins, it isn't awaitable
+        itself. Commands run on a thread pool shared by all AsyncKeyboard instances, and every packet they send
+        is handed over to the event loop, which does all of the actual device I/O. A command occupies one pool
+        thread from start to finish, blocked while its packets are in flight, so at most MAX_WORKERS keyboards
+        make progress at the same time and commands for the others wait for a free thread. Commands for the
+        same keyboard always run one after another.
+        This is meant for unattended use: a command which would need the unlock dialog raises RuntimeError
+        unless the keyboard was unlocked beforehand.
+    """
+
+    # size of the thread pool shared by all instances
+    MAX_WORKERS = 8
+    executor = None
+
+    def __init__(self, transport):
+        self.transport = transport
+        if AsyncKeyboard.executor is None:
+            AsyncKeyboard.executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS)
+        # Keyboard isn't thread-safe, commands for this keyboard must not overlap
+        self.lock = None
+        self.keyboard = Keyboard(transport, usb_send=self._usb_send)
+        transport.policy = self.keyboard.retry_policy
+
+    @classmethod
+    def open(cls, path, loop=None):
+        return cls(AsyncHidTransport.open(path, loop))
+
+    def close(self):
+        self.transport.close()
+
+    def _usb_send(self, transport, msg, retries=1):
+        return asyncio.run_coroutine_threadsafe(transport.exchange(msg, retries), transport.loop).result()
+
+    async def run(self, fn, *args):
+        """ Runs any synchronous Keyboard method, e.g. await kb.run(kb.keyboard.set_layout_options, 1) """
+        loop = asyncio.get_event_loop()
+        self.transport.attach(loop)
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            return await loop.run_in_executor(self.executor, fn, *args)
+
+    async def reload(self, sideload_json=None):
+        await self.run(self.keyboard.reload, sideload_json)
+
+    async def set_key(self, layer, row, col, code):
+        await self.run(self.keyboard.set_key, layer, row, col, code)
+
+    async def set_encoder(self, layer, index, direction, code):
+        await self.run(self.keyboard.set_encoder, layer, index, direction, code)
+
+    async def set_macro(self, data):
+        await self.run(self.keyboard.set_macro, data)
+
+    async def save_layout(self):
+        return await self.run(self.keyboard.save_layout)
+
+    async def restore_layout(self, data):
+        await self.run(self.keyboard.restore_layout, data)
+
+    async def get_uid(self):
+        return await self.run(self.keyboard.get_uid)
+
+    def __getattr__(self, name):
+        # read-only access to loaded state, e.g. kb.layers or kb.layout
+        return getattr(self.keyboard, name)
@@ -1,26 +1,65 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
+import logging
 import struct
 
 from protocol.constants import CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP
+from protocol.io_worker import PRIORITY_INTERACTIVE
 
 
 class BaseProtocol:
     vial_protocol = None
     usb_send = NotImplemented
+    usb_send_many = None
+    pipeline_window = 1
+    retry_policy = None
+    io_worker = None
     dev = None
+    # changes to loaded state queued up by a restore running on the I/O worker, see _update
+    deferred_updates = None
 
     macro_count = 0
     macro_memory = 0
     macro = b""
 
+    def _usb_send_many(self, msgs, retries=1):
+        """ Sends a batch of independent requests, pipelined if the transport supports it """
+        if self.usb_send_many is None or self.pipeline_window < 2:
+            return [self.usb_send(self.dev, msg, retries=retries) for msg in msgs]
+        return self.usb_send_many(self.dev, msgs, window=self.pipeline_window, retries=retries,
+                                  on_stall=self._pipeline_stall)
+
+    def _pipeline_stall(self):
+        logging.warning("device stalled with %d requests in flight, falling back to lock-step mode",
+                        self.pipeline_window)
+        self.pipeline_window = 1
+
+    def _update(self, fn, *args):
+        """
+            Applies a change to the loaded state once it has been written to the device
+
+            While a restore runs in the background the change is queued in deferred_updates instead, so that
+            the GUI thread applies all of them once the restore is done, see Keyboard.submit_restore_layout.
+        """
+        if self.deferred_updates is not None:
+            self.deferred_updates.append((fn, args))
+        else:
+            fn(*args)
+
+    def _load_now(self, fn, *args):
+        """
+            Runs fn, which loads something that is needed right away
+
+            On the I/O worker this goes ahead of any background loading that is still queued.
+        """
+        if self.io_worker is not None:
+            self.io_worker.call(PRIORITY_INTERACTIVE, fn, *args)
+        else:
+            fn(*args)
+
     def _retrieve_dynamic_entries(self, cmd, count, fmt):
         out = []
-        for x in range(count):
-            data = self.usb_send(
-                self.dev,
-                struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP, cmd, x),
-                retries=20
-            )
+        requests = [struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP, cmd, x) for x in range(count)]
+        for x, data in enumerate(self._usb_send_many(requests, retries=20)):
             if data[0] != 0:
                 raise RuntimeError("failed retrieving dynamic={} entry {} from the device".format(cmd, x))
             out.append(struct.unpack(fmt, data[1:1 + struct.calcsize(fmt)]))
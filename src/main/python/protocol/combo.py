@@ -11,23 +11,34 @@ from unlocker import Unlocker
 class ProtocolCombo(BaseProtocol):
 
     def reload_combo(self):
-        self.combo_entries = self._retrieve_dynamic_entries(DYNAMIC_VIAL_COMBO_GET,
-                                                            self.combo_count, "<HHHHH")
-        for x, entry in enumerate(self.combo_entries):
-            self.combo_entries[x] = (Keycode.serialize(entry[0]), Keycode.serialize(entry[1]),
-                                     Keycode.serialize(entry[2]), Keycode.serialize(entry[3]),
-                                     Keycode.serialize(entry[4]))
+        entries = self._retrieve_dynamic_entries(DYNAMIC_VIAL_COMBO_GET, self.combo_count, "<HHHHH")
+        # only published once complete, this can run on the I/O worker while the GUI looks at the entries
+        self.combo_entries = [(Keycode.serialize(entry[0]), Keycode.serialize(entry[1]),
+                               Keycode.serialize(entry[2]), Keycode.serialize(entry[3]),
+                               Keycode.serialize(entry[4])) for entry in entries]
+
+    def load_combo(self):
+        """ Makes sure the combo entries have been retrieved """
+        if self.combo_entries is None:
+            self._load_now(self._load_combo)
+
+    def _load_combo(self):
+        # checked again here, a background job might have got to it first
+        if self.combo_entries is None:
+            self.reload_combo()
 
     def combo_get(self, idx):
+        self.load_combo()
         return self.combo_entries[idx]
 
     def combo_set(self, idx, entry):
+        self.load_combo()
         if self.combo_entries[idx] == entry:
             return
         # for the replacement key
         if entry[-1] == RESET_KEYCODE:
             Unlocker.unlock(self)
-        self.combo_entries[idx] = entry
+        self._update(self.combo_entries.__setitem__, idx, entry)
         entry = [Keycode.deserialize(entry[0]), Keycode.deserialize(entry[1]), Keycode.deserialize(entry[2]),
                  Keycode.deserialize(entry[3]), Keycode.deserialize(entry[4])]
         serialized = struct.pack("<HHHHH", *entry)
@@ -35,6 +46,7 @@ class ProtocolCombo(BaseProtocol):
                                             DYNAMIC_VIAL_COMBO_SET, idx) + serialized, retries=20)
 
     def save_combo(self):
+        self.load_combo()
         combo = []
         for entry in self.combo_entries:
             combo.append((entry[0], entry[1], entry[2], entry[3], entry[4]))
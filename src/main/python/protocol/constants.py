@@ -14,7 +14,9 @@ CMD_VIA_MACRO_GET_BUFFER = 0x0E
 CMD_VIA_MACRO_SET_BUFFER = 0x0F
 CMD_VIA_GET_LAYER_COUNT = 0x11
 CMD_VIA_KEYMAP_GET_BUFFER = 0x12
+CMD_VIA_KEYMAP_SET_BUFFER = 0x13
 CMD_VIA_VIAL_PREFIX = 0xFE
+VIA_UNHANDLED = 0xFF
 VIA_LAYOUT_OPTIONS = 0x02
 VIA_SWITCH_MATRIX_STATE = 0x03
 QMK_BACKLIGHT_BRIGHTNESS = 0x09
@@ -51,6 +53,13 @@ DYNAMIC_VIAL_KEY_OVERRIDE_SET = 0x06
 
 # how much of a macro/keymap buffer we can read/write per packet
 BUFFER_FETCH_CHUNK = 28
+# below this many changed keys, a keymap is written one key per packet rather than through the keymap buffer
+KEYMAP_BULK_WRITE_MIN_KEYS = 4
+
+# how long high-level operations are allowed to take in total, including all retries, in seconds
+RELOAD_DEADLINE = 60
+RESTORE_LAYOUT_DEADLINE = 60
+SET_MACRO_DEADLINE = 20
 
 # When did we get support for advanced macros (including delays in macros)
 VIAL_PROTOCOL_ADVANCED_MACROS = 2
@@ -0,0 +1,104 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import hashlib
+import logging
+import os
+import pathlib
+import struct
+
+from PyQt5.QtCore import QStandardPaths
+
+
+class DefinitionCache:
+    """
+        On-disk cache of compressed keyboard definitions (vial.json), so that opening a keyboard
+        we've already seen doesn't need to download the whole definition again
+
+        Entries are addressed by keyboard UID, protocol versions, definition size and a hash of the first and
+        last blocks of the definition. The definition is an xz stream, which ends with the CRC64 of the
+        uncompressed data followed by the index and the stream footer. The index and footer only depend on
+        sizes, so the probed tail has to reach back far enough to cover the CRC64 - that is what gives away
+        edits anywhere in the definition which keep its compressed size.
+    """
+
+    MAX_ENTRIES = 64
+    # how many leading blocks of the definition are hashed into the key
+    HEAD_BLOCKS = 2
+    # how many trailing bytes of the definition are hashed into the key: CRC64 check (8 bytes),
+    # index (12 bytes) and stream footer (12 bytes), with some slack for a larger index
+    TAIL_BYTES = 48
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.path.join(QStandardPaths.writableLocation(QStandardPaths.AppLocalDataLocation),
+                                     "definitions")
+        self.directory = directory
+
+    @staticmethod
+    def key(keyboard_id, vial_protocol, via_protocol, size, probe):
+        """ probe is the content of the blocks returned by probe_blocks() """
+        digest = hashlib.sha256(struct.pack("<QIII", keyboard_id, vial_protocol, via_protocol, size) + probe)
+        return "{:016X}-{}".format(keyboard_id, digest.hexdigest()[:32])
+
+    @classmethod
+    def probe_blocks(cls, size, block_size):
+        """ Which of the definition blocks make up the cache key, for a definition of size bytes """
+        blocks = (size + block_size - 1) // block_size
+        tail = max(size - cls.TAIL_BYTES, 0) // block_size
+        return sorted(set(range(min(blocks, cls.HEAD_BLOCKS))) | set(range(tail, blocks)))
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".bin")
+
+    def get(self, key, size):
+        """ Returns the cached definition payload or None """
+        path = self.path(key)
+        try:
+            with open(path, "rb") as inf:
+                data = inf.read()
+        except OSError:
+            return None
+
+        digest, payload = data[:32], data[32:]
+        if len(payload) != size or hashlib.sha256(payload).digest() != digest:
+            logging.warning("DefinitionCache: dropping corrupted entry %s", key)
+            self.invalidate(key)
+            return None
+
+        # bump modification time, eviction goes by least recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return payload
+
+    def put(self, key, payload):
+        try:
+            pathlib.Path(self.directory).mkdir(parents=True, exist_ok=True)
+            # only the latest definition of a keyboard is worth keeping
+            uid = key.split("-")[0]
+            for name in os.listdir(self.directory):
+                if name.startswith(uid + "-"):
+                    os.remove(os.path.join(self.directory, name))
+
+            tmp = self.path(key) + ".tmp"
+            with open(tmp, "wb") as outf:
+                outf.write(hashlib.sha256(payload).digest() + payload)
+            os.replace(tmp, self.path(key))
+            self.evict()
+        except OSError as e:
+            logging.warning("DefinitionCache: failed to store %s: %s", key, e)
+
+    def invalidate(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                   if name.endswith(".bin")]
+        if len(entries) <= self.MAX_ENTRIES:
+            return
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:len(entries) - self.MAX_ENTRIES]:
+            os.remove(path)
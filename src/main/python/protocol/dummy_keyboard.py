@@ -6,16 +6,28 @@ class DummyKeyboard(Keyboard):
     def reload_layers(self):
         self.layers = 4
 
-    def reload_keymap(self):
-        for layer in range(self.layers):
+    def reload_keymap(self, layers=None):
+        if layers is None:
+            layers = range(self.layers)
+
+        for layer in layers:
             for row, col in self.rowcol.keys():
                 self.layout[(layer, row, col)] = "KC_NO"
 
-        for layer in range(self.layers):
+        self.loaded_layers.update(layers)
+
+    def reload_encoders(self, layers=None):
+        if layers is None:
+            layers = range(self.layers)
+
+        for layer in layers:
             for idx in self.encoderpos:
                 self.encoder_layout[(layer, idx, 0)] = "KC_NO"
                 self.encoder_layout[(layer, idx, 1)] = "KC_NO"
 
+        self.loaded_encoders.update(layers)
+
+    def reload_layout_options(self):
         if self.layout_labels:
             self.layout_options = 0
 
@@ -22,3 +22,7 @@ class ProtocolDynamic(BaseProtocol):
         self.tap_dance_count = data[0]
         self.combo_count = data[1]
         self.key_override_count = data[2]
+        # the entries themselves are retrieved on first use, or in the background with prefetch_dynamic
+        self.tap_dance_entries = None
+        self.combo_entries = None
+        self.key_override_entries = None
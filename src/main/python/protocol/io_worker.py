@@ -0,0 +1,97 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import itertools
+import threading
+from concurrent.futures import Future
+from queue import PriorityQueue
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+# lower value is served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_POLL = 1
+PRIORITY_BULK = 2
+# queued behind everything else
+PRIORITY_STOP = 3
+
+
+class IoWorker(QThread):
+    """
+        Owns the device handle: every exchange with the device runs on this thread, most urgent job first
+
+        Jobs hand their result back through a concurrent.futures.Future; a callback, if given,
+        is invoked with that future on the thread which owns this object (normally the GUI thread)
+    """
+
+    job_finished = pyqtSignal(object, object)
+
+    def __init__(self):
+        super().__init__()
+
+        self.queue = PriorityQueue()
+        # keeps jobs of the same priority in submission order
+        self.counter = itertools.count()
+        self.thread_ident = None
+        # guards stopped, so that nothing gets queued once stop() has emptied the queue
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.job_finished.connect(self.on_job_finished)
+
+    def run(self):
+        self.thread_ident = threading.get_ident()
+        while True:
+            priority, _, fn, args, kwargs, future, callback = self.queue.get()
+            if fn is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            if callback is not None:
+                self.job_finished.emit(callback, future)
+
+    def on_job_finished(self, callback, future):
+        callback(future)
+
+    def submit(self, priority, fn, *args, callback=None, **kwargs):
+        """
+            Queues fn to run on the worker thread; fn must not need any user interaction (e.g. unlocking)
+
+            Once the worker is stopped, the returned future fails right away with RuntimeError
+        """
+        future = Future()
+        with self.lock:
+            if not self.stopped:
+                self.queue.put((priority, next(self.counter), fn, args, kwargs, future, callback))
+                return future
+        future.set_exception(RuntimeError("device I/O worker was stopped"))
+        if callback is not None:
+            self.job_finished.emit(callback, future)
+        return future
+
+    def call(self, priority, fn, *args, **kwargs):
+        """ Runs fn on the worker thread and waits for its result """
+        if self.on_worker_thread():
+            return fn(*args, **kwargs)
+        return self.submit(priority, fn, *args, **kwargs).result()
+
+    def wrap(self, fn, priority=PRIORITY_INTERACTIVE):
+        """ Returns a synchronous version of fn which always executes on the worker thread """
+        def wrapper(*args, **kwargs):
+            return self.call(priority, fn, *args, **kwargs)
+        return wrapper
+
+    def on_worker_thread(self):
+        return threading.get_ident() == self.thread_ident
+
+    def stop(self):
+        """ Cancels queued jobs, lets the one that is running finish, then terminates the thread """
+        with self.lock:
+            if not self.stopped:
+                self.stopped = True
+                while not self.queue.empty():
+                    job = self.queue.get_nowait()
+                    job[5].cancel()
+                self.queue.put((PRIORITY_STOP, next(self.counter), None, (), {}, None, None))
+        self.wait()
@@ -85,24 +85,38 @@ class ProtocolKeyOverride(BaseProtocol):
     def reload_key_override(self):
         entries = self._retrieve_dynamic_entries(DYNAMIC_VIAL_KEY_OVERRIDE_GET,
                                                  self.key_override_count, "<HHHBBBB")
-        self.key_override_entries = []
-        for e in entries:
-            e = (Keycode.serialize(e[0]), Keycode.serialize(e[1]), e[2], e[3], e[4], e[5], e[6])
-            self.key_override_entries.append(KeyOverrideEntry(e))
+        # only published once complete, this can run on the I/O worker while the GUI looks at the entries
+        self.key_override_entries = [
+            KeyOverrideEntry((Keycode.serialize(e[0]), Keycode.serialize(e[1]), e[2], e[3], e[4], e[5], e[6]))
+            for e in entries
+        ]
+
+    def load_key_override(self):
+        """ Makes sure the key override entries have been retrieved """
+        if self.key_override_entries is None:
+            self._load_now(self._load_key_override)
+
+    def _load_key_override(self):
+        # checked again here, a background job might have got to it first
+        if self.key_override_entries is None:
+            self.reload_key_override()
 
     def key_override_get(self, idx):
+        self.load_key_override()
         return self.key_override_entries[idx]
 
     def key_override_set(self, idx, entry):
+        self.load_key_override()
         if entry != self.key_override_entries[idx]:
             if entry.replacement == RESET_KEYCODE:
                 Unlocker.unlock(self)
 
-            self.key_override_entries[idx] = entry
+            self._update(self.key_override_entries.__setitem__, idx, entry)
             self.usb_send(self.dev, struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP,
                                                 DYNAMIC_VIAL_KEY_OVERRIDE_SET, idx) + entry.serialize())
 
     def save_key_override(self):
+        self.load_key_override()
         return [e.save() for e in self.key_override_entries]
 
     def restore_key_override(self, data):
@@ -1,27 +1,35 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
+import logging
 import struct
 import json
 import lzma
+import time
 from collections import OrderedDict
+from concurrent.futures import Future
+from functools import partial
 
 from keycodes.keycodes import RESET_KEYCODE, Keycode, recreate_keyboard_keycodes
-from kle_serial import Serial as KleSerial
+from compiled_layout import CompiledLayout
 from protocol.combo import ProtocolCombo
 from protocol.constants import CMD_VIA_GET_PROTOCOL_VERSION, CMD_VIA_GET_KEYBOARD_VALUE, CMD_VIA_SET_KEYBOARD_VALUE, \
     CMD_VIA_SET_KEYCODE, CMD_VIA_LIGHTING_SET_VALUE, CMD_VIA_LIGHTING_GET_VALUE, CMD_VIA_LIGHTING_SAVE, \
-    CMD_VIA_GET_LAYER_COUNT, CMD_VIA_KEYMAP_GET_BUFFER, CMD_VIA_VIAL_PREFIX, VIA_LAYOUT_OPTIONS, \
-    VIA_SWITCH_MATRIX_STATE, QMK_BACKLIGHT_BRIGHTNESS, QMK_BACKLIGHT_EFFECT, QMK_RGBLIGHT_BRIGHTNESS, \
-    QMK_RGBLIGHT_EFFECT, QMK_RGBLIGHT_EFFECT_SPEED, QMK_RGBLIGHT_COLOR, VIALRGB_GET_INFO, VIALRGB_GET_MODE, \
-    VIALRGB_GET_SUPPORTED, VIALRGB_SET_MODE, CMD_VIAL_GET_KEYBOARD_ID, CMD_VIAL_GET_SIZE, CMD_VIAL_GET_DEFINITION, \
-    CMD_VIAL_GET_ENCODER, CMD_VIAL_SET_ENCODER, CMD_VIAL_GET_UNLOCK_STATUS, CMD_VIAL_UNLOCK_START, CMD_VIAL_UNLOCK_POLL, \
-    CMD_VIAL_LOCK, CMD_VIAL_QMK_SETTINGS_QUERY, CMD_VIAL_QMK_SETTINGS_GET, CMD_VIAL_QMK_SETTINGS_SET, \
-    CMD_VIAL_QMK_SETTINGS_RESET, BUFFER_FETCH_CHUNK, VIAL_PROTOCOL_QMK_SETTINGS
+    CMD_VIA_GET_LAYER_COUNT, CMD_VIA_KEYMAP_GET_BUFFER, CMD_VIA_KEYMAP_SET_BUFFER, CMD_VIA_VIAL_PREFIX, \
+    VIA_LAYOUT_OPTIONS, VIA_SWITCH_MATRIX_STATE, QMK_BACKLIGHT_BRIGHTNESS, QMK_BACKLIGHT_EFFECT, \
+    QMK_RGBLIGHT_BRIGHTNESS, QMK_RGBLIGHT_EFFECT, QMK_RGBLIGHT_EFFECT_SPEED, QMK_RGBLIGHT_COLOR, VIALRGB_GET_INFO, \
+    VIALRGB_GET_MODE, VIALRGB_GET_SUPPORTED, VIALRGB_SET_MODE, CMD_VIAL_GET_KEYBOARD_ID, CMD_VIAL_GET_SIZE, \
+    CMD_VIAL_GET_DEFINITION, CMD_VIAL_GET_ENCODER, CMD_VIAL_SET_ENCODER, CMD_VIAL_GET_UNLOCK_STATUS, \
+    CMD_VIAL_UNLOCK_START, CMD_VIAL_UNLOCK_POLL, CMD_VIAL_LOCK, CMD_VIAL_QMK_SETTINGS_QUERY, \
+    CMD_VIAL_QMK_SETTINGS_GET, CMD_VIAL_QMK_SETTINGS_SET, CMD_VIAL_QMK_SETTINGS_RESET, BUFFER_FETCH_CHUNK, \
+    VIAL_PROTOCOL_QMK_SETTINGS, RELOAD_DEADLINE, RESTORE_LAYOUT_DEADLINE, KEYMAP_BULK_WRITE_MIN_KEYS
+from protocol.definition_cache import DefinitionCache
 from protocol.dynamic import ProtocolDynamic
-from protocol.key_override import ProtocolKeyOverride
+from protocol.io_worker import PRIORITY_BULK
+from protocol.key_override import ProtocolKeyOverride, KeyOverrideEntry
+from protocol.keymap_store import KeymapStore
 from protocol.macro import ProtocolMacro
 from protocol.tap_dance import ProtocolTapDance
 from unlocker import Unlocker
-from util import MSG_LEN, hid_send
+from util import MSG_LEN, HID_PIPELINE_WINDOW, RetryPolicy, hid_send, hid_send_many
 
 SUPPORTED_VIA_PROTOCOL = [-1, 9]
 SUPPORTED_VIAL_PROTOCOL = [-1, 0, 1, 2, 3, 4, 5, 6]
@@ -34,17 +42,39 @@ class ProtocolError(Exception):
 class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo, ProtocolKeyOverride):
     """ Low-level communication with a vial-enabled keyboard """
 
-    def __init__(self, dev, usb_send=hid_send):
+    def __init__(self, dev, usb_send=hid_send, usb_send_many=None, pipeline_window=HID_PIPELINE_WINDOW,
+                 definition_cache=None, layout_cache=None):
         self.dev = dev
+        # when set, definitions of known keyboards are loaded from disk instead of downloaded
+        self.definition_cache = definition_cache
+        # when set, the KLE layout of known definitions is loaded precompiled instead of parsed
+        self.layout_cache = layout_cache
+        # retry timing learnt for this device, and deadlines for the high-level operations below
+        self.retry_policy = RetryPolicy()
+        if usb_send is hid_send:
+            usb_send = partial(hid_send, policy=self.retry_policy)
+        if usb_send_many is hid_send_many:
+            usb_send_many = partial(hid_send_many, policy=self.retry_policy)
         self.usb_send = usb_send
+        # when set, bulk reads keep several requests in flight instead of doing one round trip per packet
+        self.usb_send_many = usb_send_many
+        self.pipeline_window = pipeline_window if usb_send_many is not None else 1
+        # whether set_keymap may write several neighbouring keys per packet through the keymap buffer
+        self.bulk_keymap_write = True
+        self.io_worker = None
         self.definition = None
 
         # n.b. using OrderedDict here to make order of layout requests consistent for tests
         self.rowcol = OrderedDict()
         self.encoderpos = OrderedDict()
         self.encoder_count = 0
-        self.layout = dict()
-        self.encoder_layout = dict()
+        self.layout = KeymapStore()
+        self.encoder_layout = KeymapStore()
+        # layers whose keymap and encoder mapping have been retrieved so far, see load_layer and load_encoders
+        self.loaded_layers = set()
+        self.loaded_encoders = set()
+        # pending background jobs started by prefetch_layers
+        self.prefetch_jobs = []
         self.rows = self.cols = self.layers = 0
         self.layout_labels = None
         self.layout_options = -1
@@ -68,13 +98,79 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
 
         self.via_protocol = self.vial_protocol = self.keyboard_id = -1
 
-    def reload(self, sideload_json=None):
-        """ Load information about the keyboard: number of layers, physical key layout """
+    def attach_io_worker(self, worker):
+        """ Routes all further communication with the device through the worker's thread """
+        self.io_worker = worker
+        self.usb_send = worker.wrap(self.usb_send)
+        if self.usb_send_many is not None:
+            self.usb_send_many = worker.wrap(self.usb_send_many)
 
+    def submit(self, priority, fn, *args, callback=None):
+        """
+            Runs fn in the background on the I/O worker, or right away if there is none
+
+            Returns a Future; callback, if given, is called with it once fn is done
+        """
+        if self.io_worker is not None:
+            return self.io_worker.submit(priority, fn, *args, callback=callback)
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        if callback is not None:
+            callback(future)
+        return future
+
+    def reload(self, sideload_json=None, progressive=False):
+        """
+            Load information about the keyboard: number of layers, physical key layout
+
+            With progressive set, only the keymap of the first layer is retrieved; other layers are loaded
+            on first use, or ahead of that with prefetch_layers.
+        """
+
+        with self.retry_policy.operation("reload", RELOAD_DEADLINE):
+            self._reload_device(sideload_json)
+            self._reload_keycodes()
+            self._reload_keymap(progressive)
+
+    def submit_reload(self, callback, sideload_json=None, progressive=False):
+        """
+            Reloads in the background on the I/O worker, callback gets the Future once everything is loaded
+
+            Device I/O runs in two jobs on the worker. In between, the global keycode tables, which the GUI reads
+            all the time, are rebuilt on the calling thread.
+        """
+        deadline = time.monotonic() + RELOAD_DEADLINE
+
+        def timed(fn, *args):
+            with self.retry_policy.operation("reload", max(0, deadline - time.monotonic())):
+                fn(*args)
+
+        def on_device_loaded(future):
+            if future.exception() is None:
+                try:
+                    self._reload_keycodes()
+                except Exception as e:
+                    future = Future()
+                    future.set_exception(e)
+                else:
+                    self.submit(PRIORITY_BULK, timed, self._reload_keymap, progressive, callback=callback)
+                    return
+            callback(future)
+
+        return self.submit(PRIORITY_BULK, timed, self._reload_device, sideload_json, callback=on_device_loaded)
+
+    def _reload_device(self, sideload_json):
+        """ First part of reload: everything up to the keymap, which needs the keycodes of this keyboard """
+        self.cancel_prefetch()
         self.rowcol = OrderedDict()
         self.encoderpos = OrderedDict()
-        self.layout = dict()
-        self.encoder_layout = dict()
+        self.layout = KeymapStore()
+        self.encoder_layout = KeymapStore()
+        self.loaded_layers = set()
+        self.loaded_encoders = set()
 
         self.reload_layout(sideload_json)
         self.reload_layers()
@@ -86,15 +182,19 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
 
         self.reload_dynamic()
 
+    def _reload_keycodes(self):
         # based on the number of macros, tapdance, etc, this will generate global keycode arrays
         recreate_keyboard_keycodes(self)
 
         # at this stage we have correct keycode info and can reload everything that depends on keycodes
-        self.reload_keymap()
+        self.create_keymap()
+
+    def _reload_keymap(self, progressive):
+        layers = range(min(self.layers, 1)) if progressive else None
+        self.reload_keymap(layers)
+        self.reload_encoders(layers)
+        self.reload_layout_options()
         self.reload_macros_late()
-        self.reload_tap_dance()
-        self.reload_combo()
-        self.reload_key_override()
 
     def reload_layers(self):
         """ Get how many layers the keyboard has """
@@ -128,18 +228,7 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
             sz = struct.unpack("<I", data[0:4])[0]
 
             # get the payload
-            payload = b""
-            block = 0
-            while sz > 0:
-                data = self.usb_send(self.dev, struct.pack("<BBI", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_DEFINITION, block),
-                                     retries=20)
-                if sz < MSG_LEN:
-                    data = data[:sz]
-                payload += data
-                block += 1
-                sz -= MSG_LEN
-
-            payload = json.loads(lzma.decompress(payload))
+            payload = self._load_definition(sz)
 
         self.check_protocol_version()
 
@@ -157,69 +246,166 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
 
         self.custom_keycodes = payload.get("customKeycodes", None)
 
-        serial = KleSerial()
-        kb = serial.deserialize(payload["layouts"]["keymap"])
-
-        self.keys = []
-        self.encoders = []
-
-        for key in kb.keys:
-            key.row = key.col = None
-            key.encoder_idx = key.encoder_dir = None
-            if key.labels[4] == "e":
-                idx, direction = key.labels[0].split(",")
-                idx, direction = int(idx), int(direction)
-                key.encoder_idx = idx
-                key.encoder_dir = direction
-                self.encoderpos[idx] = True
-                self.encoder_count = max(self.encoder_count, idx + 1)
-                self.encoders.append(key)
-            elif key.decal or (key.labels[0] and "," in key.labels[0]):
-                row, col = 0, 0
-                if key.labels[0] and "," in key.labels[0]:
-                    row, col = key.labels[0].split(",")
-                    row, col = int(row), int(col)
-                key.row = row
-                key.col = col
-                self.rowcol[(row, col)] = True
-                self.keys.append(key)
-
-            # bottom right corner determines layout index and option in this layout
-            key.layout_index = -1
-            key.layout_option = -1
-            if key.labels[8]:
-                idx, opt = key.labels[8].split(",")
-                key.layout_index, key.layout_option = int(idx), int(opt)
-
-    def reload_keymap(self):
-        """ Load current key mapping from the keyboard """
-
-        keymap = b""
-        # calculate what the size of keymap will be and retrieve the entire binary buffer
-        size = self.layers * self.rows * self.cols * 2
-        for x in range(0, size, BUFFER_FETCH_CHUNK):
-            offset = x
-            sz = min(size - offset, BUFFER_FETCH_CHUNK)
-            data = self.usb_send(self.dev, struct.pack(">BHB", CMD_VIA_KEYMAP_GET_BUFFER, offset, sz), retries=20)
-            keymap += data[4:4+sz]
-
-        for layer in range(self.layers):
-            for row, col in self.rowcol.keys():
-                if row >= self.rows or col >= self.cols:
-                    raise RuntimeError("malformed vial.json, key references {},{} but matrix declares rows={} cols={}"
-                                       .format(row, col, self.rows, self.cols))
-                # determine where this (layer, row, col) will be located in keymap array
-                offset = layer * self.rows * self.cols * 2 + row * self.cols * 2 + col * 2
-                keycode = Keycode.serialize(struct.unpack(">H", keymap[offset:offset+2])[0])
-                self.layout[(layer, row, col)] = keycode
+        if self.layout_cache is not None:
+            compiled = self.layout_cache.load(payload["layouts"]["keymap"])
+        else:
+            compiled = CompiledLayout.compile(payload["layouts"]["keymap"])
+
+        self.keys = compiled.keys(CompiledLayout.KIND_KEY)
+        self.encoders = compiled.keys(CompiledLayout.KIND_ENCODER)
+
+        for key in self.keys:
+            self.rowcol[(key.row, key.col)] = True
+        for key in self.encoders:
+            self.encoderpos[key.encoder_idx] = True
+            self.encoder_count = max(self.encoder_count, key.encoder_idx + 1)
+
+    def _load_definition(self, sz):
+        """ Downloads and decodes the definition, or takes it from definition_cache if it's already known """
+
+        blocks = (sz + MSG_LEN - 1) // MSG_LEN
+        requests = [struct.pack("<BBI", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_DEFINITION, block) for block in range(blocks)]
+        if self.definition_cache is None or blocks == 0:
+            return json.loads(lzma.decompress(b"".join(self._usb_send_many(requests, retries=20))[:sz]))
+
+        # only fetch the blocks which identify the definition
+        fetched = dict()
+        probe_blocks = DefinitionCache.probe_blocks(sz, MSG_LEN)
+        fetched.update(zip(probe_blocks, self._usb_send_many([requests[x] for x in probe_blocks], retries=20)))
+        key = DefinitionCache.key(self.keyboard_id, self.vial_protocol, self.via_protocol, sz,
+                                  b"".join(fetched[x] for x in probe_blocks))
+
+        payload = self.definition_cache.get(key, sz)
+        if payload is not None:
+            try:
+                return json.loads(lzma.decompress(payload))
+            except (lzma.LZMAError, ValueError):
+                self.definition_cache.invalidate(key)
+
+        rest = [x for x in range(blocks) if x not in fetched]
+        fetched.update(zip(rest, self._usb_send_many([requests[x] for x in rest], retries=20)))
+        payload = b"".join(fetched[x] for x in range(blocks))[:sz]
+        definition = json.loads(lzma.decompress(payload))
+        self.definition_cache.put(key, payload)
+        return definition
+
+    def create_keymap(self):
+        """ Allocates keymap storage for the matrix positions and encoders present in the layout """
+
+        for row, col in self.rowcol.keys():
+            if row >= self.rows or col >= self.cols:
+                raise RuntimeError("malformed vial.json, key references {},{} but matrix declares rows={} cols={}"
+                                   .format(row, col, self.rows, self.cols))
+        # reading a layer that hasn't been retrieved yet fetches it right away
+        self.layout = KeymapStore(self.layers, self.rows, self.cols, loader=self.load_layer)
+        self.layout.set_present(self.rowcol.keys())
+        self.encoder_layout = KeymapStore(self.layers, self.encoder_count, 2, loader=self.load_encoders)
+        self.encoder_layout.set_present([(idx, direction) for idx in self.encoderpos for direction in range(2)])
+
+    def reload_keymap(self, layers=None):
+        """ Load current key mapping of the given layers, or of all of them, from the keyboard """
+
+        # only retrieve the parts of the keymap buffer that hold keys of the layout, matrix positions
+        # no key refers to are skipped unless they fall within a packet anyway
+        if layers is None:
+            layers = range(self.layers)
+            ranges = self.layout.ranges(BUFFER_FETCH_CHUNK // 2)
+        else:
+            size = self.rows * self.cols
+            ranges = []
+            for layer in layers:
+                ranges += self.layout.ranges(BUFFER_FETCH_CHUNK // 2, layer * size, (layer + 1) * size)
+        requests = [struct.pack(">BHB", CMD_VIA_KEYMAP_GET_BUFFER, start * 2, (end - start) * 2)
+                    for start, end in ranges]
+        for (start, end), data in zip(ranges, self._usb_send_many(requests, retries=20)):
+            self.layout.load(data[4:4 + (end - start) * 2], start)
+
+        self.loaded_layers.update(layers)
+
+    def reload_encoders(self, layers=None):
+        """ Load current encoder mapping of the given layers, or of all of them, from the keyboard """
+
+        if layers is None:
+            layers = range(self.layers)
+        keys = [(layer, idx) for layer in layers for idx in self.encoderpos]
+        requests = [struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_ENCODER, layer, idx) for layer, idx in keys]
+        for (layer, idx), data in zip(keys, self._usb_send_many(requests, retries=20)):
+            self.encoder_layout.set_code((layer, idx, 0), struct.unpack(">H", data[0:2])[0])
+            self.encoder_layout.set_code((layer, idx, 1), struct.unpack(">H", data[2:4])[0])
+
+        self.loaded_encoders.update(layers)
+
+    def load_layer(self, layer):
+        """ Makes sure the keymap of layer has been retrieved """
+        if layer not in self.loaded_layers:
+            self._load_now(self._load_layer, layer)
+
+    def _load_layer(self, layer):
+        # checked again here, the layer might have been loaded by a job that was already queued
+        if layer < self.layers and layer not in self.loaded_layers:
+            self.reload_keymap([layer])
+
+    def load_encoders(self, layer):
+        """ Makes sure the encoder mapping of layer has been retrieved, e.g. once the layer is displayed """
+        if layer not in self.loaded_encoders:
+            self._load_now(self._load_encoders, [layer])
+
+    def _load_encoders(self, layers):
+        layers = [layer for layer in layers if layer < self.layers and layer not in self.loaded_encoders]
+        if layers:
+            self.reload_encoders(layers)
+
+    def load_all_layers(self):
+        """ Makes sure the keymap and encoders of every layer have been retrieved, e.g. before saving """
+        if len(self.loaded_layers) < self.layers:
+            self._load_now(self._load_all_keymaps)
+        if len(self.loaded_encoders) < self.layers:
+            self._load_now(self._load_encoders, range(self.layers))
+
+    def _load_all_keymaps(self):
+        layers = [layer for layer in range(self.layers) if layer not in self.loaded_layers]
+        if layers:
+            self.reload_keymap(layers)
+
+    def prefetch_layers(self, callback=None):
+        """
+            Loads every layer that isn't loaded yet in the background, one job per layer
 
+            callback, if given, is called with the layer number once that layer is ready
+        """
+        self.prefetch_jobs = [job for job in self.prefetch_jobs if not job.done()]
         for layer in range(self.layers):
-            for idx in self.encoderpos:
-                data = self.usb_send(self.dev, struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_ENCODER, layer, idx),
-                                     retries=20)
-                self.encoder_layout[(layer, idx, 0)] = Keycode.serialize(struct.unpack(">H", data[0:2])[0])
-                self.encoder_layout[(layer, idx, 1)] = Keycode.serialize(struct.unpack(">H", data[2:4])[0])
-
+            if layer not in self.loaded_layers:
+                self.prefetch_jobs.append(self.submit(PRIORITY_BULK, self._load_layer, layer,
+                                                      callback=partial(self._on_layer_prefetched, layer, callback)))
+
+    def prefetch_dynamic(self):
+        """ Loads tap dance, combo and key override entries that haven't been needed yet in the background """
+        self.prefetch_jobs = [job for job in self.prefetch_jobs if not job.done()]
+        for entries, load in [(self.tap_dance_entries, self._load_tap_dance), (self.combo_entries, self._load_combo),
+                              (self.key_override_entries, self._load_key_override)]:
+            if entries is None:
+                self.prefetch_jobs.append(self.submit(PRIORITY_BULK, load, callback=self._on_dynamic_prefetched))
+
+    def _on_dynamic_prefetched(self, future):
+        if future.exception() is not None:
+            # not fatal, the entries get another try when they're first used
+            logging.warning("failed to load dynamic entries in the background: %s", future.exception())
+
+    def _on_layer_prefetched(self, layer, callback, future):
+        if future.exception() is not None:
+            # not fatal, the layer gets another try when it's first used
+            logging.warning("failed to load layer %d in the background: %s", layer, future.exception())
+        elif callback is not None:
+            callback(layer)
+
+    def cancel_prefetch(self):
+        """ Drops background loading that hasn't started yet, e.g. before the device is closed """
+        for job in self.prefetch_jobs:
+            job.cancel()
+        self.prefetch_jobs = []
+
+    def reload_layout_options(self):
         if self.layout_labels:
             data = self.usb_send(self.dev, struct.pack("BB", CMD_VIA_GET_KEYBOARD_VALUE, VIA_LAYOUT_OPTIONS),
                                  retries=20)
@@ -309,28 +495,57 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
                 self.settings[qsid] = QmkSettings.qsid_deserialize(qsid, data[1:])
 
     def set_key(self, layer, row, col, code):
+        self.load_layer(layer)
         key = (layer, row, col)
-        if self.layout[key] != code:
+        value = Keycode.deserialize(code)
+        if self.layout.code(key) != value:
             if code == RESET_KEYCODE:
                 Unlocker.unlock(self)
 
-            self.usb_send(self.dev, struct.pack(">BBBBH", CMD_VIA_SET_KEYCODE, layer, row, col,
-                                                Keycode.deserialize(code)), retries=20)
-            self.layout[key] = code
+            self.usb_send(self.dev, struct.pack(">BBBBH", CMD_VIA_SET_KEYCODE, layer, row, col, value), retries=20)
+            self._update(self.layout.set_code, key, value)
+
+    def set_keymap(self, target):
+        """
+            Writes every key where target, a modified copy of self.layout.snapshot(), differs from the keymap
+
+            Large changes go out through the keymap buffer, up to BUFFER_FETCH_CHUNK bytes of neighbouring keys
+            per packet. Small ones, or every change when bulk_keymap_write is off, are sent one key at a time.
+        """
+        changed = [key for key in self.layout.diff(target) if key in self.layout]
+        if not changed:
+            return
+        if Keycode.deserialize(RESET_KEYCODE) in [target.code(key) for key in changed]:
+            Unlocker.unlock(self)
+
+        spans = self.layout.spans(target, BUFFER_FETCH_CHUNK // 2)
+        if self.bulk_keymap_write and len(changed) >= KEYMAP_BULK_WRITE_MIN_KEYS and len(spans) < len(changed):
+            requests = []
+            for start, end in spans:
+                chunk = struct.pack(">{}H".format(end - start), *target.codes[start:end])
+                requests.append(struct.pack(">BHB", CMD_VIA_KEYMAP_SET_BUFFER, start * 2, len(chunk)) + chunk)
+        else:
+            requests = [struct.pack(">BBBBH", CMD_VIA_SET_KEYCODE, *key, target.code(key)) for key in changed]
+        self._usb_send_many(requests, retries=20)
+
+        for key in changed:
+            self._update(self.layout.set_code, key, target.code(key))
 
     def set_encoder(self, layer, index, direction, code):
+        self.load_encoders(layer)
         key = (layer, index, direction)
-        if self.encoder_layout[key] != code:
+        value = Keycode.deserialize(code)
+        if self.encoder_layout.code(key) != value:
             if code == RESET_KEYCODE:
                 Unlocker.unlock(self)
 
             self.usb_send(self.dev, struct.pack(">BBBBBH", CMD_VIA_VIAL_PREFIX, CMD_VIAL_SET_ENCODER,
-                                                layer, index, direction, Keycode.deserialize(code)), retries=20)
-            self.encoder_layout[key] = code
+                                                layer, index, direction, value), retries=20)
+            self._update(self.encoder_layout.set_code, key, value)
 
     def set_layout_options(self, options):
         if self.layout_options != -1 and self.layout_options != options:
-            self.layout_options = options
+            self._update(setattr, self, "layout_options", options)
             self.usb_send(self.dev, struct.pack(">BBI", CMD_VIA_SET_KEYBOARD_VALUE, VIA_LAYOUT_OPTIONS, options),
                           retries=20)
 
@@ -367,6 +582,7 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
     def save_layout(self):
         """ Serializes current layout to a binary """
 
+        self.load_all_layers()
         data = {"version": 1, "uid": self.keyboard_id}
 
         layout = []
@@ -406,14 +622,84 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
     def restore_layout(self, data):
         """ Restores saved layout """
 
-        data = json.loads(data.decode("utf-8"))
+        with self.retry_policy.operation("restore_layout", RESTORE_LAYOUT_DEADLINE):
+            self._restore_layout(json.loads(data.decode("utf-8")))
+
+    def submit_restore_layout(self, data, callback):
+        """
+            Restores saved layout as a background job on the I/O worker, callback gets the Future once done
+
+            Only the device writes happen on the worker; the keymap, macros and dynamic entries held here change
+            on the calling thread right before callback runs, even if the restore failed part way through.
+            Anything which needs the keyboard unlocked must be taken care of beforehand, see restore_needs_unlock.
+        """
+        updates = []
+
+        def restore():
+            self.deferred_updates = updates
+            try:
+                self.restore_layout(data)
+            finally:
+                self.deferred_updates = None
+
+        def on_restored(future):
+            for fn, args in updates:
+                fn(*args)
+            callback(future)
+
+        return self.submit(PRIORITY_BULK, restore, callback=on_restored)
 
-        # restore keymap
+    def restore_needs_unlock(self, data):
+        """
+            Whether restoring data, a parsed saved layout, might write a RESET keycode or macros, which needs
+            the keyboard to be unlocked first
+
+            Only looks at what is already loaded and doesn't talk to the device, so it can run on the GUI thread
+            before the restore itself is handed off to the I/O worker. Keys and entries which weren't loaded yet
+            count as changed, so this may ask for an unlock that wasn't strictly needed, never the other way around.
+        """
+        reset = Keycode.deserialize(RESET_KEYCODE)
+        for l, layer in enumerate(data["layout"]):
+            for r, row in enumerate(layer):
+                for c, code in enumerate(row):
+                    key = (l, r, c)
+                    if key in self.layout and Keycode.deserialize(code) == reset and \
+                            (l not in self.loaded_layers or self.layout.code(key) != reset):
+                        return True
+        for l, layer in enumerate(data["encoder_layout"]):
+            for e, encoder in enumerate(layer):
+                for direction in range(2):
+                    key = (l, e, direction)
+                    if Keycode.deserialize(encoder[direction]) == reset and \
+                            (l not in self.loaded_encoders or self.encoder_layout.get(key) != reset):
+                        return True
+
+        macro = self.restored_macro_data(data.get("macro"))
+        if macro is not None and macro != self.macro:
+            return True
+
+        if any(entry[x] == RESET_KEYCODE for entry in data.get("tap_dance", [])[:self.tap_dance_count]
+               for x in range(4)):
+            return True
+        if any(entry[-1] == RESET_KEYCODE for entry in data.get("combo", [])[:self.combo_count]):
+            return True
+        for entry in data.get("key_override", [])[:self.key_override_count]:
+            ko = KeyOverrideEntry()
+            ko.restore(entry)
+            if ko.replacement == RESET_KEYCODE:
+                return True
+        return False
+
+    def _restore_layout(self, data):
+        # restore keymap, only keys that actually differ get written
+        self.load_all_layers()
+        keymap = self.layout.snapshot()
         for l, layer in enumerate(data["layout"]):
             for r, row in enumerate(layer):
                 for c, code in enumerate(row):
-                    if (l, r, c) in self.layout:
-                        self.set_key(l, r, c, Keycode.serialize(Keycode.deserialize(code)))
+                    if (l, r, c) in keymap:
+                        keymap.set_code((l, r, c), Keycode.deserialize(code))
+        self.set_keymap(keymap)
 
         # restore encoders
         for l, layer in enumerate(data["encoder_layout"]):
@@ -507,7 +793,7 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
 
     def qmk_settings_set(self, qsid, value):
         from editor.qmk_settings import QmkSettings
-        self.settings[qsid] = value
+        self._update(self.settings.__setitem__, qsid, value)
         data = self.usb_send(self.dev, struct.pack("<BBH", CMD_VIA_VIAL_PREFIX, CMD_VIAL_QMK_SETTINGS_SET, qsid)
                              + QmkSettings.qsid_serialize(qsid, value),
                              retries=20)
@@ -0,0 +1,171 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import sys
+from array import array
+
+from keycodes.keycodes import Keycode
+
+
+class KeymapStore:
+    """
+        Keycodes of a layers x rows x cols grid: the keymap, or the encoder map as layers x encoders x 2
+
+        Keycodes are kept as 16-bit integers in a flat array. Indexing with a (layer, row, col) tuple
+        gives the qmk_id string, so this can be used like a dict of those. Only positions that exist on
+        the keyboard are present; everything else behaves like a missing key. A present position is valid
+        once its keycode has been loaded. Reading one that isn't calls loader with its layer first, which
+        is expected to load it, see Keyboard.load_layer.
+    """
+
+    def __init__(self, layers=0, rows=0, cols=0, loader=None):
+        self.shape = (layers, rows, cols)
+        self.codes = array("H", bytes(2 * layers * rows * cols))
+        self.present = bytearray(layers * rows * cols)
+        self.valid = bytearray(layers * rows * cols)
+        self.loader = loader
+
+    def index(self, key):
+        """ Returns the position of (layer, row, col) in the flat array, or None if it's outside the grid """
+        layer, row, col = key
+        layers, rows, cols = self.shape
+        if 0 <= layer < layers and 0 <= row < rows and 0 <= col < cols:
+            return (layer * rows + row) * cols + col
+        return None
+
+    def key(self, idx):
+        layers, rows, cols = self.shape
+        return idx // (rows * cols), idx // cols % rows, idx % cols
+
+    def set_present(self, positions):
+        """ Marks (row, col) positions as present on every layer """
+        for layer in range(self.shape[0]):
+            for row, col in positions:
+                self.present[self.index((layer, row, col))] = 1
+
+    def load(self, data, start=0):
+        """
+            Takes keycodes from a big-endian buffer, as returned by the firmware, starting at position start
+            of the flat array; by default the buffer holds the entire grid
+
+            The present positions among them become valid.
+        """
+        codes = array("H")
+        codes.frombytes(data[:2 * (len(self.codes) - start)])
+        if sys.byteorder == "little":
+            codes.byteswap()
+        end = start + len(codes)
+        self.codes[start:end] = codes
+        self.valid[start:end] = self.present[start:end]
+
+    def ranges(self, max_length, first=0, last=None):
+        """
+            Covers all present positions between first and last with as few (start, end) ranges of the flat
+            array as possible, each at most max_length positions long; by default the entire array is covered
+
+            Missing positions inside a range come along for free; those between ranges are never touched.
+        """
+        ranges = []
+        start = end = None
+        for idx in range(first, len(self.present) if last is None else last):
+            if not self.present[idx]:
+                continue
+            if start is not None and idx - start < max_length:
+                end = idx + 1
+            else:
+                if start is not None:
+                    ranges.append((start, end))
+                start, end = idx, idx + 1
+        if start is not None:
+            ranges.append((start, end))
+        return ranges
+
+    def code(self, key):
+        """ Returns the keycode at (layer, row, col) as an integer, loading its layer first if needed """
+        idx = self.index(key)
+        if idx is None or not self.present[idx]:
+            raise KeyError(key)
+        if not self.valid[idx] and self.loader is not None:
+            self.loader(key[0])
+        if not self.valid[idx]:
+            raise KeyError(key)
+        return self.codes[idx]
+
+    def set_code(self, key, code):
+        idx = self.index(key)
+        if idx is None:
+            raise KeyError(key)
+        self.codes[idx] = code
+        self.present[idx] = 1
+        self.valid[idx] = 1
+
+    def __getitem__(self, key):
+        return Keycode.serialize(self.code(key))
+
+    def __setitem__(self, key, code):
+        self.set_code(key, Keycode.deserialize(code))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        idx = self.index(key)
+        return idx is not None and self.present[idx] == 1
+
+    def keys(self):
+        return [self.key(idx) for idx, present in enumerate(self.present) if present]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self.present.count(1)
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def snapshot(self):
+        """ Returns an independent copy, which never loads anything itself """
+        copy = KeymapStore()
+        copy.shape = self.shape
+        copy.codes = array("H", self.codes)
+        copy.present = bytearray(self.present)
+        copy.valid = bytearray(self.valid)
+        return copy
+
+    def diff(self, other):
+        """ Returns (layer, row, col) of valid positions where other holds a different keycode """
+        if other.shape != self.shape:
+            raise ValueError("cannot compare keymaps of different shape")
+        return [self.key(idx) for idx, (a, b) in enumerate(zip(self.codes, other.codes))
+                if a != b and (self.valid[idx] or other.valid[idx])]
+
+    def spans(self, other, max_length):
+        """
+            Groups the valid positions where other holds a different keycode into (start, end) ranges of the
+            flat array, each at most max_length positions long
+
+            A range may take in unchanged positions between two changes, but never one that isn't valid,
+            so writing other's keycodes over a range only touches keys that exist on the keyboard and
+            whose keycode is known.
+        """
+        if other.shape != self.shape:
+            raise ValueError("cannot compare keymaps of different shape")
+        spans = []
+        start = end = None
+        for idx, (a, b) in enumerate(zip(self.codes, other.codes)):
+            if not self.valid[idx]:
+                if start is not None:
+                    spans.append((start, end))
+                    start = None
+            elif a != b:
+                if start is not None and idx - start < max_length:
+                    end = idx + 1
+                else:
+                    if start is not None:
+                        spans.append((start, end))
+                    start, end = idx, idx + 1
+        if start is not None:
+            spans.append((start, end))
+        return spans
@@ -6,7 +6,7 @@ from macro.macro_action import SS_TAP_CODE, SS_DOWN_CODE, SS_UP_CODE, ActionText
 from macro.macro_action_ui import tag_to_action
 from protocol.base_protocol import BaseProtocol
 from protocol.constants import CMD_VIA_MACRO_GET_COUNT, CMD_VIA_MACRO_GET_BUFFER_SIZE, CMD_VIA_MACRO_GET_BUFFER, \
-    CMD_VIA_MACRO_SET_BUFFER, BUFFER_FETCH_CHUNK, VIAL_PROTOCOL_ADVANCED_MACROS
+    CMD_VIA_MACRO_SET_BUFFER, BUFFER_FETCH_CHUNK, VIAL_PROTOCOL_ADVANCED_MACROS, SET_MACRO_DEADLINE
 from unlocker import Unlocker
 from util import chunks
 
@@ -149,10 +149,16 @@ class ProtocolMacro(BaseProtocol):
         self.macro = b""
         if self.macro_memory:
             # now retrieve the entire buffer, MACRO_CHUNK bytes at a time, as that is what fits into a packet
+            requests = []
             for x in range(0, self.macro_memory, BUFFER_FETCH_CHUNK):
                 sz = min(BUFFER_FETCH_CHUNK, self.macro_memory - x)
-                data = self.usb_send(self.dev, struct.pack(">BHB", CMD_VIA_MACRO_GET_BUFFER, x, sz), retries=20)
-                self.macro += data[4:4 + sz]
+                requests.append(struct.pack(">BHB", CMD_VIA_MACRO_GET_BUFFER, x, sz))
+            # fetch one pipeline window at a time so that we can stop as soon as all macros are in
+            while requests:
+                batch = requests[:self.pipeline_window]
+                requests = requests[len(batch):]
+                for request, data in zip(batch, self._usb_send_many(batch, retries=20)):
+                    self.macro += data[4:4 + request[3]]
                 if self.macro.count(b"\x00") > self.macro_count:
                     break
             # macros are stored as NUL-separated strings, so let's clean up the buffer
@@ -169,11 +175,12 @@ class ProtocolMacro(BaseProtocol):
         if len(data) > self.macro_memory:
             raise RuntimeError("the macro is too big: got {} max {}".format(len(data), self.macro_memory))
 
-        for x, chunk in enumerate(chunks(data, BUFFER_FETCH_CHUNK)):
-            off = x * BUFFER_FETCH_CHUNK
-            self.usb_send(self.dev, struct.pack(">BHB", CMD_VIA_MACRO_SET_BUFFER, off, len(chunk)) + chunk,
-                          retries=20)
-        self.macro = data
+        with self.retry_policy.operation("set_macro", SET_MACRO_DEADLINE):
+            for x, chunk in enumerate(chunks(data, BUFFER_FETCH_CHUNK)):
+                off = x * BUFFER_FETCH_CHUNK
+                self.usb_send(self.dev, struct.pack(">BHB", CMD_VIA_MACRO_SET_BUFFER, off, len(chunk)) + chunk,
+                              retries=20)
+        self._update(setattr, self, "macro", data)
 
     def save_macro(self):
         macros = self.macros_deserialize(self.macro)
@@ -183,8 +190,15 @@ class ProtocolMacro(BaseProtocol):
         return out
 
     def restore_macros(self, macros):
+        data = self.restored_macro_data(macros)
+        if data is not None and data != self.macro:
+            Unlocker.unlock(self)
+            self.set_macro(data)
+
+    def restored_macro_data(self, macros):
+        """ Serializes saved macros the way restore_macros writes them, or None if there's nothing to restore """
         if not isinstance(macros, list):
-            return
+            return None
 
         full_macro = []
         for macro in macros:
@@ -199,10 +213,7 @@ class ProtocolMacro(BaseProtocol):
             full_macro += [[] for x in range(self.macro_count - len(full_macro))]
         full_macro = full_macro[:self.macro_count]
         # TODO: log a warning if macro is cutoff
-        data = self.macros_serialize(full_macro)[0:self.macro_memory]
-        if data != self.macro:
-            Unlocker.unlock(self)
-            self.set_macro(data)
+        return self.macros_serialize(full_macro)[0:self.macro_memory]
 
     def macro_serialize(self, macro):
         """
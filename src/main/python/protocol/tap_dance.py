@@ -11,23 +11,34 @@ from unlocker import Unlocker
 class ProtocolTapDance(BaseProtocol):
 
     def reload_tap_dance(self):
-        self.tap_dance_entries = self._retrieve_dynamic_entries(DYNAMIC_VIAL_TAP_DANCE_GET,
-                                                                self.tap_dance_count, "<HHHHH")
-        for x, entry in enumerate(self.tap_dance_entries):
-            self.tap_dance_entries[x] = (Keycode.serialize(entry[0]), Keycode.serialize(entry[1]),
-                                         Keycode.serialize(entry[2]), Keycode.serialize(entry[3]),
-                                         entry[4])
+        entries = self._retrieve_dynamic_entries(DYNAMIC_VIAL_TAP_DANCE_GET, self.tap_dance_count, "<HHHHH")
+        # only published once complete, this can run on the I/O worker while the GUI looks at the entries
+        self.tap_dance_entries = [(Keycode.serialize(entry[0]), Keycode.serialize(entry[1]),
+                                   Keycode.serialize(entry[2]), Keycode.serialize(entry[3]),
+                                   entry[4]) for entry in entries]
+
+    def load_tap_dance(self):
+        """ Makes sure the tap dance entries have been retrieved """
+        if self.tap_dance_entries is None:
+            self._load_now(self._load_tap_dance)
+
+    def _load_tap_dance(self):
+        # checked again here, a background job might have got to it first
+        if self.tap_dance_entries is None:
+            self.reload_tap_dance()
 
     def tap_dance_get(self, idx):
+        self.load_tap_dance()
         return self.tap_dance_entries[idx]
 
     def tap_dance_set(self, idx, entry):
+        self.load_tap_dance()
         if self.tap_dance_entries[idx] == entry:
             return
         for x in range(4):
             if entry[x] == RESET_KEYCODE:
                 Unlocker.unlock(self)
-        self.tap_dance_entries[idx] = entry
+        self._update(self.tap_dance_entries.__setitem__, idx, entry)
         entry = [Keycode.deserialize(entry[0]), Keycode.deserialize(entry[1]), Keycode.deserialize(entry[2]),
                  Keycode.deserialize(entry[3]), entry[4]]
         serialized = struct.pack("<HHHHH", *entry)
@@ -35,6 +46,7 @@ class ProtocolTapDance(BaseProtocol):
                                             DYNAMIC_VIAL_TAP_DANCE_SET, idx) + serialized, retries=20)
 
     def save_tap_dance(self):
+        self.load_tap_dance()
         tap_dance = []
         for entry in self.tap_dance_entries:
             tap_dance.append((entry[0], entry[1], entry[2], entry[3], entry[4]))
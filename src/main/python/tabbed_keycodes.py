@@ -1,4 +1,5 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
+from collections import OrderedDict
 
 from PyQt5.QtCore import Qt, pyqtSignal
 from PyQt5.QtWidgets import QTabWidget, QWidget, QScrollArea, QApplication, QVBoxLayout
@@ -7,12 +8,11 @@ from PyQt5.QtGui import QPalette
 from constants import KEYCODE_BTN_RATIO
 from widgets.display_keyboard import DisplayKeyboard
 from widgets.display_keyboard_defs import ansi_100, ansi_80, ansi_70, iso_100, iso_80, iso_70, mods, mods_narrow
-from widgets.flowlayout import FlowLayout
+from widgets.keycode_view import KeycodeModel, KeycodeView
 from keycodes.keycodes import KEYCODES_BASIC, KEYCODES_ISO, KEYCODES_MACRO, KEYCODES_LAYERS, KEYCODES_QUANTUM, \
     KEYCODES_BOOT, KEYCODES_MODIFIERS, \
     KEYCODES_BACKLIGHT, KEYCODES_MEDIA, KEYCODES_SPECIAL, KEYCODES_SHIFTED, KEYCODES_USER, Keycode, \
     KEYCODES_TAP_DANCE, KEYCODES_MIDI, KEYCODES_BASIC_NUMPAD, KEYCODES_BASIC_NAV, KEYCODES_ISO_KR, BASIC_KEYCODES
-from widgets.square_button import SquareButton
 from util import tr, KeycodeDisplay
 
 
@@ -24,18 +24,9 @@ class AlternativeDisplay(QWidget):
         super().__init__()
 
         self.kb_display = None
-        self.keycodes = keycodes
-        self.buttons = []
-
-        self.key_layout = FlowLayout()
-
-        if prefix_buttons:
-            for title, code in prefix_buttons:
-                btn = SquareButton()
-                btn.setRelSize(KEYCODE_BTN_RATIO)
-                btn.setText(title)
-                btn.clicked.connect(lambda st, k=code: self.keycode_changed.emit(title))
-                self.key_layout.addWidget(btn)
+        self.model = KeycodeModel(keycodes, prefix_buttons)
+        self.view = KeycodeView(self.model, keycode_filter_any, KEYCODE_BTN_RATIO)
+        self.view.keycode_changed.connect(self.keycode_changed)
 
         layout = QVBoxLayout()
         if kbdef:
@@ -43,57 +34,49 @@ class AlternativeDisplay(QWidget):
             self.kb_display.keycode_changed.connect(self.keycode_changed)
             layout.addWidget(self.kb_display)
             layout.setAlignment(self.kb_display, Qt.AlignHCenter)
-        layout.addLayout(self.key_layout)
+        layout.addWidget(self.view)
         self.setLayout(layout)
 
     def recreate_buttons(self, keycode_filter):
-        for btn in self.buttons:
-            btn.deleteLater()
-        self.buttons = []
-
-        for keycode in self.keycodes:
-            if not keycode_filter(keycode.qmk_id):
-                continue
-            btn = SquareButton()
-            btn.setRelSize(KEYCODE_BTN_RATIO)
-            btn.setToolTip(Keycode.tooltip(keycode.qmk_id))
-            btn.clicked.connect(lambda st, k=keycode: self.keycode_changed.emit(k.qmk_id))
-            btn.keycode = keycode
-            self.key_layout.addWidget(btn)
-            self.buttons.append(btn)
-
+        # keycode lists may have been refilled for a different keyboard
+        self.model.reload()
+        self.view.set_keycode_filter(keycode_filter)
         self.relabel_buttons()
 
     def relabel_buttons(self):
         if self.kb_display:
             self.kb_display.relabel_buttons()
 
-        KeycodeDisplay.relabel_buttons(self.buttons)
+        self.model.relabel()
 
     def required_width(self):
         return self.kb_display.sizeHint().width() if self.kb_display else 0
 
     def has_buttons(self):
-        return len(self.buttons) > 0
+        return self.view.keycode_count() > 0
 
 
 class Tab(QScrollArea):
 
     keycode_changed = pyqtSignal(str)
 
+    # how many alternatives are kept around once built, only one of them is displayed at a time
+    MAX_ALTERNATIVES = 2
+
     def __init__(self, parent, label, alts, prefix_buttons=None):
         super().__init__(parent)
 
         self.label = label
+        self.alts = alts
+        self.prefix_buttons = prefix_buttons
+        self.keycode_filter = keycode_filter_any
         self.layout = QVBoxLayout()
         self.layout.setContentsMargins(0, 0, 0, 0)
 
-        self.alternatives = []
-        for kb, keys in alts:
-            alt = AlternativeDisplay(kb, keys, prefix_buttons)
-            alt.keycode_changed.connect(self.keycode_changed)
-            self.layout.addWidget(alt)
-            self.alternatives.append(alt)
+        # AlternativeDisplay by index in alts, only built once selected or measured; least recently used first
+        self.alternatives = OrderedDict()
+        # required_width of every alternative by (index, font height), kept when the alternative is dropped
+        self.required_widths = dict()
 
         self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
         self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
@@ -103,32 +86,65 @@ class Tab(QScrollArea):
         w.setLayout(self.layout)
         self.setWidget(w)
 
+    def alternative(self, idx):
+        alt = self.alternatives.get(idx)
+        if alt is not None:
+            self.alternatives.move_to_end(idx)
+            return alt
+
+        kb, keys = self.alts[idx]
+        alt = AlternativeDisplay(kb, keys, self.prefix_buttons)
+        alt.keycode_changed.connect(self.keycode_changed)
+        alt.recreate_buttons(self.keycode_filter)
+        alt.hide()
+        self.layout.addWidget(alt)
+        self.alternatives[idx] = alt
+
+        while len(self.alternatives) > self.MAX_ALTERNATIVES:
+            idx, old = self.alternatives.popitem(last=False)
+            self.layout.removeWidget(old)
+            old.deleteLater()
+        return alt
+
+    def required_width(self, idx):
+        kb, keys = self.alts[idx]
+        if not kb:
+            return 0
+        key = (idx, self.fontMetrics().height())
+        if key not in self.required_widths:
+            self.required_widths[key] = self.alternative(idx).required_width()
+        return self.required_widths[key]
+
     def recreate_buttons(self, keycode_filter):
-        for alt in self.alternatives:
+        self.keycode_filter = keycode_filter
+        for alt in self.alternatives.values():
             alt.recreate_buttons(keycode_filter)
         self.setVisible(self.has_buttons())
 
     def relabel_buttons(self):
-        for alt in self.alternatives:
+        for alt in self.alternatives.values():
             alt.relabel_buttons()
 
     def has_buttons(self):
-        for alt in self.alternatives:
-            if alt.has_buttons():
-                return True
+        for kb, keys in self.alts:
+            for keycode in keys:
+                if self.keycode_filter(keycode.qmk_id):
+                    return True
         return False
 
     def select_alternative(self):
-        # hide everything first
-        for alt in self.alternatives:
-            alt.hide()
-
-        # then display first alternative which fits on screen w/o horizontal scroll
-        for alt in self.alternatives:
-            if self.width() - self.verticalScrollBar().width() > alt.required_width():
-                alt.show()
+        # display first alternative which fits on screen w/o horizontal scroll
+        selected = None
+        for idx in range(len(self.alts)):
+            if self.width() - self.verticalScrollBar().width() > self.required_width(idx):
+                selected = idx
                 break
 
+        if selected is not None:
+            self.alternative(selected)
+        for idx, alt in self.alternatives.items():
+            alt.setVisible(idx == selected)
+
     def resizeEvent(self, evt):
         super().resizeEvent(evt)
         self.select_alternative()
@@ -0,0 +1,109 @@
+import asyncio
+import socket
+import unittest
+
+from keycodes.keycodes import RESET_KEYCODE
+from protocol.async_keyboard import AsyncHidTransport, AsyncKeyboard
+from test.test_keyboard import SimulatedDevice, LAYOUT_2x2, s
+from util import MSG_LEN
+
+
+class SocketDevice:
+    """ Answers requests arriving on one end of a socketpair the way SimulatedDevice expects them """
+
+    def __init__(self, loop, sim):
+        self.sim = sim
+        self.host, self.device = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.device.setblocking(False)
+        loop.add_reader(self.device.fileno(), self.on_request)
+        self.loop = loop
+
+    def on_request(self):
+        data = self.device.recv(MSG_LEN + 1)
+        # strip report id and padding
+        inp = self.sim.expect_data[self.sim.expect_idx][0] if self.sim.expect_idx < len(self.sim.expect_data) else b""
+        self.assertPadded(data[1:], inp)
+        self.device.send(self.sim.sim_send(self.sim, inp))
+
+    @staticmethod
+    def assertPadded(data, inp):
+        if data != inp + b"\x00" * (MSG_LEN - len(inp)):
+            raise Exception("unexpected request {}, expected {}".format(data.hex(), inp.hex()))
+
+    def close(self):
+        self.loop.remove_reader(self.device.fileno())
+        self.device.close()
+        self.host.close()
+
+
+def prepare_device(keymap):
+    sim = SimulatedDevice()
+    sim.expect_via_protocol(9)
+    sim.expect_keyboard_id(0)
+    sim.expect_layout(LAYOUT_2x2)
+    sim.expect_layers(len(keymap))
+    sim.expect("0C", "0C00")
+    sim.expect("0D", "0D0000")
+    sim.expect_keymap(keymap)
+    return sim
+
+
+def run(coro):
+    # asyncio.run() needs python 3.7
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class TestAsyncKeyboard(unittest.TestCase):
+
+    def test_many_keyboards(self):
+        """ Tests that several keyboards are driven concurrently from a single event loop """
+
+        sims = [prepare_device([[[x, 2], [3, 4]]]) for x in range(1, 5)]
+        devices = []
+        # created before the loop runs, they attach to it on their first command
+        keyboards = []
+
+        async def main():
+            loop = asyncio.get_event_loop()
+            devices.extend(SocketDevice(loop, sim) for sim in sims)
+            keyboards.extend(AsyncKeyboard(AsyncHidTransport(dev.host.fileno())) for dev in devices)
+            await asyncio.gather(*[kb.reload() for kb in keyboards])
+            # all keyboards share a single thread pool
+            self.assertEqual(len({kb.executor for kb in keyboards}), 1)
+            for x, kb in enumerate(keyboards):
+                self.assertIs(kb.transport.loop, loop)
+                self.assertEqual(kb.layers, 1)
+                self.assertEqual(kb.layout[(0, 0, 0)], s(x + 1))
+                sims[x].expect("05000100000A", "05000100000A")
+            await asyncio.gather(*[kb.set_key(0, 1, 0, s(10)) for kb in keyboards])
+            for sim, dev, kb in zip(sims, devices, keyboards):
+                sim.finish()
+                self.assertEqual(kb.layout[(0, 1, 0)], s(10))
+                loop.remove_reader(kb.transport.fd)
+                dev.close()
+
+        run(main())
+
+    def test_locked(self):
+        """ Tests that a command which needs the unlock dialog fails instead of showing it """
+
+        sim = prepare_device([[[1, 2], [3, 4]]])
+
+        async def main():
+            loop = asyncio.get_event_loop()
+            dev = SocketDevice(loop, sim)
+            kb = AsyncKeyboard(AsyncHidTransport(dev.host.fileno()))
+            await kb.reload()
+            sim.expect("FE05", "00")
+            with self.assertRaises(RuntimeError):
+                await kb.set_key(0, 0, 1, RESET_KEYCODE)
+            sim.finish()
+            self.assertEqual(kb.layout[(0, 0, 1)], s(2))
+            loop.remove_reader(kb.transport.fd)
+            dev.close()
+
+        run(main())
@@ -0,0 +1,265 @@
+import struct
+import threading
+import time
+import unittest
+
+from protocol.io_worker import IoWorker, PRIORITY_INTERACTIVE, PRIORITY_POLL, PRIORITY_BULK
+from util import MSG_LEN, RetryPolicy, hid_send, hid_send_many, response_matches
+
+
+class QueuedDevice:
+    """ Behaves like a hidapi device: requests are answered asynchronously through an input report queue """
+
+    def __init__(self, queue_depth=None):
+        self.memory = bytes(range(256)) * 4
+        # how many requests can be queued on the device side before it starts dropping them
+        self.queue_depth = queue_depth
+        self.inbox = []
+        self.outbox = []
+        self.max_in_flight = 0
+        self.writes = 0
+
+    def respond(self, msg):
+        if msg[0] == 0x12:
+            offset, sz = struct.unpack(">HB", msg[1:4])
+            return msg[:4] + self.memory[offset:offset + sz]
+        # vial-style command which doesn't echo anything back
+        block = struct.unpack("<I", msg[2:6])[0]
+        return self.memory[block * MSG_LEN:(block + 1) * MSG_LEN]
+
+    def write(self, data):
+        self.writes += 1
+        msg = bytes(data[1:])
+        if self.queue_depth is None or len(self.inbox) < self.queue_depth:
+            self.inbox.append(msg)
+        self.max_in_flight = max(self.max_in_flight, len(self.inbox) + len(self.outbox))
+        return len(data)
+
+    def read(self, length, timeout_ms=0):
+        # the firmware processes its queue while we're waiting for a report
+        while self.inbox:
+            out = self.respond(self.inbox.pop(0))
+            self.outbox.append(out + b"\x00" * (MSG_LEN - len(out)))
+        if self.outbox:
+            return self.outbox.pop(0)
+        return b""
+
+
+class FlakyDevice(QueuedDevice):
+    """ Loses the first `failures` responses """
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+        self.timeouts = []
+
+    def read(self, length, timeout_ms=0):
+        if timeout_ms == 0:
+            # non-blocking drain of the queue
+            return b""
+        self.timeouts.append(timeout_ms)
+        if self.failures > 0:
+            self.failures -= 1
+            self.inbox.clear()
+            return b""
+        return super().read(length, timeout_ms)
+
+
+def keymap_request(offset, sz=28):
+    return struct.pack(">BHB", 0x12, offset, sz)
+
+
+def definition_request(block):
+    return struct.pack("<BBI", 0xFE, 0x02, block)
+
+
+class TestHidPipeline(unittest.TestCase):
+
+    def test_window(self):
+        """ Tests that pipelined requests get their own responses while respecting the window """
+
+        dev = QueuedDevice()
+        requests = [keymap_request(x * 28) for x in range(20)]
+        responses = hid_send_many(dev, requests, window=4)
+        self.assertEqual(dev.writes, 20)
+        self.assertLessEqual(dev.max_in_flight, 4)
+        for x, data in enumerate(responses):
+            self.assertEqual(data[4:32], dev.memory[x * 28:x * 28 + 28])
+
+    def test_ordered(self):
+        """ Tests that responses without an echoed header are matched in order """
+
+        dev = QueuedDevice()
+        responses = hid_send_many(dev, [definition_request(x) for x in range(10)], window=3)
+        self.assertEqual(b"".join(responses), dev.memory[:10 * MSG_LEN])
+
+    def test_stall_fallback(self):
+        """ Tests that firmware dropping queued reports falls back to lock-step mode """
+
+        dev = QueuedDevice(queue_depth=1)
+        stalls = []
+        requests = [keymap_request(x * 28) for x in range(6)] + [definition_request(x) for x in range(6)]
+        responses = hid_send_many(dev, requests, window=4, on_stall=lambda: stalls.append(True))
+        self.assertEqual(stalls, [True])
+        for x in range(6):
+            self.assertEqual(responses[x][4:32], dev.memory[x * 28:x * 28 + 28])
+        self.assertEqual(b"".join(responses[6:]), dev.memory[:6 * MSG_LEN])
+
+
+class TestCorrelation(unittest.TestCase):
+
+    def test_drain_stale(self):
+        """ Tests that a late response to an earlier request is not mistaken for the current one """
+
+        dev = QueuedDevice()
+        dev.outbox.append(dev.respond(definition_request(5)))
+        data = hid_send(dev, definition_request(1))
+        self.assertEqual(data, dev.memory[MSG_LEN:2 * MSG_LEN])
+
+    def test_discard_mismatch(self):
+        """ Tests that a buffer response for a different offset or size is discarded """
+
+        dev = QueuedDevice()
+        real_respond = dev.respond
+        stale = [real_respond(keymap_request(56)), real_respond(keymap_request(0, 14))]
+
+        def respond(msg):
+            # stale replies show up after our request was already sent
+            dev.outbox.extend(stale)
+            stale.clear()
+            return real_respond(msg)
+
+        dev.respond = respond
+        data = hid_send(dev, keymap_request(0))
+        self.assertEqual(data[:4], keymap_request(0))
+        self.assertEqual(data[4:32], dev.memory[:28])
+
+    def test_response_matches(self):
+        self.assertTrue(response_matches(keymap_request(28), keymap_request(28) + b"\x01"))
+        self.assertFalse(response_matches(keymap_request(28), keymap_request(0) + b"\x01"))
+        self.assertFalse(response_matches(b"\x11", b"\x12\x00"))
+        self.assertTrue(response_matches(b"\x11", b"\xFF"))
+        self.assertTrue(response_matches(definition_request(3), b"\x12\x34"))
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_retries_counted(self):
+        """ Tests that retries are reported per command and timeouts grow with each retry """
+
+        policy = RetryPolicy()
+        policy.observe(0.001)
+        dev = FlakyDevice(failures=2)
+        data = hid_send(dev, keymap_request(0), retries=5, policy=policy)
+        self.assertEqual(data[4:32], dev.memory[:28])
+        self.assertEqual(policy.last_retries, 2)
+        self.assertEqual(policy.retry_counts[0x12], 2)
+        self.assertEqual(dev.timeouts, sorted(dev.timeouts))
+        self.assertLess(dev.timeouts[0], dev.timeouts[-1])
+
+    def test_learns_latency(self):
+        """ Tests that the read timeout follows observed round-trip time within bounds """
+
+        policy = RetryPolicy()
+        self.assertEqual(policy.timeout_ms(), RetryPolicy.MAX_TIMEOUT_MS)
+        for x in range(10):
+            policy.observe(0.002)
+        self.assertEqual(policy.timeout_ms(), RetryPolicy.MIN_TIMEOUT_MS)
+        self.assertLessEqual(policy.backoff(100), RetryPolicy.BACKOFF_MAX)
+
+    def test_deadline(self):
+        """ Tests that an operation gives up once its deadline passes, regardless of retries left """
+
+        policy = RetryPolicy()
+        dev = FlakyDevice(failures=10 ** 6)
+        with self.assertRaises(RuntimeError):
+            with policy.operation("test", 0.05):
+                hid_send(dev, keymap_request(0), retries=10 ** 6, policy=policy)
+        self.assertLess(len(dev.timeouts), 100)
+
+
+    def test_last_attempt(self):
+        """ Tests that the last attempt waits the full timeout, also for commands sent without retries """
+
+        policy = RetryPolicy()
+        for x in range(10):
+            policy.observe(0.001)
+        self.assertEqual(policy.timeout_ms(final=True), RetryPolicy.MAX_TIMEOUT_MS)
+        dev = FlakyDevice(failures=0)
+        hid_send(dev, keymap_request(0), policy=policy)
+        self.assertGreater(dev.timeouts[0], RetryPolicy.MAX_TIMEOUT_MS - 10)
+
+    def test_overlapping_operations(self):
+        """ Tests that operations from different threads may end in any order and keep their own deadlines """
+
+        policy = RetryPolicy()
+        outer = policy.operation("outer", 0)
+        inner = policy.operation("inner", 60)
+        outer.__enter__()
+        inner.__enter__()
+        with self.assertRaises(RuntimeError):
+            policy.check_deadline()
+        outer.__exit__(None, None, None)
+        policy.check_deadline()
+        self.assertGreater(policy.remaining(), 50)
+        with policy.suspended():
+            self.assertEqual(policy.remaining(), float("inf"))
+        inner.__exit__(None, None, None)
+        self.assertEqual(policy.operations, [])
+
+
+class TestIoWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = IoWorker()
+        self.worker.start()
+
+    def tearDown(self):
+        self.worker.stop()
+
+    def test_priority(self):
+        """ Tests that interactive jobs overtake polling and bulk jobs waiting in the queue """
+
+        gate = threading.Event()
+        order = []
+        self.worker.submit(PRIORITY_BULK, gate.wait)
+        futures = [
+            self.worker.submit(PRIORITY_BULK, order.append, "bulk"),
+            self.worker.submit(PRIORITY_POLL, order.append, "poll"),
+            self.worker.submit(PRIORITY_INTERACTIVE, order.append, "interactive"),
+        ]
+        gate.set()
+        for future in futures:
+            future.result()
+        self.assertEqual(order, ["interactive", "poll", "bulk"])
+
+    def test_stop(self):
+        """ Tests that stopping cancels queued jobs and that nothing can be queued afterwards """
+
+        gate = threading.Event()
+        running = self.worker.submit(PRIORITY_BULK, gate.wait)
+        queued = self.worker.submit(PRIORITY_BULK, threading.get_ident)
+        threading.Timer(0.05, gate.set).start()
+        while not running.running():
+            time.sleep(0.001)
+        self.worker.stop()
+        self.assertTrue(running.result())
+        self.assertTrue(queued.cancelled())
+
+        with self.assertRaises(RuntimeError):
+            self.worker.wrap(threading.get_ident)()
+
+    def test_wrap(self):
+        """ Tests that wrapped calls run on the worker thread and hand back results and errors """
+
+        def send(dev, msg, retries=1):
+            if msg is None:
+                raise RuntimeError("failed to communicate with the device")
+            return threading.get_ident(), msg
+
+        send = self.worker.wrap(send)
+        ident, msg = send(None, b"\x01", retries=20)
+        self.assertEqual(msg, b"\x01")
+        self.assertNotEqual(ident, threading.get_ident())
+        with self.assertRaises(RuntimeError):
+            send(None, None)
@@ -1,15 +1,27 @@
+import json
 import unittest
 import lzma
 import struct
-
-from keycodes.keycodes import Keycode
+import tempfile
+from concurrent.futures import Future
+from unittest import mock
+
+from compiled_layout import CompiledLayout, LayoutCache
+from keycodes.keycodes import Keycode, RESET_KEYCODE
+from kle_serial import Serial as KleSerial
+from protocol.definition_cache import DefinitionCache
 from protocol.keyboard_comm import Keyboard
+from protocol.keymap_store import KeymapStore
 from util import chunks, MSG_LEN
 
 LAYOUT_2x2 = """
 {"name":"test","vendorId":"0x0000","productId":"0x1111","lighting":"none","matrix":{"rows":2,"cols":2},"layouts":{"keymap":[["0,0","0,1"],["1,0","1,1"]]}}
 """
 
+LAYOUT_1x4_GAP = """
+{"name":"test","vendorId":"0x0000","productId":"0x1111","lighting":"none","matrix":{"rows":1,"cols":4},"layouts":{"keymap":[["0,0","0,1","0,3"]]}}
+"""
+
 LAYOUT_ENCODER = r"""
 {"name":"test","vendorId":"0x0000","productId":"0x1111","lighting":"none","matrix":{"rows":1,"cols":1},"layouts":{"keymap":[["0,0\n\n\n\n\n\n\n\n\ne","0,1\n\n\n\n\n\n\n\n\ne"],["0,0"]]}}
 """
@@ -50,6 +62,15 @@ class SimulatedDevice:
                 chunk
             )
 
+    def expect_layout_blocks(self, layout, blocks):
+        """ Expects that only the given blocks of the layout are retrieved, in the given order """
+        compressed = lzma.compress(layout.encode("utf-8"))
+        self.expect("FE01", struct.pack("<I", len(compressed)))
+        all_chunks = list(chunks(compressed, 32))
+        for idx in blocks:
+            self.expect(struct.pack("<BBI", 0xFE, 0x02, idx), all_chunks[idx])
+        return len(all_chunks)
+
     def expect_layers(self, layers):
         self.expect("11", struct.pack("BB", 0x11, layers))
 
@@ -61,9 +82,20 @@ class SimulatedDevice:
                     buffer += struct.pack(">H", col)
         # client will retrieve our keymap buffer in chunks of 28 bytes
         for x, chunk in enumerate(chunks(buffer, 28)):
-            query = struct.pack(">BHB", 0x12, x, len(chunk))
+            query = struct.pack(">BHB", 0x12, x * 28, len(chunk))
             self.expect(query, query + chunk)
 
+    def expect_keymap_ranges(self, keymap, ranges):
+        """ Expects that only the given (start, end) keycode ranges of the keymap buffer are retrieved """
+        buffer = b""
+        for layer in keymap:
+            for row in layer:
+                for col in row:
+                    buffer += struct.pack(">H", col)
+        for start, end in ranges:
+            query = struct.pack(">BHB", 0x12, start * 2, (end - start) * 2)
+            self.expect(query, query + buffer[start * 2:end * 2])
+
     def expect_encoders(self, encoders):
         for l, layer in enumerate(encoders):
             for e, enc in enumerate(layer):
@@ -98,22 +130,25 @@ class SimulatedDevice:
 class TestKeyboard(unittest.TestCase):
 
     @staticmethod
-    def prepare_keyboard(layout, keymap, encoders=None):
+    def prepare_keyboard(layout, keymap, encoders=None, ranges=None, progressive=False):
         dev = SimulatedDevice()
         dev.expect_via_protocol(9)
         dev.expect_keyboard_id(0)
         dev.expect_layout(layout)
         dev.expect_layers(len(keymap))
-        dev.expect_keymap(keymap)
-        if encoders is not None:
-            dev.expect_encoders(encoders)
         # macro count
         dev.expect("0C", "0C00")
         # macro buffer size
         dev.expect("0D", "0D0000")
+        if ranges is None:
+            dev.expect_keymap(keymap)
+        else:
+            dev.expect_keymap_ranges(keymap, ranges)
+        if encoders is not None:
+            dev.expect_encoders(encoders[:1] if progressive else encoders)
 
         kb = Keyboard(dev, dev.sim_send)
-        kb.reload()
+        kb.reload(progressive=progressive)
 
         return kb, dev
 
@@ -132,13 +167,106 @@ class TestKeyboard(unittest.TestCase):
         self.assertEqual(kb.layout[(1, 1, 1)], s(8))
         dev.finish()
 
+    def test_sparse_keymap_fetch(self):
+        """ Tests that matrix positions no key refers to aren't retrieved """
+
+        # 8x8 matrix with only the first 4 rows wired up
+        layout = json.dumps({"name": "test", "vendorId": "0x0000", "productId": "0x1111", "lighting": "none",
+                             "matrix": {"rows": 8, "cols": 8},
+                             "layouts": {"keymap": [["{},{}".format(r, c) for c in range(8)] for r in range(4)]}})
+        keymap = [[[(l << 8) | (r << 4) | c for c in range(8)] for r in range(8)] for l in range(4)]
+        # 3 packets per layer instead of 19 for the entire 512 byte buffer
+        ranges = [(start + l * 64, end + l * 64) for l in range(4) for start, end in [(0, 14), (14, 28), (28, 32)]]
+
+        kb, dev = self.prepare_keyboard(layout, keymap, ranges=ranges)
+        self.assertEqual(kb.layout.ranges(14), ranges)
+        self.assertEqual(len(kb.layout), 4 * 32)
+        for l in range(4):
+            for r in range(4):
+                for c in range(8):
+                    self.assertEqual(kb.layout.code((l, r, c)), keymap[l][r][c])
+        self.assertNotIn((0, 4, 0), kb.layout)
+        dev.finish()
+
+    def test_submit_reload(self):
+        """ Tests that a background reload hands back the loaded keyboard, or what went wrong while loading it """
+
+        dev = SimulatedDevice()
+        dev.expect_via_protocol(9)
+        dev.expect_keyboard_id(0)
+        dev.expect_layout(LAYOUT_2x2)
+        dev.expect_layers(1)
+        dev.expect("0C", "0C00")
+        dev.expect("0D", "0D0000")
+        dev.expect_keymap([[[1, 2], [3, 4]]])
+
+        kb = Keyboard(dev, dev.sim_send)
+        finished = []
+        kb.submit_reload(finished.append)
+        self.assertIsNone(finished[0].result())
+        self.assertEqual(kb.layout[(0, 1, 1)], s(4))
+        dev.finish()
+
+        # the device stops answering half way through
+        dev = SimulatedDevice()
+        dev.expect_via_protocol(9)
+        kb = Keyboard(dev, dev.sim_send)
+        finished = []
+        kb.submit_reload(finished.append)
+        self.assertEqual(len(finished), 1)
+        self.assertIsNotNone(finished[0].exception())
+
+    def test_progressive_reload(self):
+        """ Tests that a progressive reload only retrieves the first layer, and the others once they're needed """
+
+        keymap = [[[1, 2], [3, 4]], [[5, 6], [7, 8]], [[9, 10], [11, 12]]]
+        kb, dev = self.prepare_keyboard(LAYOUT_2x2, keymap, ranges=[(0, 4)], progressive=True)
+        self.assertEqual(kb.loaded_layers, {0})
+        self.assertEqual(kb.layout[(0, 1, 1)], s(4))
+
+        # editing a layer which isn't there yet retrieves it first
+        dev.expect_keymap_ranges(keymap, [(8, 12)])
+        dev.expect("050201000010", "")
+        kb.set_key(2, 1, 0, 0x10)
+        self.assertEqual(kb.loaded_layers, {0, 2})
+        self.assertEqual(kb.layout[(2, 1, 1)], s(12))
+
+        # the rest in the background; without an I/O worker that happens right away
+        loaded = []
+        dev.expect_keymap_ranges(keymap, [(4, 8)])
+        kb.prefetch_layers(loaded.append)
+        self.assertEqual(loaded, [1])
+        self.assertEqual(kb.layout[(1, 0, 0)], s(5))
+
+        # everything is loaded now, saving doesn't need to talk to the keyboard
+        data = json.loads(kb.save_layout().decode("utf-8"))
+        keymap[2][1][0] = 0x10
+        self.assertEqual(data["layout"], [[[s(code) for code in row] for row in layer] for layer in keymap])
+        dev.finish()
+
+    def test_progressive_save(self):
+        """ Tests that saving a progressively loaded keymap retrieves the missing layers """
+
+        keymap = [[[1, 2], [3, 4]], [[5, 6], [7, 8]], [[9, 10], [11, 12]]]
+        kb, dev = self.prepare_keyboard(LAYOUT_2x2, keymap, ranges=[(0, 4)], progressive=True)
+
+        # reading a layer which isn't there yet retrieves it first
+        dev.expect_keymap_ranges(keymap, [(4, 8)])
+        self.assertEqual(kb.layout[(1, 0, 1)], s(6))
+        self.assertEqual(kb.loaded_layers, {0, 1})
+
+        dev.expect_keymap_ranges(keymap, [(8, 12)])
+        data = json.loads(kb.save_layout().decode("utf-8"))
+        self.assertEqual(data["layout"], [[[s(code) for code in row] for row in layer] for layer in keymap])
+        dev.finish()
+
     def test_set_key(self):
         """ Tests that setting a key works """
 
         kb, dev = self.prepare_keyboard(LAYOUT_2x2, [[[1, 2], [3, 4]], [[5, 6], [7, 8]]])
         dev.expect("050101000009", "")
         kb.set_key(1, 1, 0, 9)
-        self.assertEqual(kb.layout[(1, 1, 0)], 9)
+        self.assertEqual(kb.layout[(1, 1, 0)], s(9))
 
         dev.finish()
 
@@ -149,7 +277,7 @@ class TestKeyboard(unittest.TestCase):
         dev.expect("050101000009", "")
         kb.set_key(1, 1, 0, 9)
         kb.set_key(1, 1, 0, 9)
-        self.assertEqual(kb.layout[(1, 1, 0)], 9)
+        self.assertEqual(kb.layout[(1, 1, 0)], s(9))
 
         dev.finish()
 
@@ -159,36 +287,279 @@ class TestKeyboard(unittest.TestCase):
         kb, dev = self.prepare_keyboard(LAYOUT_2x2, [[[1, 2], [3, 4]], [[5, 6], [7, 8]]])
         dev.expect("05010100000A", "")
         kb.set_key(1, 1, 0, 10)
-        self.assertEqual(kb.layout[(1, 1, 0)], 10)
+        self.assertEqual(kb.layout[(1, 1, 0)], s(10))
         data = kb.save_layout()
         dev.finish()
 
         kb, dev = self.prepare_keyboard(LAYOUT_2x2, [[[1, 2], [3, 4]], [[5, 6], [7, 8]]])
         dev.expect("05010100000A", "")
         kb.restore_layout(data)
-        self.assertEqual(kb.layout[(1, 1, 0)], 10)
+        self.assertEqual(kb.layout[(1, 1, 0)], s(10))
+        dev.finish()
+
+    def test_layout_restore_bulk(self):
+        """ Tests that restoring many keys writes them through the keymap buffer """
+
+        kb, dev = self.prepare_keyboard(LAYOUT_2x2, [[[1, 2], [3, 4]], [[5, 6], [7, 8]]])
+        data = json.loads(kb.save_layout().decode("utf-8"))
+        data["layout"] = [[[1, 2], [13, 14]], [[15, 16], [17, 8]]]
+        dev.expect(struct.pack(">BHB5H", 0x13, 4, 10, 13, 14, 15, 16, 17), "")
+        kb.restore_layout(json.dumps(data).encode("utf-8"))
+        self.assertEqual(kb.layout[(0, 1, 0)], s(13))
+        self.assertEqual(kb.layout[(1, 1, 0)], s(17))
+        dev.finish()
+
+    def test_restore_in_background(self):
+        """ Tests that a background restore only changes the loaded keymap once it has been handed back """
+
+        kb, dev = self.prepare_keyboard(LAYOUT_2x2, [[[1, 2], [3, 4]], [[5, 6], [7, 8]]])
+        data = json.loads(kb.save_layout().decode("utf-8"))
+        data["layout"][1][1][0] = s(10)
+        jobs = []
+        kb.submit = lambda priority, fn, *args, callback=None: jobs.append((fn, callback))
+        finished = []
+        kb.submit_restore_layout(json.dumps(data).encode("utf-8"), finished.append)
+
+        job, callback = jobs[0]
+        dev.expect("05010100000A", "")
+        job()
+        dev.finish()
+        self.assertEqual(kb.layout[(1, 1, 0)], s(7))
+        self.assertIsNone(kb.deferred_updates)
+
+        future = Future()
+        future.set_result(None)
+        callback(future)
+        self.assertEqual(kb.layout[(1, 1, 0)], s(10))
+        self.assertEqual(finished, [future])
+
+    def test_restore_needs_unlock(self):
+        """ Tests that only restoring a RESET keycode which isn't on the keyboard yet asks for an unlock """
+
+        reset = Keycode.deserialize(RESET_KEYCODE)
+        kb, dev = self.prepare_keyboard(LAYOUT_2x2, [[[1, 2], [3, 4]], [[5, 6], [7, reset]]])
+        data = json.loads(kb.save_layout().decode("utf-8"))
+        self.assertFalse(kb.restore_needs_unlock(data))
+
+        data["layout"][0][0][1] = RESET_KEYCODE
+        self.assertTrue(kb.restore_needs_unlock(data))
+
+        # keys of layers that weren't retrieved yet count as changed
+        data["layout"][0][0][1] = s(2)
+        kb.loaded_layers.discard(1)
+        self.assertTrue(kb.restore_needs_unlock(data))
+        dev.finish()
+
+    def test_set_keymap_spans(self):
+        """ Tests that keymap buffer writes skip positions that aren't on the keyboard """
+
+        kb, dev = self.prepare_keyboard(LAYOUT_1x4_GAP, [[[1, 2, 3, 4]], [[5, 6, 7, 8]]])
+        target = kb.layout.snapshot()
+        for key in target.keys():
+            target.set_code(key, target.code(key) + 0x10)
+        self.assertEqual(kb.layout.spans(target, 14), [(0, 2), (3, 6), (7, 8)])
+        self.assertEqual(kb.layout.spans(target, 2), [(0, 2), (3, 5), (5, 6), (7, 8)])
+
+        dev.expect(struct.pack(">BHB2H", 0x13, 0, 4, 0x11, 0x12), "")
+        dev.expect(struct.pack(">BHB3H", 0x13, 6, 6, 0x14, 0x15, 0x16), "")
+        dev.expect(struct.pack(">BHBH", 0x13, 14, 2, 0x18), "")
+        kb.set_keymap(target)
+        self.assertEqual(kb.layout.diff(target), [])
+        # position (0, 0, 2) isn't on the keyboard and stays untouched
+        self.assertEqual(kb.layout.codes[2], 3)
+        dev.finish()
+
+        # the same change one key at a time
+        kb, dev = self.prepare_keyboard(LAYOUT_1x4_GAP, [[[1, 2, 3, 4]], [[5, 6, 7, 8]]])
+        kb.bulk_keymap_write = False
+        for key in target.keys():
+            dev.expect(struct.pack(">BBBBH", 0x05, *key, target.code(key)), "")
+        kb.set_keymap(target)
         dev.finish()
 
     def test_encoder_simple(self):
         """ Tests that we try to retrieve encoder layout """
 
         kb, dev = self.prepare_keyboard(LAYOUT_ENCODER, [[[1]], [[2]], [[3]], [[4]]], [[(10, 11)], [(12, 13)], [(14, 15)], [(16, 17)]])
-        self.assertEqual(kb.encoder_layout[(0, 0, 0)], 10)
-        self.assertEqual(kb.encoder_layout[(0, 0, 1)], 11)
-        self.assertEqual(kb.encoder_layout[(1, 0, 0)], 12)
-        self.assertEqual(kb.encoder_layout[(1, 0, 1)], 13)
-        self.assertEqual(kb.encoder_layout[(2, 0, 0)], 14)
-        self.assertEqual(kb.encoder_layout[(2, 0, 1)], 15)
-        self.assertEqual(kb.encoder_layout[(3, 0, 0)], 16)
-        self.assertEqual(kb.encoder_layout[(3, 0, 1)], 17)
+        self.assertEqual(kb.encoder_layout[(0, 0, 0)], s(10))
+        self.assertEqual(kb.encoder_layout[(0, 0, 1)], s(11))
+        self.assertEqual(kb.encoder_layout[(1, 0, 0)], s(12))
+        self.assertEqual(kb.encoder_layout[(1, 0, 1)], s(13))
+        self.assertEqual(kb.encoder_layout[(2, 0, 0)], s(14))
+        self.assertEqual(kb.encoder_layout[(2, 0, 1)], s(15))
+        self.assertEqual(kb.encoder_layout[(3, 0, 0)], s(16))
+        self.assertEqual(kb.encoder_layout[(3, 0, 1)], s(17))
         dev.finish()
 
     def test_encoder_change(self):
         """ Test that changing encoder works """
 
         kb, dev = self.prepare_keyboard(LAYOUT_ENCODER, [[[1]], [[2]], [[3]], [[4]]], [[(10, 11)], [(12, 13)], [(14, 15)], [(16, 17)]])
-        self.assertEqual(kb.encoder_layout[(1, 0, 0)], 12)
-        self.assertEqual(kb.encoder_layout[(1, 0, 1)], 13)
+        self.assertEqual(kb.encoder_layout[(1, 0, 0)], s(12))
+        self.assertEqual(kb.encoder_layout[(1, 0, 1)], s(13))
         dev.expect("FE040100010020", "")
         kb.set_encoder(1, 0, 1, 0x20)
-        self.assertEqual(kb.encoder_layout[(1, 0, 1)], 0x20)
+        self.assertEqual(kb.encoder_layout[(1, 0, 1)], s(0x20))
+
+    def test_encoder_progressive(self):
+        """ Tests that a progressive reload retrieves encoders of the other layers only once they're needed """
+
+        keymap = [[[1]], [[2]], [[3]], [[4]]]
+        encoders = [[(10, 11)], [(12, 13)], [(14, 15)], [(16, 17)]]
+        kb, dev = self.prepare_keyboard(LAYOUT_ENCODER, keymap, encoders, ranges=[(0, 1)], progressive=True)
+        self.assertEqual(kb.loaded_encoders, {0})
+        self.assertEqual(kb.encoder_layout[(0, 0, 1)], s(11))
+
+        dev.expect(struct.pack("BBBB", 0xFE, 3, 2, 0), struct.pack(">HH", 14, 15))
+        dev.expect("FE040200010020", "")
+        kb.set_encoder(2, 0, 1, 0x20)
+        # the keymap of that layer isn't needed for this
+        self.assertEqual(kb.loaded_layers, {0})
+        self.assertEqual(kb.loaded_encoders, {0, 2})
+
+        # saving retrieves whatever is still missing
+        dev.expect_keymap_ranges(keymap, [(1, 2), (2, 3), (3, 4)])
+        dev.expect(struct.pack("BBBB", 0xFE, 3, 1, 0), struct.pack(">HH", 12, 13))
+        dev.expect(struct.pack("BBBB", 0xFE, 3, 3, 0), struct.pack(">HH", 16, 17))
+        data = json.loads(kb.save_layout().decode("utf-8"))
+        self.assertEqual(data["encoder_layout"], [[[s(10), s(11)]], [[s(12), s(13)]], [[s(14), s(0x20)]],
+                                                  [[s(16), s(17)]]])
+        dev.finish()
+
+    def test_dynamic_entries_lazy(self):
+        """ Tests that tap dance, combo and key override entries are only retrieved once they're needed """
+
+        dev = SimulatedDevice()
+        dev.expect_via_protocol(9)
+        dev.expect("FE00", struct.pack("<IQ", 4, 0))
+        dev.expect_layout(LAYOUT_2x2)
+        dev.expect_layers(1)
+        dev.expect("0C", "0C00")
+        dev.expect("0D", "0D0000")
+        # no QMK settings
+        dev.expect("FE090000", "FF" * 32)
+        # 2 tap dances, 1 combo, no key overrides
+        dev.expect("FE0D00", "020100")
+        dev.expect_keymap([[[1, 2], [3, 4]]])
+        kb = Keyboard(dev, dev.sim_send)
+        kb.reload()
+        dev.finish()
+        self.assertEqual(kb.tap_dance_count, 2)
+        self.assertIsNone(kb.tap_dance_entries)
+        self.assertIsNone(kb.combo_entries)
+
+        dev.expect("FE0D0100", "00" + struct.pack("<HHHHH", 4, 5, 6, 7, 200).hex())
+        dev.expect("FE0D0101", "00" + struct.pack("<HHHHH", 8, 9, 10, 11, 250).hex())
+        self.assertEqual(kb.tap_dance_get(1), (s(8), s(9), s(10), s(11), 250))
+        self.assertEqual(kb.tap_dance_get(0), (s(4), s(5), s(6), s(7), 200))
+        self.assertIsNone(kb.combo_entries)
+        dev.finish()
+
+        # saving retrieves what is still missing
+        dev.expect("FE0D0300", "00" + struct.pack("<HHHHH", 4, 5, 0, 0, 6).hex())
+        data = json.loads(kb.save_layout().decode("utf-8"))
+        self.assertEqual(data["combo"], [[s(4), s(5), s(0), s(0), s(6)]])
+        self.assertEqual(data["key_override"], [])
+        self.assertEqual(len(data["tap_dance"]), 2)
+        dev.finish()
+
+    def test_definition_cache(self):
+        """ Tests that a keyboard that was seen before doesn't download its definition again """
+
+        compressed = lzma.compress(LAYOUT_2x2.encode("utf-8"))
+        probe = DefinitionCache.probe_blocks(len(compressed), 32)
+        rest = [x for x in range(len(list(chunks(compressed, 32)))) if x not in probe]
+        self.assertTrue(rest)
+
+        with tempfile.TemporaryDirectory() as directory:
+            for expected_blocks in [probe + rest, probe]:
+                dev = SimulatedDevice()
+                dev.expect_via_protocol(9)
+                dev.expect_keyboard_id(0)
+                dev.expect_layout_blocks(LAYOUT_2x2, expected_blocks)
+                dev.expect_layers(1)
+                dev.expect("0C", "0C00")
+                dev.expect("0D", "0D0000")
+                dev.expect_keymap([[[1, 2], [3, 4]]])
+
+                kb = Keyboard(dev, dev.sim_send, definition_cache=DefinitionCache(directory))
+                kb.reload()
+                self.assertEqual(kb.rows, 2)
+                self.assertEqual(kb.layout[(0, 1, 1)], s(4))
+                dev.finish()
+
+    def test_definition_cache_same_size(self):
+        """ Tests that an edit which keeps the compressed size of the definition isn't served from the cache """
+
+        # compresses to 204 bytes, the last block only holds part of the xz index and the footer
+        old = LAYOUT_2x2.strip()[:-1] + ',"revision":"1.0.1"}'
+        new = LAYOUT_2x2.strip()[:-1] + ',"revision":"1.0.2"}'
+        compressed = [lzma.compress(layout.encode("utf-8")) for layout in [old, new]]
+        self.assertEqual(len(compressed[0]), len(compressed[1]))
+        # the blocks the cache used to hash, the first two and the last one, are the same for both
+        first, second = [list(chunks(data, 32)) for data in compressed]
+        self.assertEqual(first[:2] + first[-1:], second[:2] + second[-1:])
+
+        probe = DefinitionCache.probe_blocks(len(compressed[0]), 32)
+        rest = [x for x in range(len(first)) if x not in probe]
+
+        with tempfile.TemporaryDirectory() as directory:
+            for layout in [old, new]:
+                dev = SimulatedDevice()
+                dev.expect_via_protocol(9)
+                dev.expect_keyboard_id(0)
+                dev.expect_layout_blocks(layout, probe + rest)
+                dev.expect_layers(1)
+                dev.expect("0C", "0C00")
+                dev.expect("0D", "0D0000")
+                dev.expect_keymap([[[1, 2], [3, 4]]])
+
+                kb = Keyboard(dev, dev.sim_send, definition_cache=DefinitionCache(directory))
+                kb.reload()
+                self.assertEqual(kb.definition["revision"], json.loads(layout)["revision"])
+                dev.finish()
+
+    def test_layout_cache(self):
+        """ Tests that a precompiled layout is loaded from disk without running the KLE parser """
+
+        rows = json.loads(LAYOUT_ENCODER)["layouts"]["keymap"]
+        with tempfile.TemporaryDirectory() as directory:
+            compiled = LayoutCache(directory).load(rows)
+
+            with mock.patch.object(KleSerial, "deserialize", side_effect=AssertionError("parser called")):
+                loaded = LayoutCache(directory).load(rows)
+
+            for a, b in zip(compiled.keys(), loaded.keys()):
+                self.assertEqual(vars(a).keys(), vars(b).keys())
+                for field in CompiledLayout.GEOMETRY + CompiledLayout.MATRIX + ["decal", "labels"]:
+                    self.assertEqual(getattr(a, field), getattr(b, field))
+            self.assertEqual([(k.encoder_idx, k.encoder_dir) for k in loaded.keys(CompiledLayout.KIND_ENCODER)],
+                             [(0, 0), (0, 1)])
+            self.assertEqual([(k.row, k.col) for k in loaded.keys(CompiledLayout.KIND_KEY)], [(0, 0)])
+
+    def test_keymap_store(self):
+        """ Tests that the keymap store behaves like a dict of valid positions and tracks differences """
+
+        store = KeymapStore(2, 2, 3)
+        store.set_present([(0, 0), (1, 2)])
+        # nothing has been loaded yet, present positions don't read as KC_NO
+        self.assertIn((0, 0, 0), store)
+        with self.assertRaises(KeyError):
+            store.code((0, 0, 0))
+        self.assertEqual(store.get((0, 0, 0), -1), -1)
+        store.load(bytes(range(24)))
+        self.assertEqual(len(store), 4)
+        self.assertEqual(store.keys(), [(0, 0, 0), (0, 1, 2), (1, 0, 0), (1, 1, 2)])
+        self.assertEqual(store.code((0, 1, 2)), 0x0A0B)
+        self.assertEqual(store[(1, 0, 0)], s(0x0C0D))
+        self.assertNotIn((0, 0, 1), store)
+        self.assertNotIn((2, 0, 0), store)
+        self.assertEqual(store.get((0, 0, 1), -1), -1)
+        with self.assertRaises(KeyError):
+            store.code((0, 0, 1))
+
+        snapshot = store.snapshot()
+        store[(1, 1, 2)] = "KC_A"
+        self.assertEqual(store[(1, 1, 2)], "KC_A")
+        self.assertEqual(snapshot.code((1, 1, 2)), 0x1617)
+        self.assertEqual(snapshot.diff(store), [(1, 1, 2)])
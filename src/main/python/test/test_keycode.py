@@ -1,10 +1,11 @@
 import unittest
 
-from keycodes.keycodes import Keycode, recreate_keyboard_keycodes
+from keycodes.keycodes import Keycode, recreate_keyboard_keycodes, KEYCODES_LAYERS
 
 
 class FakeKeyboard:
 
+    vial_protocol = 6
     layers = 4
     macro_count = 16
     custom_keycodes = None
@@ -26,3 +27,78 @@ class TestKeycode(unittest.TestCase):
             if s != hex(x):
                 covered += 1
         print("{}/{} covered keycodes, which is {:.4f}%".format(covered, 2 ** 16, 100 * covered / 2 ** 16))
+
+    def test_expression_cache(self):
+        """ Tests that expressions are evaluated once and re-evaluated after the keycode tables change """
+
+        recreate_keyboard_keycodes(FakeKeyboard())
+        code = Keycode.deserialize("MT(MOD_LCTL, KC_A)")
+        self.assertEqual(code, Keycode.deserialize("LCTL_T(KC_A)"))
+        self.assertEqual(Keycode.expression_cache["MT(MOD_LCTL, KC_A)"], code)
+        self.assertEqual(Keycode.deserialize("LCTL(KC_B) | 0"), Keycode.deserialize("LCTL(KC_B)"))
+        self.assertEqual(Keycode.deserialize("NOT_A_KEYCODE"), 0)
+        self.assertNotIn("NOT_A_KEYCODE", Keycode.expression_cache)
+
+        class OldKeyboard(FakeKeyboard):
+            vial_protocol = 5
+
+        recreate_keyboard_keycodes(OldKeyboard())
+        self.assertNotIn("MT(MOD_LCTL, KC_A)", Keycode.expression_cache)
+        self.assertNotEqual(Keycode.deserialize("MT(MOD_LCTL, KC_A)"), code)
+        recreate_keyboard_keycodes(FakeKeyboard())
+
+    def test_many_layers(self):
+        """ Tests that boards with more layers than layer-tap can address still get their layer keycodes """
+
+        class BigKeyboard(FakeKeyboard):
+            layers = 32
+
+        recreate_keyboard_keycodes(BigKeyboard())
+        self.assertEqual(Keycode.serialize(Keycode.deserialize("MO(31)")), "MO(31)")
+        self.assertEqual(Keycode.serialize(Keycode.deserialize("LT15(KC_A)")), "LT15(KC_A)")
+        self.assertNotIn("LT16(kc)", [kc.qmk_id for kc in KEYCODES_LAYERS])
+        recreate_keyboard_keycodes(FakeKeyboard())
+
+    def test_tables(self):
+        """ Tests that the precomputed tables agree with computing every keycode from scratch """
+
+        class OldKeyboard(FakeKeyboard):
+            vial_protocol = 5
+
+        for kb in [OldKeyboard(), FakeKeyboard()]:
+            recreate_keyboard_keycodes(kb)
+            for x in range(2 ** 16):
+                self.assertEqual(Keycode.serialize(x), Keycode.serialize_uncached(x))
+            self.assertEqual(Keycode.deserialize("0x7fff"), 0x7FFF)
+            self.assertEqual(Keycode.deserialize("0x10 | 0x20"), 0x30)
+
+    def test_display_labels(self):
+        """ Tests that memoized labels follow the keymap override and changes to the keycode tables """
+
+        from keymaps import KEYMAPS
+        from util import KeycodeDisplay
+
+        recreate_keyboard_keycodes(FakeKeyboard())
+        danish = dict(KEYMAPS)["Danish (QWERTY)"]
+        try:
+            KeycodeDisplay.set_keymap_override(KEYMAPS[0][1])
+            self.assertEqual(KeycodeDisplay.get_label("KC_2"), "@\n2")
+            self.assertFalse(KeycodeDisplay.code_is_overriden("KC_2"))
+            self.assertEqual(KeycodeDisplay.button_label(Keycode.find("KC_2")), ("@\n2", False))
+
+            KeycodeDisplay.set_keymap_override(danish)
+            self.assertEqual(KeycodeDisplay.get_label("KC_2"), danish["KC_2"])
+            self.assertTrue(KeycodeDisplay.code_is_overriden("KC_2"))
+            self.assertFalse(KeycodeDisplay.code_is_overriden("KC_A"))
+            self.assertEqual(KeycodeDisplay.button_label(Keycode.find("KC_2")), (danish["KC_2"], True))
+            self.assertEqual(KeycodeDisplay.tooltip("KC_2"), Keycode.tooltip("KC_2"))
+
+            # user keycodes get their labels from the keyboard
+            class CustomKeyboard(FakeKeyboard):
+                custom_keycodes = [{"name": "MY_KEY", "title": "My key", "shortName": "Mine"}]
+
+            self.assertEqual(KeycodeDisplay.get_label("USER00"), "User 0")
+            recreate_keyboard_keycodes(CustomKeyboard())
+            self.assertEqual(KeycodeDisplay.get_label("USER00"), "Mine")
+        finally:
+            KeycodeDisplay.set_keymap_override(KEYMAPS[0][1])
@@ -2,7 +2,7 @@
 import sys
 import time
 
-from PyQt5.QtCore import Qt, QTimer, QCoreApplication, QByteArray, QBuffer, QIODevice
+from PyQt5.QtCore import Qt, QTimer, QCoreApplication, QByteArray, QBuffer, QIODevice, QThread
 from PyQt5.QtGui import QPalette
 from PyQt5.QtWidgets import QVBoxLayout, QLabel, QProgressBar, QDialog, QApplication
 
@@ -12,6 +12,10 @@ from util import tr
 
 class Unlocker(QDialog):
 
+    # set up by the main window, there is nothing to show the dialog in without it
+    global_layout_editor = None
+    global_main_window = None
+
     def __init__(self, layout_editor, keyboard):
         super().__init__()
 
@@ -58,10 +62,6 @@ class Unlocker(QDialog):
             if (w.desc.row, w.desc.col) in lock_keys:
                 w.setOn(True)
 
-        self.keyboard_reference.update_layout()
-        self.keyboard_reference.update()
-        self.keyboard_reference.updateGeometry()
-
     def unlock_poller(self):
         data = self.keyboard.unlock_poll()
         unlocked = data[0]
@@ -111,15 +111,21 @@ class Unlocker(QDialog):
         if keyboard.get_unlock_status() == 1:
             return True
 
+        # e.g. an AsyncKeyboard command running on a pool thread in a script
+        if cls.global_main_window is None or QThread.currentThread() is not cls.global_main_window.thread():
+            raise RuntimeError("the keyboard is locked, it needs to be unlocked from the Vial GUI first")
+
         cls.dlg_retval = None
-        dlg = cls(cls.global_layout_editor, keyboard)
-        dlg.finished.connect(cls.on_dialog_finished)
-        cls.global_main_window.lock_ui()
-        dlg.setModal(True)
-        dlg.show()
-        while cls.dlg_retval is None:
-            time.sleep(0.05)
-            QCoreApplication.processEvents()
+        # holding down the unlock keys doesn't count against the deadline of whatever needed the unlock
+        with keyboard.retry_policy.suspended():
+            dlg = cls(cls.global_layout_editor, keyboard)
+            dlg.finished.connect(cls.on_dialog_finished)
+            cls.global_main_window.lock_ui()
+            dlg.setModal(True)
+            dlg.show()
+            while cls.dlg_retval is None:
+                time.sleep(0.05)
+                QCoreApplication.processEvents()
         ret = cls.dlg_retval
         cls.global_main_window.unlock_ui()
         return ret
@@ -2,8 +2,12 @@
 import logging
 import os
 import pathlib
+import random
 import sys
+import threading
 import time
+from collections import Counter
+from contextlib import contextmanager
 from logging.handlers import RotatingFileHandler
 
 from PyQt5.QtCore import QCoreApplication, QStandardPaths
@@ -13,6 +17,8 @@ from PyQt5.QtWidgets import QApplication, QWidget, QScrollArea, QFrame
 from hidproxy import hid
 from keycodes.keycodes import Keycode
 from keymaps import KEYMAPS
+from protocol.constants import CMD_VIA_KEYMAP_GET_BUFFER, CMD_VIA_MACRO_GET_BUFFER, CMD_VIA_VIAL_PREFIX, \
+    VIA_UNHANDLED
 
 tr = QCoreApplication.translate
 
@@ -24,6 +30,9 @@ VIBL_SERIAL_NUMBER_MAGIC = "vibl:d4f8159c"
 
 MSG_LEN = 32
 
+# how many requests hid_send_many keeps outstanding at once
+HID_PIPELINE_WINDOW = 4
+
 # these should match what we have in vial-qmk/keyboards/vial_example
 # so that people don't accidentally reuse a sample keyboard UID
 EXAMPLE_KEYBOARDS = [
@@ -37,36 +46,274 @@ EXAMPLE_KEYBOARDS = [
 EXAMPLE_KEYBOARD_PREFIX = 0xA6867BDFD3B00F
 
 
-def hid_send(dev, msg, retries=1):
+class RetryPolicy:
+    """
+    Timeouts and delays used by hid_send, learnt from how fast a particular device answers
+
+    The read timeout follows the smoothed round-trip time and doubles on every retry, delays between retries
+    back off exponentially with jitter, and operation() puts a deadline on everything sent inside it.
+    The last attempt of a command always gets the full MAX_TIMEOUT_MS, so commands sent without retries
+    still leave the firmware time for slow work such as EEPROM writes.
+
+    A policy is shared by the GUI thread and the I/O worker, all of its state is guarded by a lock
+    """
+
+    MIN_TIMEOUT_MS = 200
+    MAX_TIMEOUT_MS = 500
+    BACKOFF_BASE = 0.01
+    BACKOFF_MAX = 0.5
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # smoothed round-trip time and its variation, in seconds
+        self.srtt = None
+        self.rttvar = 0
+        # [operation name, deadline, times suspended] of operations in progress, outermost first
+        self.operations = []
+        # command byte -> how many retries it took in total
+        self.retry_counts = Counter()
+        self.last_retries = 0
+        self.operation_retries = 0
+
+    def timeout_ms(self, attempt=0, outstanding=1, final=False):
+        """ Read timeout for the given attempt; final is set when there won't be another attempt after it """
+        with self.lock:
+            if self.srtt is None or final:
+                timeout = self.MAX_TIMEOUT_MS
+            else:
+                timeout = (self.srtt + 4 * self.rttvar) * 1000 * outstanding
+            timeout = max(self.MIN_TIMEOUT_MS, min(self.MAX_TIMEOUT_MS, timeout)) * (2 ** attempt)
+            return int(min(timeout, self.MAX_TIMEOUT_MS, self.remaining() * 1000))
+
+    def backoff(self, attempt):
+        """ Returns how long to sleep before retry number `attempt` (counting from 1) """
+        delay = min(self.BACKOFF_MAX, self.BACKOFF_BASE * (2 ** (attempt - 1)))
+        return min(random.uniform(delay / 2, delay), self.remaining())
+
+    def observe(self, rtt):
+        with self.lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def record(self, msg, retries):
+        with self.lock:
+            self.last_retries = retries
+            if retries:
+                self.retry_counts[msg[0]] += retries
+                self.operation_retries += retries
+        if retries:
+            logging.info("hid_send: command %02X took %d retries", msg[0], retries)
+
+    def remaining(self):
+        """ Seconds left until the deadline of the current operation """
+        with self.lock:
+            deadlines = [deadline for name, deadline, suspended in self.operations if not suspended]
+            if not deadlines:
+                return float("inf")
+            return max(0, min(deadlines) - time.monotonic())
+
+    def check_deadline(self):
+        with self.lock:
+            if self.remaining() <= 0:
+                name = [name for name, deadline, suspended in self.operations if not suspended][0]
+                raise RuntimeError("{} did not finish in time".format(name))
+
+    @contextmanager
+    def operation(self, name, seconds):
+        """ Limits the total time everything sent inside of this block is allowed to take """
+        entry = [name, time.monotonic() + seconds, 0]
+        with self.lock:
+            if not self.operations:
+                self.operation_retries = 0
+            self.operations.append(entry)
+        try:
+            yield
+        finally:
+            with self.lock:
+                # operations started from another thread may have come and gone in the meantime
+                self.operations.remove(entry)
+                retries = 0 if self.operations else self.operation_retries
+            if retries:
+                logging.info("%s: %d retries in total", name, retries)
+
+    @contextmanager
+    def suspended(self):
+        """ Stops the clock on running operations, e.g. while waiting on the user """
+        with self.lock:
+            operations = list(self.operations)
+            for entry in operations:
+                entry[2] += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self.lock:
+                for entry in operations:
+                    entry[1] += elapsed
+                    entry[2] -= 1
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+def _echo_header(msg):
+    """ Returns the part of a request which the firmware echoes back in its response, or None if it doesn't """
+    if msg[0] in [CMD_VIA_KEYMAP_GET_BUFFER, CMD_VIA_MACRO_GET_BUFFER]:
+        # command, 16-bit offset, size
+        return msg[:4]
+    if msg[0] != CMD_VIA_VIAL_PREFIX:
+        # VIA answers in-place, so at least the command byte is preserved
+        return msg[:1]
+    # vial commands overwrite the whole report with their response
+    return None
+
+
+def response_matches(msg, data):
+    """ Checks whether `data` can be the response to request `msg` """
+    header = _echo_header(msg)
+    if header is None or data.startswith(header):
+        return True
+    # VIA replaces the command byte with id_unhandled for commands it doesn't know
+    return len(header) == 1 and data[0] == VIA_UNHANDLED
+
+
+def _hid_drain(dev):
+    """ Discards input reports that are already queued without waiting for new ones """
+    # webhid reads always block, and there is no queue on our side to get out of sync there
+    if sys.platform == "emscripten":
+        return
+    try:
+        while dev.read(MSG_LEN, timeout_ms=0):
+            logging.warning("hid: discarding a stale input report")
+    except OSError:
+        pass
+
+
+def _hid_read_matching(dev, msg, timeout_ms):
+    """ Reads until a response to `msg` arrives or timeout_ms passes, discarding anything else """
+    deadline = time.monotonic() + timeout_ms / 1000
+    while True:
+        data = bytes(dev.read(MSG_LEN, timeout_ms=max(0, int((deadline - time.monotonic()) * 1000))))
+        if not data or response_matches(msg, data):
+            return data
+        logging.warning("hid: discarding response %s which does not match request %s",
+                        data[:4].hex(), msg[:4].hex())
+        if time.monotonic() >= deadline:
+            return b""
+
+
+def hid_send(dev, msg, retries=1, policy=None):
     if len(msg) > MSG_LEN:
         raise RuntimeError("message must be less than 32 bytes")
     msg += b"\x00" * (MSG_LEN - len(msg))
+    if policy is None:
+        policy = DEFAULT_RETRY_POLICY
 
     data = b""
-    first = True
-
-    while retries > 0:
-        retries -= 1
-        if not first:
-            time.sleep(0.5)
-        first = False
+    attempt = 0
+
+    while attempt < retries:
+        if attempt > 0:
+            time.sleep(policy.backoff(attempt))
+        policy.check_deadline()
+        timeout_ms = policy.timeout_ms(attempt, final=attempt == retries - 1)
+        attempt += 1
         try:
+            # a response to an earlier request that timed out might still be queued
+            _hid_drain(dev)
+
+            start = time.monotonic()
             # add 00 at start for hidapi report id
             if dev.write(b"\x00" + msg) != MSG_LEN + 1:
                 continue
 
-            data = bytes(dev.read(MSG_LEN, timeout_ms=500))
+            data = _hid_read_matching(dev, msg, timeout_ms)
             if not data:
                 continue
+            policy.observe(time.monotonic() - start)
         except OSError:
             continue
         break
 
+    policy.record(msg, attempt - 1)
     if not data:
         raise RuntimeError("failed to communicate with the device")
     return data
 
 
+def hid_send_many(dev, msgs, window=HID_PIPELINE_WINDOW, retries=1, on_stall=None, policy=None):
+    """
+    Sends a batch of independent requests keeping up to `window` of them in flight, returns list of responses
+
+    Responses are matched to requests by the echoed command header for commands which echo one, and by order
+    otherwise. When the device stops answering (some firmware drops queued reports), on_stall is called and
+    everything that is not known to be answered correctly is redone in lock-step with hid_send
+    """
+
+    padded = []
+    for msg in msgs:
+        if len(msg) > MSG_LEN:
+            raise RuntimeError("message must be less than 32 bytes")
+        padded.append(msg + b"\x00" * (MSG_LEN - len(msg)))
+
+    if policy is None:
+        policy = DEFAULT_RETRY_POLICY
+
+    results = [None] * len(padded)
+    pending = []
+    nxt = 0
+    stalled = False
+
+    _hid_drain(dev)
+
+    while nxt < len(padded) or pending:
+        try:
+            while nxt < len(padded) and len(pending) < window:
+                # add 00 at start for hidapi report id
+                if dev.write(b"\x00" + padded[nxt]) != MSG_LEN + 1:
+                    raise OSError("short write")
+                pending.append(nxt)
+                nxt += 1
+
+            policy.check_deadline()
+            data = bytes(dev.read(MSG_LEN, timeout_ms=policy.timeout_ms(outstanding=len(pending))))
+        except OSError:
+            data = b""
+        if not data:
+            stalled = True
+            break
+
+        for idx in pending:
+            if _echo_header(padded[idx]) is None and idx != pending[0]:
+                continue
+            if response_matches(padded[idx], data):
+                results[idx] = data
+                pending.remove(idx)
+                break
+        else:
+            logging.warning("hid: discarding response %s which does not match any request in flight", data[:4].hex())
+
+    if stalled:
+        if on_stall is not None:
+            on_stall()
+        # once a request went unanswered, responses matched purely by order after it could be shifted
+        first_missing = min(pending) if pending else nxt
+        for idx in range(first_missing, len(padded)):
+            if _echo_header(padded[idx]) is None:
+                results[idx] = None
+        _hid_drain(dev)
+        for idx, msg in enumerate(padded):
+            if results[idx] is None:
+                results[idx] = hid_send(dev, msg, retries=retries, policy=policy)
+
+    return results
+
+
 def is_rawhid(desc, quiet):
     if desc["usage_page"] != 0xFF60 or desc["usage"] != 0x61:
         if not quiet:
@@ -172,23 +419,68 @@ class KeycodeDisplay:
     keymap_override = KEYMAPS[0][1]
     clients = []
 
+    # (label, overriden, tooltip) of codes seen under the active keymap override, see lookup()
+    labels = dict()
+    # (label, overriden) of palette buttons by qmk_id
+    button_labels = dict()
+    # what the tables above were built for: active keymap override and Keycode.generation
+    labels_key = None
+
+    @classmethod
+    def check_labels(cls):
+        key = (id(cls.keymap_override), Keycode.generation)
+        if cls.labels_key != key:
+            cls.labels.clear()
+            cls.button_labels.clear()
+            cls.labels_key = key
+
+    @classmethod
+    def lookup(cls, code):
+        """ Returns (label, overriden, tooltip) of a code """
+        cls.check_labels()
+        entry = cls.labels.get(code)
+        if entry is None:
+            key = Keycode.find_outer_keycode(code)
+            overriden = key is not None and key.qmk_id in cls.keymap_override
+            if overriden:
+                label = cls.keymap_override[key.qmk_id]
+            else:
+                label = Keycode.label(code)
+            entry = (label, overriden, Keycode.tooltip(code))
+            cls.labels[code] = entry
+        return entry
+
     @classmethod
     def get_label(cls, code):
         """ Get label for a specific keycode """
-        if cls.code_is_overriden(code):
-            return cls.keymap_override[Keycode.find_outer_keycode(code).qmk_id]
-        return Keycode.label(code)
+        return cls.lookup(code)[0]
 
     @classmethod
     def code_is_overriden(cls, code):
         """ Check whether a country-specific keymap overrides a code """
-        key = Keycode.find_outer_keycode(code)
-        return key is not None and key.qmk_id in cls.keymap_override
+        return cls.lookup(code)[1]
 
     @classmethod
-    def display_keycode(cls, widget, code):
-        text = cls.get_label(code)
-        tooltip = Keycode.tooltip(code)
+    def tooltip(cls, code):
+        return cls.lookup(code)[2]
+
+    @classmethod
+    def button_label(cls, keycode):
+        """ Returns (label, overriden) for a palette button of the given Keycode """
+        cls.check_labels()
+        entry = cls.button_labels.get(keycode.qmk_id)
+        if entry is None:
+            if keycode.qmk_id in cls.keymap_override:
+                entry = (cls.keymap_override[keycode.qmk_id], True)
+            else:
+                entry = (keycode.label, False)
+            cls.button_labels[keycode.qmk_id] = entry
+        return entry
+
+    @classmethod
+    def describe(cls, code):
+        """ Returns what display_keycode shows for a code, to be passed to show() """
+        text, overriden, tooltip = cls.lookup(code)
         mask = Keycode.is_mask(code)
         mask_text = ""
         inner = Keycode.find_inner_keycode(code)
@@ -196,19 +488,29 @@ class KeycodeDisplay:
             mask_text = cls.get_label(inner.qmk_id)
         if mask:
             text = text.split("\n")[0]
-        widget.masked = mask
+        mask_overriden = bool(inner and mask and cls.code_is_overriden(inner.qmk_id))
+        return text, mask_text, tooltip, mask, overriden, mask_overriden
+
+    @classmethod
+    def show(cls, widget, display):
+        text, mask_text, tooltip, mask, overriden, mask_overriden = display
+        widget.setMasked(mask)
         widget.setText(text)
         widget.setMaskText(mask_text)
         widget.setToolTip(tooltip)
-        if cls.code_is_overriden(code):
+        if overriden:
             widget.setColor(QApplication.palette().color(QPalette.Link))
         else:
             widget.setColor(None)
-        if inner and mask and cls.code_is_overriden(inner.qmk_id):
+        if mask_overriden:
             widget.setMaskColor(QApplication.palette().color(QPalette.Link))
         else:
             widget.setMaskColor(None)
 
+    @classmethod
+    def display_keycode(cls, widget, code):
+        cls.show(widget, cls.describe(code))
+
     @classmethod
     def set_keymap_override(cls, override):
         cls.keymap_override = override
@@ -227,12 +529,6 @@ class KeycodeDisplay:
     @classmethod
     def relabel_buttons(cls, buttons):
         for widget in buttons:
-            qmk_id = widget.keycode.qmk_id
-            if qmk_id in KeycodeDisplay.keymap_override:
-                label = KeycodeDisplay.keymap_override[qmk_id]
-                highlight_color = QApplication.palette().color(QPalette.Link).getRgb()
-                widget.setStyleSheet("QPushButton {color: rgb%s;}" % str(highlight_color))
-            else:
-                label = widget.keycode.label
-                widget.setStyleSheet("QPushButton {}")
+            label, overriden = cls.button_label(widget.keycode)
+            widget.setHighlighted(overriden)
             widget.setText(label.replace("&", "&&"))
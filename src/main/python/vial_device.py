@@ -1,10 +1,15 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
+import sys
 import time
+from concurrent.futures import Future
 
+from compiled_layout import LayoutCache
 from hidproxy import hid
+from protocol.definition_cache import DefinitionCache
+from protocol.io_worker import IoWorker
 from protocol.keyboard_comm import Keyboard
 from protocol.dummy_keyboard import DummyKeyboard
-from util import MSG_LEN, pad_for_vibl
+from util import MSG_LEN, pad_for_vibl, hid_send_many
 
 
 class VialDevice:
@@ -15,15 +20,25 @@ class VialDevice:
         self.sideload = False
         self.via_stack = False
 
-    def open(self, override_json=None):
+    def open(self, override_json=None, callback=None):
+        """ callback, if given, is called with a Future once the device is ready to use """
         self.dev = hid.device()
         for x in range(10):
             try:
                 self.dev.open_path(self.desc["path"])
-                return
+                break
             except OSError:
                 time.sleep(1)
-        raise RuntimeError("unable to open the device")
+        else:
+            raise RuntimeError("unable to open the device")
+        if callback is not None:
+            self.opened(callback)
+
+    @staticmethod
+    def opened(callback):
+        future = Future()
+        future.set_result(None)
+        callback(future)
 
     def send(self, data):
         # add 00 at start for hidapi report id
@@ -44,11 +59,38 @@ class VialKeyboard(VialDevice):
         self.sideload = sideload
         self.via_stack = via_stack
         self.keyboard = None
+        self.io_worker = None
 
-    def open(self, override_json=None):
+    def open(self, override_json=None, callback=None):
+        """
+            With callback, the keyboard is loaded in the background if possible and callback gets
+            a Future once that's done; otherwise this blocks until the keyboard is loaded
+        """
         super().open(override_json)
-        self.keyboard = Keyboard(self.dev)
-        self.keyboard.reload(override_json)
+        # webhid hands us one report at a time, so there is nothing to gain from pipelining there
+        if sys.platform == "emscripten":
+            self.keyboard = Keyboard(self.dev, definition_cache=DefinitionCache(),
+                                     layout_cache=LayoutCache.shared())
+        else:
+            self.keyboard = Keyboard(self.dev, usb_send_many=hid_send_many, definition_cache=DefinitionCache(),
+                                     layout_cache=LayoutCache.shared())
+            # keep device I/O off the GUI thread
+            self.io_worker = IoWorker()
+            self.io_worker.start()
+            self.keyboard.attach_io_worker(self.io_worker)
+        # with a worker to stream in the remaining layers, the GUI can come up after the first one
+        progressive = self.io_worker is not None
+        if callback is not None:
+            self.keyboard.submit_reload(callback, override_json, progressive=progressive)
+        else:
+            self.keyboard.reload(override_json, progressive=progressive)
+
+    def close(self):
+        if self.io_worker is not None:
+            self.keyboard.cancel_prefetch()
+            self.io_worker.stop()
+            self.io_worker = None
+        super().close()
 
     def title(self):
         s = "{} {}".format(self.desc["manufacturer_string"], self.desc["product_string"]).strip()
@@ -91,9 +133,11 @@ class VialDummyKeyboard(VialKeyboard):
         self.sideload = True
         self.desc = {"path": "/dummy/keyboard"}
 
-    def open(self, override_json=None):
+    def open(self, override_json=None, callback=None):
         self.keyboard = DummyKeyboard(None, usb_send=self.raise_usb_send)
         self.keyboard.reload(override_json)
+        if callback is not None:
+            self.opened(callback)
 
     def title(self):
         return "[Dummy Keyboard]"
@@ -1,6 +1,4 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
-import json
-
 from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtWidgets import QGridLayout, QWidget, QSizePolicy
 
@@ -8,7 +6,7 @@ from constants import KEYCODE_BTN_RATIO
 from keycodes.keycodes import Keycode
 from util import KeycodeDisplay
 from widgets.square_button import SquareButton
-from kle_serial import Serial as KleSerial
+from compiled_layout import LayoutCache
 
 
 class DisplayKeyboard(QWidget):
@@ -22,8 +20,7 @@ class DisplayKeyboard(QWidget):
         self.setSizePolicy(QSizePolicy.Maximum, QSizePolicy.Maximum)
         self.buttons = []
 
-        keymap = KleSerial().deserialize(json.loads(kbdef))
-        for key in keymap.keys:
+        for key in LayoutCache.shared().load(kbdef).keys():
             kc = Keycode.find_by_qmk_id(key.labels[0])
             btn = SquareButton()
             btn.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
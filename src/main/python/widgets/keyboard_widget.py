@@ -1,6 +1,7 @@
-from collections import defaultdict
+import math
+from collections import defaultdict, OrderedDict
 
-from PyQt5.QtGui import QPainter, QColor, QPainterPath, QTransform, QBrush, QPolygonF, QPalette
+from PyQt5.QtGui import QPainter, QColor, QPainterPath, QTransform, QBrush, QPolygonF, QPalette, QPixmap, QPen
 from PyQt5.QtWidgets import QWidget, QToolTip, QApplication
 from PyQt5.QtCore import Qt, QSize, QRect, QPointF, pyqtSignal, QEvent, QRectF
 
@@ -10,118 +11,109 @@ from constants import KEY_SIZE_RATIO, KEY_SPACING_RATIO, KEYBOARD_WIDGET_PADDING
 from themes import Theme
 
 
-class KeyWidget:
+class KeyGeometry:
+    """
+        Shape of a keycap in its own coordinates, with the top-left corner of the key at the origin
 
-    def __init__(self, desc, scale, shift_x=0, shift_y=0):
-        self.active = False
-        self.on = False
-        self.masked = False
-        self.pressed = False
-        self.desc = desc
-        self.text = ""
-        self.mask_text = ""
-        self.tooltip = ""
-        self.color = None
-        self.mask_color = None
-        self.scale = 0
+        Only the size and shape of a key go into it, so every key which looks the same shares one instance,
+        see get(). KeyWidget places it on the keyboard.
+    """
 
-        self.rotation_angle = desc.rotation_angle
+    MAX_ENTRIES = 4096
+
+    templates = OrderedDict()
+
+    @staticmethod
+    def shape(desc):
+        """ Everything about desc which affects the geometry """
+        return desc.width, desc.height, desc.width2, desc.height2, desc.x2, desc.y2
+
+    @classmethod
+    def get(cls, desc, scale):
+        key = (cls, scale) + cls.shape(desc)
+        geometry = cls.templates.get(key)
+        if geometry is None:
+            geometry = cls(key, desc, scale)
+            cls.templates[key] = geometry
+            if len(cls.templates) > cls.MAX_ENTRIES:
+                cls.templates.popitem(last=False)
+        else:
+            cls.templates.move_to_end(key)
+        return geometry
 
+    def __init__(self, key, desc, scale):
+        # also identifies pre-rendered keycaps of this shape, see KeycapCache
+        self.key = key
         self.has2 = desc.width2 != desc.width or desc.height2 != desc.height or desc.x2 != 0 or desc.y2 != 0
 
-        self.update_position(scale, shift_x, shift_y)
+        self.size = scale * (KEY_SIZE_RATIO + KEY_SPACING_RATIO)
+        spacing = scale * KEY_SPACING_RATIO
 
-    def update_position(self, scale, shift_x=0, shift_y=0):
-        if self.scale != scale or self.shift_x != shift_x or self.shift_y != shift_y:
-            self.scale = scale
-            self.size = self.scale * (KEY_SIZE_RATIO + KEY_SPACING_RATIO)
-            spacing = self.scale * KEY_SPACING_RATIO
+        self.w = self.size * desc.width - spacing
+        self.h = self.size * desc.height - spacing
 
-            self.rotation_x = self.size * self.desc.rotation_x
-            self.rotation_y = self.size * self.desc.rotation_y
+        self.rect = QRect(0, 0, round(self.w), round(self.h))
+        self.text_rect = QRect(
+            0,
+            round(self.size * SHADOW_TOP_PADDING),
+            round(self.w),
+            round(self.h - self.size * (SHADOW_BOTTOM_PADDING + SHADOW_TOP_PADDING))
+        )
 
-            self.shift_x = shift_x
-            self.shift_y = shift_y
-            self.x = self.size * self.desc.x
-            self.y = self.size * self.desc.y
-            self.w = self.size * self.desc.width - spacing
-            self.h = self.size * self.desc.height - spacing
-
-            self.rect = QRect(
-                round(self.x),
-                round(self.y),
-                round(self.w),
-                round(self.h)
-            )
-            self.text_rect = QRect(
-                round(self.x),
-                round(self.y + self.size * SHADOW_TOP_PADDING),
-                round(self.w),
-                round(self.h - self.size * (SHADOW_BOTTOM_PADDING + SHADOW_TOP_PADDING))
-            )
+        self.x2 = self.size * desc.x2
+        self.y2 = self.size * desc.y2
+        self.w2 = self.size * desc.width2 - spacing
+        self.h2 = self.size * desc.height2 - spacing
 
-            self.x2 = self.x + self.size * self.desc.x2
-            self.y2 = self.y + self.size * self.desc.y2
-            self.w2 = self.size * self.desc.width2 - spacing
-            self.h2 = self.size * self.desc.height2 - spacing
+        self.rect2 = QRect(
+            round(self.x2),
+            round(self.y2),
+            round(self.w2),
+            round(self.h2)
+        )
 
-            self.rect2 = QRect(
-                round(self.x2),
-                round(self.y2),
-                round(self.w2),
-                round(self.h2)
-            )
+        self.polygon = self.corners(self.rect).united(self.corners(self.rect2))
+        self.corner = self.size * KEY_ROUNDNESS
+        self.background_draw_path = self.calculate_background_draw_path()
+        self.foreground_draw_path = self.calculate_foreground_draw_path()
+        self.extra_draw_path = self.calculate_extra_draw_path()
+
+        # calculate areas where the inner keycode will be located
+        # nonmask = outer (e.g. Rsft_T)
+        # mask = inner (e.g. KC_A)
+        self.nonmask_rect = QRect(
+            0,
+            round(self.size * KEYBOARD_WIDGET_NONMASK_PADDING),
+            round(self.w),
+            round(self.h * (1 - KEYBOARD_WIDGET_MASK_HEIGHT))
+        )
+        self.mask_rect = QRect(
+            round(self.size * SHADOW_SIDE_PADDING),
+            round(self.h * (1 - KEYBOARD_WIDGET_MASK_HEIGHT)),
+            round(self.w - 2 * self.size * SHADOW_SIDE_PADDING),
+            round(self.h * KEYBOARD_WIDGET_MASK_HEIGHT - self.size * SHADOW_BOTTOM_PADDING)
+        )
+        self.mask_polygon = self.corners(self.mask_rect)
 
-            self.bbox = self.calculate_bbox(self.rect)
-            self.bbox2 = self.calculate_bbox(self.rect2)
-            self.polygon = QPolygonF(self.bbox + [self.bbox[0]])
-            self.polygon2 = QPolygonF(self.bbox2 + [self.bbox2[0]])
-            self.polygon = self.polygon.united(self.polygon2)
-            self.corner = self.size * KEY_ROUNDNESS
-            self.background_draw_path = self.calculate_background_draw_path()
-            self.foreground_draw_path = self.calculate_foreground_draw_path()
-            self.extra_draw_path = self.calculate_extra_draw_path()
-
-            # calculate areas where the inner keycode will be located
-            # nonmask = outer (e.g. Rsft_T)
-            # mask = inner (e.g. KC_A)
-            self.nonmask_rect = QRect(
-                round(self.x),
-                round(self.y + self.size * KEYBOARD_WIDGET_NONMASK_PADDING),
-                round(self.w),
-                round(self.h * (1 - KEYBOARD_WIDGET_MASK_HEIGHT))
-            )
-            self.mask_rect = QRect(
-                round(self.x + self.size * SHADOW_SIDE_PADDING),
-                round(self.y + self.h * (1 - KEYBOARD_WIDGET_MASK_HEIGHT)),
-                round(self.w - 2 * self.size * SHADOW_SIDE_PADDING),
-                round(self.h * KEYBOARD_WIDGET_MASK_HEIGHT - self.size * SHADOW_BOTTOM_PADDING)
-            )
-            self.mask_bbox = self.calculate_bbox(self.mask_rect)
-            self.mask_polygon = QPolygonF(self.mask_bbox + [self.mask_bbox[0]])
+        # area covered when drawing this key
+        render_rect = self.background_draw_path.boundingRect().united(self.extra_draw_path.boundingRect())
+        margin = KeycapCache.MARGIN
+        self.render_rect = render_rect.adjusted(-margin, -margin, margin, margin)
 
-    def calculate_bbox(self, rect):
+    @staticmethod
+    def corners(rect):
         x1 = rect.topLeft().x()
         y1 = rect.topLeft().y()
         x2 = rect.bottomRight().x()
         y2 = rect.bottomRight().y()
-        points = [(x1, y1), (x1, y2), (x2, y2), (x2, y1)]
-        bbox = []
-        for p in points:
-            t = QTransform()
-            t.translate(self.shift_x, self.shift_y)
-            t.translate(self.rotation_x, self.rotation_y)
-            t.rotate(self.rotation_angle)
-            t.translate(-self.rotation_x, -self.rotation_y)
-            p = t.map(QPointF(p[0], p[1]))
-            bbox.append(p)
-        return bbox
+        points = [(x1, y1), (x1, y2), (x2, y2), (x2, y1), (x1, y1)]
+        return QPolygonF([QPointF(x, y) for x, y in points])
 
     def calculate_background_draw_path(self):
         path = QPainterPath()
         path.addRoundedRect(
-            round(self.x),
-            round(self.y),
+            0,
+            0,
             round(self.w),
             round(self.h),
             self.corner,
@@ -146,8 +138,8 @@ class KeyWidget:
     def calculate_foreground_draw_path(self):
         path = QPainterPath()
         path.addRoundedRect(
-            round(self.x + self.size * SHADOW_SIDE_PADDING),
-            round(self.y + self.size * SHADOW_TOP_PADDING),
+            round(self.size * SHADOW_SIDE_PADDING),
+            round(self.size * SHADOW_TOP_PADDING),
             round(self.w - 2 * self.size * SHADOW_SIDE_PADDING),
             round(self.h - self.size * (SHADOW_BOTTOM_PADDING + SHADOW_TOP_PADDING)),
             self.corner,
@@ -172,51 +164,27 @@ class KeyWidget:
     def calculate_extra_draw_path(self):
         return QPainterPath()
 
-    def setText(self, text):
-        self.text = text
 
-    def setMaskText(self, text):
-        self.mask_text = text
-
-    def setToolTip(self, tooltip):
-        self.tooltip = tooltip
-
-    def setActive(self, active):
-        self.active = active
+class EncoderGeometry(KeyGeometry):
 
-    def setOn(self, on):
-        self.on = on
-
-    def setPressed(self, pressed):
-        self.pressed = pressed
+    @staticmethod
+    def shape(desc):
+        return KeyGeometry.shape(desc) + (desc.encoder_dir,)
 
-    def setColor(self, color):
-        self.color = color
-
-    def setMaskColor(self, color):
-        self.mask_color = color
-
-    def __repr__(self):
-        qualifiers = ["KeyboardWidget"]
-        if self.desc.row is not None:
-            qualifiers.append("matrix:{},{}".format(self.desc.row, self.desc.col))
-        if self.desc.layout_index != -1:
-            qualifiers.append("layout:{},{}".format(self.desc.layout_index, self.desc.layout_option))
-        return " ".join(qualifiers)
-
-
-class EncoderWidget(KeyWidget):
+    def __init__(self, key, desc, scale):
+        self.encoder_dir = desc.encoder_dir
+        super().__init__(key, desc, scale)
 
     def calculate_background_draw_path(self):
         path = QPainterPath()
-        path.addEllipse(round(self.x), round(self.y), round(self.w), round(self.h))
+        path.addEllipse(0, 0, round(self.w), round(self.h))
         return path
 
     def calculate_foreground_draw_path(self):
         path = QPainterPath()
         path.addEllipse(
-            round(self.x + self.size * SHADOW_SIDE_PADDING),
-            round(self.y + self.size * SHADOW_TOP_PADDING),
+            round(self.size * SHADOW_SIDE_PADDING),
+            round(self.size * SHADOW_TOP_PADDING),
             round(self.w - 2 * self.size * SHADOW_SIDE_PADDING),
             round(self.h - self.size * (SHADOW_BOTTOM_PADDING + SHADOW_TOP_PADDING))
         )
@@ -226,9 +194,9 @@ class EncoderWidget(KeyWidget):
         path = QPainterPath()
         # midpoint of arrow triangle
         p = self.h
-        x = self.x
-        y = self.y + p / 2
-        if self.desc.encoder_dir == 0:
+        x = 0
+        y = p / 2
+        if self.encoder_dir == 0:
             # counterclockwise - pointing down
             path.moveTo(round(x), round(y))
             path.lineTo(round(x + p / 10), round(y - p / 10))
@@ -244,16 +212,253 @@ class EncoderWidget(KeyWidget):
             path.lineTo(round(x), round(y))
         return path
 
+
+class KeyWidget:
+
+    geometry_class = KeyGeometry
+
+    def __init__(self, desc, scale, shift_x=0, shift_y=0):
+        self.active = False
+        self.on = False
+        self.masked = False
+        self.pressed = False
+        self.desc = desc
+        self.text = ""
+        self.mask_text = ""
+        self.tooltip = ""
+        self.color = None
+        self.mask_color = None
+        self.scale = 0
+        # KeyboardWidget which displays this key, notified whenever the key needs to be repainted
+        self.owner = None
+
+        self.rotation_angle = desc.rotation_angle
+
+        self.update_position(scale, shift_x, shift_y)
+
+    def update_position(self, scale, shift_x=0, shift_y=0):
+        if self.scale != scale or self.shift_x != shift_x or self.shift_y != shift_y:
+            self.scale = scale
+            self.geometry = self.geometry_class.get(self.desc, scale)
+            size = self.geometry.size
+
+            self.rotation_x = size * self.desc.rotation_x
+            self.rotation_y = size * self.desc.rotation_y
+
+            self.shift_x = shift_x
+            self.shift_y = shift_y
+            self.x = size * self.desc.x
+            self.y = size * self.desc.y
+
+            # maps the key's own coordinates onto the keyboard, before scaling
+            t = QTransform()
+            t.translate(self.shift_x, self.shift_y)
+            t.translate(self.rotation_x, self.rotation_y)
+            t.rotate(self.rotation_angle)
+            t.translate(-self.rotation_x, -self.rotation_y)
+            t.translate(round(self.x), round(self.y))
+            self.transform = t
+
+            self.polygon = t.map(self.geometry.polygon)
+            self.mask_polygon = t.map(self.geometry.mask_polygon)
+            # area to repaint when this key changes
+            self.paint_rect = t.mapRect(self.geometry.render_rect)
+
+    def setText(self, text):
+        if self.text != text:
+            self.text = text
+            self.changed()
+
+    def setMaskText(self, text):
+        if self.mask_text != text:
+            self.mask_text = text
+            self.changed()
+
+    def setMasked(self, masked):
+        if self.masked != masked:
+            self.masked = masked
+            self.changed()
+
+    def setToolTip(self, tooltip):
+        self.tooltip = tooltip
+
+    def setActive(self, active):
+        if self.active != active:
+            self.active = active
+            self.changed()
+
+    def setOn(self, on):
+        if self.on != on:
+            self.on = on
+            self.changed()
+
+    def setPressed(self, pressed):
+        if self.pressed != pressed:
+            self.pressed = pressed
+            self.changed()
+
+    def setColor(self, color):
+        if self.color != color:
+            self.color = color
+            self.changed()
+
+    def setMaskColor(self, color):
+        if self.mask_color != color:
+            self.mask_color = color
+            self.changed()
+
+    def changed(self):
+        if self.owner is not None:
+            self.owner.update_key(self)
+
+    def __repr__(self):
+        qualifiers = ["KeyboardWidget"]
+        if self.desc.row is not None:
+            qualifiers.append("matrix:{},{}".format(self.desc.row, self.desc.col))
+        if self.desc.layout_index != -1:
+            qualifiers.append("layout:{},{}".format(self.desc.layout_index, self.desc.layout_option))
+        return " ".join(qualifiers)
+
+
+class EncoderWidget(KeyWidget):
+
+    geometry_class = EncoderGeometry
+
     def __repr__(self):
         return "EncoderWidget"
 
 
+class KeycapStyle:
+    """ Pens and brushes for drawing keycaps, derived from the application palette """
+
+    def __init__(self):
+        palette = QApplication.palette()
+        self.key = (palette.cacheKey(), Theme.mask_light_factor())
+
+        # for regular keycaps
+        self.regular_pen = QPen(palette.color(QPalette.ButtonText))
+
+        self.background_brush = QBrush(palette.color(QPalette.Button), Qt.SolidPattern)
+        self.foreground_brush = QBrush(palette.color(QPalette.Button).lighter(120), Qt.SolidPattern)
+        self.mask_brush = QBrush(palette.color(QPalette.Button).lighter(Theme.mask_light_factor()), Qt.SolidPattern)
+
+        # for currently selected keycap
+        self.active_pen = QPen(palette.color(QPalette.Highlight))
+        self.active_pen.setWidthF(1.5)
+
+        # for the encoder arrow
+        self.extra_pen = self.regular_pen
+        self.extra_brush = QBrush(palette.color(QPalette.ButtonText), Qt.SolidPattern)
+
+        # for pressed keycaps
+        self.background_pressed_brush = QBrush(palette.color(QPalette.Highlight), Qt.SolidPattern)
+        self.foreground_pressed_brush = QBrush(palette.color(QPalette.Highlight).lighter(120), Qt.SolidPattern)
+
+        self.background_on_brush = QBrush(palette.color(QPalette.Highlight).darker(150), Qt.SolidPattern)
+        self.foreground_on_brush = QBrush(palette.color(QPalette.Highlight).darker(120), Qt.SolidPattern)
+
+    @classmethod
+    def current(cls):
+        """ Returns the style for the current palette, rebuilding it only after a theme change """
+        palette = QApplication.palette()
+        if KeycapCache.style is None or KeycapCache.style.key != (palette.cacheKey(), Theme.mask_light_factor()):
+            KeycapCache.clear()
+            KeycapCache.style = cls()
+        return KeycapCache.style
+
+
+class KeycapCache:
+    """
+        Pre-rendered keycaps shared by all keyboard widgets, least recently used first
+
+        A repaint only needs to blit a pixmap for every key whose shape and state was drawn before.
+        The cache is bounded by the memory taken up by the pixmaps rather than their number, a keycap
+        on a HiDPI screen at a large scale is many times the size of one at 1x.
+    """
+
+    MAX_BYTES = 16 * 1024 * 1024
+    # extra room around the keycap for the selection outline
+    MARGIN = 2
+
+    pixmaps = OrderedDict()
+    size = 0
+    style = None
+
+    @staticmethod
+    def pixmap_bytes(pixmap):
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+    @classmethod
+    def get(cls, key):
+        pixmap = cls.pixmaps.get(key)
+        if pixmap is not None:
+            cls.pixmaps.move_to_end(key)
+        return pixmap
+
+    @classmethod
+    def put(cls, key, pixmap):
+        old = cls.pixmaps.pop(key, None)
+        if old is not None:
+            cls.size -= cls.pixmap_bytes(old)
+        cls.pixmaps[key] = pixmap
+        cls.size += cls.pixmap_bytes(pixmap)
+        # always keep the one just added, even if it doesn't fit by itself
+        while cls.size > cls.MAX_BYTES and len(cls.pixmaps) > 1:
+            cls.size -= cls.pixmap_bytes(cls.pixmaps.popitem(last=False)[1])
+
+    @classmethod
+    def clear(cls):
+        cls.pixmaps.clear()
+        cls.size = 0
+
+
+class KeyGrid:
+    """
+        Uniform grid over the bounding boxes of placed keys, used to find the keys under a point
+
+        Every cell lists, in display order, the keys whose (rotated) bounding box overlaps it; only those
+        need an exact polygon test.
+    """
+
+    def __init__(self, widgets, cell_size):
+        self.cell_size = max(cell_size, 1)
+        self.cells = defaultdict(list)
+        for widget in widgets:
+            bbox = widget.polygon.boundingRect()
+            x1, y1 = self.cell(bbox.left(), bbox.top())
+            x2, y2 = self.cell(bbox.right(), bbox.bottom())
+            for cx in range(x1, x2 + 1):
+                for cy in range(y1, y2 + 1):
+                    self.cells[(cx, cy)].append(widget)
+
+    def cell(self, x, y):
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def candidates(self, point):
+        return self.cells.get(self.cell(point.x(), point.y()), [])
+
+
+class Placement:
+    """ Widgets displayed for one combination of layout options, with where to put them """
+
+    def __init__(self, widgets, positions, grid, width, height):
+        self.widgets = widgets
+        # (scale, shift_x, shift_y) of every widget
+        self.positions = positions
+        self.grid = grid
+        self.width = width
+        self.height = height
+
+
 class KeyboardWidget(QWidget):
 
     clicked = pyqtSignal()
     deselected = pyqtSignal()
     anykey = pyqtSignal()
 
+    # how many layout option combinations to remember the placement of
+    MAX_PLACEMENTS = 32
+
     def __init__(self, layout_editor):
         super().__init__()
 
@@ -273,14 +478,25 @@ class KeyboardWidget(QWidget):
 
         # widgets in current layout
         self.widgets = []
+        # index of self.widgets by position, for hit_test
+        self.grid = KeyGrid([], 1)
 
         self.width = self.height = 0
         self.active_key = None
         self.active_mask = False
 
+        # what the current placement of self.widgets was computed from, see update_layout
+        self.placement = None
+        # recently used placements by what they were computed from
+        self.placements = OrderedDict()
+        # layout options which affect what is displayed
+        self.layout_indices = []
+
     def set_keys(self, keys, encoders):
         self.common_widgets = []
         self.widgets_for_layout = []
+        self.placement = None
+        self.placements.clear()
 
         self.add_keys([(x, KeyWidget) for x in keys] + [(x, EncoderWidget) for x in encoders])
         self.update_layout()
@@ -289,10 +505,13 @@ class KeyboardWidget(QWidget):
         scale_factor = self.fontMetrics().height()
 
         for key, cls in keys:
+            widget = cls(key, scale_factor)
+            widget.owner = self
             if key.layout_index == -1:
-                self.common_widgets.append(cls(key, scale_factor))
+                self.common_widgets.append(widget)
             else:
-                self.widgets_for_layout.append(cls(key, scale_factor))
+                self.widgets_for_layout.append(widget)
+        self.layout_indices = sorted(set(w.desc.layout_index for w in self.widgets_for_layout))
 
     def place_widgets(self):
         scale_factor = self.fontMetrics().height()
@@ -337,24 +556,52 @@ class KeyboardWidget(QWidget):
             widget.update_position(widget.scale, widget.shift_x - top_x + self.padding,
                                    widget.shift_y - top_y + self.padding)
 
-    def update_layout(self):
-        """ Updates self.widgets for the currently active layout """
+    def calculate_placement(self):
+        """ Places widgets for the currently active layout """
 
-        # determine widgets for current layout
         self.place_widgets()
-        self.widgets = list(filter(lambda w: not w.desc.decal, self.widgets))
+        widgets = list(filter(lambda w: not w.desc.decal, self.widgets))
 
-        self.widgets.sort(key=lambda w: (w.y, w.x))
+        widgets.sort(key=lambda w: (w.y, w.x))
+        # a cell about the size of a 1u key keeps the number of candidates per cell small
+        grid = KeyGrid(widgets, self.fontMetrics().height() * (KEY_SIZE_RATIO + KEY_SPACING_RATIO))
 
         # determine maximum width and height of container
         max_w = max_h = 0
-        for key in self.widgets:
+        for key in widgets:
             p = key.polygon.boundingRect().bottomRight()
             max_w = max(max_w, p.x() * self.scale)
             max_h = max(max_h, p.y() * self.scale)
 
-        self.width = round(max_w + 2 * self.padding)
-        self.height = round(max_h + 2 * self.padding)
+        return Placement(widgets, [(w.scale, w.shift_x, w.shift_y) for w in widgets], grid,
+                         round(max_w + 2 * self.padding), round(max_h + 2 * self.padding))
+
+    def update_layout(self):
+        """ Updates self.widgets for the currently active layout """
+
+        # nothing to do unless the font, scale or chosen layout options changed since the last time
+        placement = (self.fontMetrics().height(), self.scale, self.padding,
+                     tuple(self.layout_editor.get_choice(idx) for idx in self.layout_indices))
+        if placement == self.placement:
+            return
+        self.placement = placement
+
+        cached = self.placements.get(placement)
+        if cached is None:
+            cached = self.calculate_placement()
+            self.placements[placement] = cached
+            if len(self.placements) > self.MAX_PLACEMENTS:
+                self.placements.popitem(last=False)
+        else:
+            self.placements.move_to_end(placement)
+            # only moves keys back into place, the shapes themselves come from KeyGeometry
+            for widget, position in zip(cached.widgets, cached.positions):
+                widget.update_position(*position)
+
+        self.widgets = list(cached.widgets)
+        self.grid = cached.grid
+        self.width = cached.width
+        self.height = cached.height
 
         self.update()
         self.updateGeometry()
@@ -364,124 +611,144 @@ class KeyboardWidget(QWidget):
         qp.begin(self)
         qp.setRenderHint(QPainter.Antialiasing)
 
-        # for regular keycaps
-        regular_pen = qp.pen()
-        regular_pen.setColor(QApplication.palette().color(QPalette.ButtonText))
-        qp.setPen(regular_pen)
-
-        background_brush = QBrush()
-        background_brush.setColor(QApplication.palette().color(QPalette.Button))
-        background_brush.setStyle(Qt.SolidPattern)
-
-        foreground_brush = QBrush()
-        foreground_brush.setColor(QApplication.palette().color(QPalette.Button).lighter(120))
-        foreground_brush.setStyle(Qt.SolidPattern)
-
-        mask_brush = QBrush()
-        mask_brush.setColor(QApplication.palette().color(QPalette.Button).lighter(Theme.mask_light_factor()))
-        mask_brush.setStyle(Qt.SolidPattern)
-
-        # for currently selected keycap
-        active_pen = qp.pen()
-        active_pen.setColor(QApplication.palette().color(QPalette.Highlight))
-        active_pen.setWidthF(1.5)
-
-        # for the encoder arrow
-        extra_pen = regular_pen
-        extra_brush = QBrush()
-        extra_brush.setColor(QApplication.palette().color(QPalette.ButtonText))
-        extra_brush.setStyle(Qt.SolidPattern)
-
-        # for pressed keycaps
-        background_pressed_brush = QBrush()
-        background_pressed_brush.setColor(QApplication.palette().color(QPalette.Highlight))
-        background_pressed_brush.setStyle(Qt.SolidPattern)
-
-        foreground_pressed_brush = QBrush()
-        foreground_pressed_brush.setColor(QApplication.palette().color(QPalette.Highlight).lighter(120))
-        foreground_pressed_brush.setStyle(Qt.SolidPattern)
+        # only keys within the area being repainted need to be drawn
+        exposed = event.region()
 
-        background_on_brush = QBrush()
-        background_on_brush.setColor(QApplication.palette().color(QPalette.Highlight).darker(150))
-        background_on_brush.setStyle(Qt.SolidPattern)
-
-        foreground_on_brush = QBrush()
-        foreground_on_brush.setColor(QApplication.palette().color(QPalette.Highlight).darker(120))
-        foreground_on_brush.setStyle(Qt.SolidPattern)
-
-        mask_font = qp.font()
-        mask_font.setPointSize(round(mask_font.pointSize() * 0.8))
+        style = KeycapStyle.current()
+        # everything besides the key itself which determines what a pre-rendered keycap looks like
+        render_key = (self.scale, self.devicePixelRatioF(), style.key, self.font().key())
 
         for idx, key in enumerate(self.widgets):
+            if not exposed.intersects(self.key_rect(key)):
+                continue
+
             qp.save()
 
             qp.scale(self.scale, self.scale)
-            qp.translate(key.shift_x, key.shift_y)
-            qp.translate(key.rotation_x, key.rotation_y)
-            qp.rotate(key.rotation_angle)
-            qp.translate(-key.rotation_x, -key.rotation_y)
+            qp.setTransform(key.transform, True)
 
             active = key.active or (self.active_key == key and not self.active_mask)
+            mask_active = self.active_key == key and self.active_mask
 
-            # draw keycap background/drop-shadow
-            qp.setPen(active_pen if active else Qt.NoPen)
-            brush = background_brush
-            if key.pressed:
-                brush = background_pressed_brush
-            elif key.on:
-                brush = background_on_brush
-            qp.setBrush(brush)
-            qp.drawPath(key.background_draw_path)
-
-            # draw keycap foreground
-            qp.setPen(Qt.NoPen)
-            brush = foreground_brush
-            if key.pressed:
-                brush = foreground_pressed_brush
-            elif key.on:
-                brush = foreground_on_brush
-            qp.setBrush(brush)
-            qp.drawPath(key.foreground_draw_path)
-
-            # draw key text
-            if key.masked:
-                # draw the outer legend
-                qp.setFont(mask_font)
-                qp.setPen(key.color if key.color else regular_pen)
-                qp.drawText(key.nonmask_rect, Qt.AlignCenter, key.text)
-
-                # draw the inner highlight rect
-                qp.setPen(active_pen if self.active_key == key and self.active_mask else Qt.NoPen)
-                qp.setBrush(mask_brush)
-                qp.drawRoundedRect(key.mask_rect, key.corner, key.corner)
-
-                # draw the inner legend
-                qp.setPen(key.mask_color if key.mask_color else regular_pen)
-                qp.drawText(key.mask_rect, Qt.AlignCenter, key.mask_text)
+            if key.rotation_angle:
+                # a pixmap would have to be resampled, draw these directly to keep legends sharp
+                self.draw_keycap(qp, key, style, active, mask_active)
             else:
-                # draw the legend
-                qp.setPen(key.color if key.color else regular_pen)
-                qp.drawText(key.text_rect, Qt.AlignCenter, key.text)
-
-            # draw the extra shape (encoder arrow)
-            qp.setPen(extra_pen)
-            qp.setBrush(extra_brush)
-            qp.drawPath(key.extra_draw_path)
+                qp.drawPixmap(self.keycap_origin(qp, key),
+                              self.keycap_pixmap(key, style, active, mask_active, render_key))
 
             qp.restore()
 
         qp.end()
 
+    def keycap_origin(self, qp, key):
+        """ Where to blit the pre-rendered keycap of an unrotated key, snapped to whole device pixels """
+        origin = key.geometry.render_rect.topLeft()
+        # position in widget coordinates, qp is scaled and translated to the key
+        target = qp.transform().map(origin)
+        ratio = self.devicePixelRatioF()
+        snapped = QPointF(round(target.x() * ratio) / ratio, round(target.y() * ratio) / ratio)
+        return origin + (snapped - target) / self.scale
+
+    def keycap_pixmap(self, key, style, active, mask_active, render_key):
+        color = key.color.rgba() if key.color else None
+        mask_color = key.mask_color.rgba() if key.mask_color else None
+        cache_key = (key.geometry.key, render_key, active, mask_active, key.pressed, key.on, key.masked,
+                     key.text, key.mask_text, color, mask_color)
+
+        pixmap = KeycapCache.get(cache_key)
+        if pixmap is None:
+            ratio = self.scale * self.devicePixelRatioF()
+            render_rect = key.geometry.render_rect
+            pixmap = QPixmap(math.ceil(render_rect.width() * ratio), math.ceil(render_rect.height() * ratio))
+            pixmap.setDevicePixelRatio(ratio)
+            pixmap.fill(Qt.transparent)
+
+            qp = QPainter()
+            qp.begin(pixmap)
+            qp.setRenderHint(QPainter.Antialiasing)
+            qp.setFont(self.font())
+            qp.translate(-render_rect.topLeft())
+            self.draw_keycap(qp, key, style, active, mask_active)
+            qp.end()
+
+            KeycapCache.put(cache_key, pixmap)
+        return pixmap
+
+    def draw_keycap(self, qp, key, style, active, mask_active):
+        """ Draws the key in its own coordinates, see KeyGeometry """
+
+        geometry = key.geometry
+        regular_pen = style.regular_pen
+
+        # draw keycap background/drop-shadow
+        qp.setPen(style.active_pen if active else Qt.NoPen)
+        brush = style.background_brush
+        if key.pressed:
+            brush = style.background_pressed_brush
+        elif key.on:
+            brush = style.background_on_brush
+        qp.setBrush(brush)
+        qp.drawPath(geometry.background_draw_path)
+
+        # draw keycap foreground
+        qp.setPen(Qt.NoPen)
+        brush = style.foreground_brush
+        if key.pressed:
+            brush = style.foreground_pressed_brush
+        elif key.on:
+            brush = style.foreground_on_brush
+        qp.setBrush(brush)
+        qp.drawPath(geometry.foreground_draw_path)
+
+        # draw key text
+        if key.masked:
+            # draw the outer legend
+            mask_font = qp.font()
+            mask_font.setPointSize(round(mask_font.pointSize() * 0.8))
+            qp.setFont(mask_font)
+            qp.setPen(key.color if key.color else regular_pen)
+            qp.drawText(geometry.nonmask_rect, Qt.AlignCenter, key.text)
+
+            # draw the inner highlight rect
+            qp.setPen(style.active_pen if mask_active else Qt.NoPen)
+            qp.setBrush(style.mask_brush)
+            qp.drawRoundedRect(geometry.mask_rect, geometry.corner, geometry.corner)
+
+            # draw the inner legend
+            qp.setPen(key.mask_color if key.mask_color else regular_pen)
+            qp.drawText(geometry.mask_rect, Qt.AlignCenter, key.mask_text)
+        else:
+            # draw the legend
+            qp.setPen(key.color if key.color else regular_pen)
+            qp.drawText(geometry.text_rect, Qt.AlignCenter, key.text)
+
+        # draw the extra shape (encoder arrow)
+        qp.setPen(style.extra_pen)
+        qp.setBrush(style.extra_brush)
+        qp.drawPath(geometry.extra_draw_path)
+
+    def key_rect(self, key):
+        """ Area covered by key in widget coordinates """
+        r = key.paint_rect
+        return QRectF(r.x() * self.scale, r.y() * self.scale, r.width() * self.scale,
+                      r.height() * self.scale).toAlignedRect()
+
+    def update_key(self, key):
+        """ Schedules a repaint of the area covered by key; Qt merges these into a single paint event """
+        self.update(self.key_rect(key))
+
     def minimumSizeHint(self):
         return QSize(self.width, self.height)
 
     def hit_test(self, pos):
         """ Returns key, hit_masked_part """
 
-        for key in self.widgets:
-            if key.masked and key.mask_polygon.containsPoint(pos/self.scale, Qt.OddEvenFill):
+        pos = pos / self.scale
+        for key in self.grid.candidates(pos):
+            if key.masked and key.mask_polygon.containsPoint(pos, Qt.OddEvenFill):
                 return key, True
-            if key.polygon.containsPoint(pos/self.scale, Qt.OddEvenFill):
+            if key.polygon.containsPoint(pos, Qt.OddEvenFill):
                 return key, False
 
         return None, False
@@ -490,12 +757,15 @@ class KeyboardWidget(QWidget):
         if not self.enabled:
             return
 
+        previous = self.active_key
         self.active_key, self.active_mask = self.hit_test(ev.pos())
+        for key in [previous, self.active_key]:
+            if key is not None:
+                self.update_key(key)
         if self.active_key is not None:
             self.clicked.emit()
         else:
             self.deselected.emit()
-        self.update()
 
     def resizeEvent(self, ev):
         if self.isEnabled():
@@ -509,14 +779,16 @@ class KeyboardWidget(QWidget):
             if key == self.active_key:
                 self.active_key = keys_looped[x + 1]
                 self.active_mask = False
+                self.update_key(key)
+                self.update_key(self.active_key)
                 self.clicked.emit()
                 return
 
     def deselect(self):
         if self.active_key is not None:
+            self.update_key(self.active_key)
             self.active_key = None
             self.deselected.emit()
-            self.update()
 
     def event(self, ev):
         if not self.enabled:
@@ -539,6 +811,7 @@ class KeyboardWidget(QWidget):
 
     def set_scale(self, scale):
         self.scale = scale
+        KeycapCache.clear()
 
     def get_scale(self):
         return self.scale
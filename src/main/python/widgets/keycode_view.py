@@ -0,0 +1,230 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import math
+
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QSortFilterProxyModel, QSize, QRect, \
+    QPersistentModelIndex, pyqtSignal
+from PyQt5.QtGui import QPalette
+from PyQt5.QtWidgets import QListView, QStyledItemDelegate, QStyleOptionButton, QStyle, QSizePolicy, QFrame, \
+    QApplication
+
+from util import KeycodeDisplay
+
+
+class KeycodeModel(QAbstractListModel):
+    """
+        Keycodes of a palette, preceded by prefix entries such as "Any"
+
+        Labels follow the active keymap override; call relabel() after it changes.
+    """
+
+    # what gets emitted when the entry is clicked
+    CodeRole = Qt.UserRole
+    # True for prefix entries, these are shown regardless of the keycode filter
+    PrefixRole = Qt.UserRole + 1
+
+    def __init__(self, keycodes, prefix_buttons=None):
+        super().__init__()
+        self.keycodes = keycodes
+        self.prefix = prefix_buttons or []
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.prefix) + len(self.keycodes)
+
+    def data(self, index, role=Qt.DisplayRole):
+        row = index.row()
+        if row < len(self.prefix):
+            title, code = self.prefix[row]
+            if role in [Qt.DisplayRole, self.CodeRole]:
+                return title
+            if role == self.PrefixRole:
+                return True
+            return None
+
+        keycode = self.keycodes[row - len(self.prefix)]
+        label, overriden = KeycodeDisplay.button_label(keycode)
+        if role == Qt.DisplayRole:
+            return label
+        elif role == Qt.ToolTipRole:
+            return KeycodeDisplay.tooltip(keycode.qmk_id)
+        elif role == Qt.ForegroundRole:
+            return QApplication.palette().color(QPalette.Link) if overriden else None
+        elif role == self.CodeRole:
+            return keycode.qmk_id
+        elif role == self.PrefixRole:
+            return False
+        return None
+
+    def reload(self):
+        """ The list of keycodes changed, e.g. after recreate_keyboard_keycodes """
+        self.beginResetModel()
+        self.endResetModel()
+
+    def relabel(self):
+        if self.rowCount() > 0:
+            self.dataChanged.emit(self.index(0), self.index(self.rowCount() - 1),
+                                  [Qt.DisplayRole, Qt.ForegroundRole])
+
+
+class KeycodeFilterModel(QSortFilterProxyModel):
+    """ Hides keycodes rejected by a keycode filter, e.g. keycode_filter_masked """
+
+    def __init__(self, keycode_filter):
+        super().__init__()
+        self.keycode_filter = keycode_filter
+
+    def set_keycode_filter(self, keycode_filter):
+        self.keycode_filter = keycode_filter
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, row, parent):
+        index = self.sourceModel().index(row, 0, parent)
+        if index.data(KeycodeModel.PrefixRole):
+            return True
+        return self.keycode_filter(index.data(KeycodeModel.CodeRole))
+
+
+class KeycodeDelegate(QStyledItemDelegate):
+    """ Paints an entry like a SquareButton of the given relative size """
+
+    def __init__(self, ratio):
+        super().__init__()
+        self.ratio = ratio
+
+    def sizeHint(self, option, index):
+        size = int(round(option.fontMetrics.height() * self.ratio))
+        return QSize(size, size)
+
+    def paint(self, painter, option, index):
+        view = option.widget
+        opt = QStyleOptionButton()
+        opt.initFrom(view)
+        # option.rect is the whole grid cell, which includes the spacing to the next entry
+        opt.rect = QRect(option.rect.topLeft(), self.sizeHint(option, index))
+        opt.state = QStyle.State_Enabled
+        if option.state & QStyle.State_MouseOver:
+            opt.state |= QStyle.State_MouseOver
+        if view.pressed == QPersistentModelIndex(index):
+            opt.state |= QStyle.State_Sunken
+        else:
+            opt.state |= QStyle.State_Raised
+        view.style().drawControl(QStyle.CE_PushButtonBevel, opt, painter, view)
+
+        painter.save()
+        color = index.data(Qt.ForegroundRole)
+        painter.setPen(color if color is not None else option.palette.color(QPalette.ButtonText))
+        painter.drawText(view.style().subElementRect(QStyle.SE_PushButtonContents, opt, view),
+                         Qt.AlignCenter, index.data(Qt.DisplayRole))
+        painter.restore()
+
+
+class KeycodeView(QListView):
+    """
+        Palette of keycodes laid out left to right and wrapped like a FlowLayout of buttons
+
+        Only the visible entries get painted, and a different keycode filter or keymap override doesn't
+        create any widgets. The view never scrolls itself; it asks for the height of all of its rows
+        so that the containing scroll area can scroll it.
+    """
+
+    keycode_changed = pyqtSignal(str)
+
+    def __init__(self, model, keycode_filter, ratio):
+        super().__init__()
+
+        self.pressed = QPersistentModelIndex()
+
+        self.proxy = KeycodeFilterModel(keycode_filter)
+        self.proxy.setSourceModel(model)
+        self.setModel(self.proxy)
+        self.setItemDelegate(KeycodeDelegate(ratio))
+
+        self.setFlow(QListView.LeftToRight)
+        self.setWrapping(True)
+        self.setResizeMode(QListView.Adjust)
+        self.setUniformItemSizes(True)
+        self.setSelectionMode(QListView.NoSelection)
+        self.setEditTriggers(QListView.NoEditTriggers)
+        self.setFocusPolicy(Qt.NoFocus)
+        self.setMouseTracking(True)
+        self.viewport().setAttribute(Qt.WA_Hover)
+        self.viewport().setAutoFillBackground(False)
+        self.setFrameShape(QFrame.NoFrame)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+
+        policy = QSizePolicy(QSizePolicy.Preferred, QSizePolicy.Preferred)
+        policy.setHeightForWidth(True)
+        self.setSizePolicy(policy)
+
+        for signal in [self.proxy.modelReset, self.proxy.layoutChanged, self.proxy.rowsInserted,
+                       self.proxy.rowsRemoved]:
+            signal.connect(self.on_rows_changed)
+        self.clicked.connect(self.on_clicked)
+
+        self.update_grid()
+
+    def set_keycode_filter(self, keycode_filter):
+        self.proxy.set_keycode_filter(keycode_filter)
+
+    def keycode_count(self):
+        """ Number of entries shown, not counting the prefix """
+        count = 0
+        for row in range(self.proxy.rowCount()):
+            if not self.proxy.index(row, 0).data(KeycodeModel.PrefixRole):
+                count += 1
+        return count
+
+    def update_grid(self):
+        size = int(round(self.fontMetrics().height() * self.itemDelegate().ratio))
+        # same spacing as FlowLayout puts between buttons
+        self.spacing_x = self.style().pixelMetric(QStyle.PM_LayoutHorizontalSpacing) + \
+            self.style().layoutSpacing(QSizePolicy.PushButton, QSizePolicy.PushButton, Qt.Horizontal)
+        self.spacing_y = self.style().pixelMetric(QStyle.PM_LayoutVerticalSpacing) + \
+            self.style().layoutSpacing(QSizePolicy.PushButton, QSizePolicy.PushButton, Qt.Vertical)
+        self.setGridSize(QSize(size + max(self.spacing_x, 0), size + max(self.spacing_y, 0)))
+        self.updateGeometry()
+
+    def on_rows_changed(self, *args):
+        self.updateGeometry()
+
+    def on_clicked(self, index):
+        self.keycode_changed.emit(index.data(KeycodeModel.CodeRole))
+
+    def changeEvent(self, ev):
+        super().changeEvent(ev)
+        if ev.type() in [ev.FontChange, ev.StyleChange]:
+            self.update_grid()
+
+    def mousePressEvent(self, ev):
+        self.pressed = QPersistentModelIndex(self.indexAt(ev.pos()))
+        self.viewport().update()
+        super().mousePressEvent(ev)
+
+    def mouseReleaseEvent(self, ev):
+        super().mouseReleaseEvent(ev)
+        self.pressed = QPersistentModelIndex()
+        self.viewport().update()
+
+    def hasHeightForWidth(self):
+        return True
+
+    def heightForWidth(self, width):
+        rows = self.proxy.rowCount()
+        if rows == 0:
+            return 0
+        grid = self.gridSize()
+        per_row = max(1, (width + max(self.spacing_x, 0)) // grid.width())
+        return math.ceil(rows / per_row) * grid.height() - max(self.spacing_y, 0)
+
+    def sizeHint(self):
+        grid = self.gridSize()
+        return QSize(grid.width(), self.heightForWidth(self.width()))
+
+    def minimumSizeHint(self):
+        return self.gridSize()
+
+    def wheelEvent(self, ev):
+        # let the scroll area around us handle scrolling
+        ev.ignore()
@@ -1,7 +1,8 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
-from PyQt5.QtCore import QSize, Qt
-from PyQt5.QtWidgets import QPushButton, QLabel, QHBoxLayout
+from PyQt5.QtCore import QSize, Qt, QEvent
+from PyQt5.QtGui import QPalette
+from PyQt5.QtWidgets import QPushButton, QLabel, QHBoxLayout, QApplication
 
 class SquareButton(QPushButton):
 
@@ -12,6 +13,7 @@ class SquareButton(QPushButton):
         self.label = None
         self.word_wrap = False
         self.text = ""
+        self.highlighted = False
 
     def setRelSize(self, ratio):
         self.scale = ratio
@@ -21,6 +23,30 @@ class SquareButton(QPushButton):
         self.word_wrap = state
         self.setText(self.text)
 
+    def setHighlighted(self, highlighted):
+        """ Shows the text in the link color of the palette, e.g. for keycodes changed by a keymap override """
+        if self.highlighted == highlighted:
+            return
+        self.highlighted = highlighted
+        self.update_highlight()
+
+    def update_highlight(self):
+        # only the text colors are set, everything else keeps following the application palette;
+        # WindowText is what the label of a word-wrapped button is drawn with
+        palette = QPalette()
+        if self.highlighted:
+            link = QApplication.palette().color(QPalette.Link)
+            palette.setColor(QPalette.ButtonText, link)
+            palette.setColor(QPalette.WindowText, link)
+        self.setPalette(palette)
+
+    def changeEvent(self, event):
+        super().changeEvent(event)
+        # the theme was switched, pick up its link color
+        if event.type() in (QEvent.PaletteChange, QEvent.ApplicationPaletteChange) and self.highlighted and \
+                self.palette().color(QPalette.ButtonText) != QApplication.palette().color(QPalette.Link):
+            self.update_highlight()
+
     def sizeHint(self):
         size = int(round(self.fontMetrics().height() * self.scale))
         return QSize(size, size)
@@ -0,0 +1,66 @@
+import random
+import sys
+import time
+
+sys.path.append("src/main/python")
+
+from keycodes.keycodes import Keycode, recreate_keyboard_keycodes
+from any_keycode import AnyKeycode
+
+
+class SyntheticKeyboard:
+
+    vial_protocol = 6
+    layers = 32
+    rows = 12
+    cols = 24
+    macro_count = 128
+    tap_dance_count = 32
+    custom_keycodes = None
+    midi = None
+
+
+def uncached_deserialize(val):
+    """ Keycode.deserialize as it was before any caching: table lookup, then a fresh expression evaluator """
+    if val in Keycode.qmk_id_to_keycode:
+        return Keycode.resolve(Keycode.qmk_id_to_keycode[val].qmk_id)
+    return AnyKeycode().decode(val)
+
+
+def bench(label, fn, items, repeat=5):
+    best = None
+    for x in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            fn(item)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("{:<40} {:8.2f} ms".format(label, best * 1000))
+    return best
+
+
+def main():
+    kb = SyntheticKeyboard()
+    start = time.perf_counter()
+    recreate_keyboard_keycodes(kb)
+    print("{:<40} {:8.2f} ms".format("recreate_keyboard_keycodes", (time.perf_counter() - start) * 1000))
+
+    # a keymap mostly made of named keycodes with some modifiers, layer-taps and unnamed codes mixed in
+    rnd = random.Random(0)
+    named = [code for code in range(0x10000) if Keycode.serialize_table[code] is not None]
+    keymap = [rnd.choice(named) if rnd.random() < 0.9 else rnd.randrange(0x10000)
+              for x in range(kb.layers * kb.rows * kb.cols)]
+    strings = [Keycode.serialize(code) for code in keymap]
+    print("{} layers x {} rows x {} cols = {} keys".format(kb.layers, kb.rows, kb.cols, len(keymap)))
+
+    before = bench("decode (serialize_uncached)", Keycode.serialize_uncached, keymap)
+    after = bench("decode (serialize)", Keycode.serialize, keymap)
+    print("{:<40} {:8.1f}x".format("decode speedup", before / after))
+
+    before = bench("encode (expression evaluation)", uncached_deserialize, strings, repeat=1)
+    after = bench("encode (deserialize)", Keycode.deserialize, strings)
+    print("{:<40} {:8.1f}x".format("encode speedup", before / after))
+
+
+if __name__ == "__main__":
+    main()